@@ -0,0 +1,17 @@
+"""Prebuild the memory-mappable geolocation index used by trie.location_split
+
+USAGE:
+# python3 -m meerkat.classification.bloom_filter.build_geo_index
+
+Created on Oct 18, 2016
+@author: J. Andrew Key
+"""
+
+import logging
+
+from .trie import build_geo_index, GEO_INDEX_FILE
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	GEO_INDEX = build_geo_index()
+	logging.info("Saved {0} nodes to {1}".format(len(GEO_INDEX.trie), GEO_INDEX_FILE))
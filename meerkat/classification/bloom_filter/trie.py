@@ -6,7 +6,16 @@ Created on Jun 26, 2016
 """
 
 import csv
+import logging
+import mmap
+import os
 import re
+import struct
+import sys
+import threading
+
+from array import array
+from bisect import bisect_right
 
 from .generate_json import generate_js
 from meerkat.various_tools import load_params
@@ -38,6 +47,37 @@ LENGTHENINGS = {}
 for key in SHORTENINGS.keys():
 	LENGTHENINGS[SHORTENINGS[key]] = key
 
+ASSETS_DIR = 'meerkat/classification/bloom_filter/assets/'
+WORDS_FILE = ASSETS_DIR + 'words_start_with_states.json'
+CITIES_FILE = ASSETS_DIR + 'us_cities_larger.csv'
+LOCATIONS_FILE = ASSETS_DIR + 'locations.json'
+GEO_INDEX_FILE = ASSETS_DIR + 'geo_index.bin'
+
+# magic, byte order, (states, nodes, labels length) of the trie and of the
+# reversed trie, city names, city names length
+GEO_INDEX_HEADER = struct.Struct("<8s8sIIIIIIII")
+GEO_INDEX_MAGIC = b"MRKTGEO2"
+CO_ID_PATTERN = re.compile(" co id:", re.IGNORECASE)
+
+STATE_CODES = frozenset(STATES)
+PUNCTUATION = r'!"#$%&\'()*+,-./:;<=>?@[\]^_`{|}~'
+# Every character str.split() splits on
+WHITESPACE = "".join(chr(code) for code in range(0x3001) if chr(code).isspace())
+STANDARDIZE_TABLE = str.maketrans("", "", PUNCTUATION + WHITESPACE)
+TOKENIZE_TABLE = str.maketrans(PUNCTUATION.replace("'", ""), " " * (len(PUNCTUATION) - 1), "'")
+
+def load_state_words(json_file=WORDS_FILE):
+	"""Load the words that start with a state abbreviation but are not a state,
+	as frozensets keyed by state. The file is generated if it is missing."""
+	try:
+		words = load_params(json_file)
+	except (IOError, ValueError):
+		words = None
+	if not isinstance(words, dict):
+		generate_js()
+		words = load_params(json_file)
+	return {state: frozenset(words.get(state, [])) for state in STATES}
+
 class TrieNode():
 	"""This is the most basic component data structure within a Trie"""
 	def __init__(self):
@@ -103,13 +143,258 @@ class Trie():
 		state = word[:2]
 		return find(self.root.children[state], word[2:], state)
 
+class CompactTrie():
+	"""Array-backed, read-only copy of a Trie. Nodes are numbered breadth first,
+	so the children of a node are a contiguous run of ids and the edge labels
+	of all nodes are a single byte string. Children keep the insertion order of
+	the Trie, which makes wildcard searches return exactly what Trie.search does.
+	The arrays may be array objects or memoryviews of a memory-mapped file."""
+	__slots__ = ("states", "labels", "starts", "parents", "words", "num_states")
+
+	def __init__(self, states, labels, starts, parents, words):
+		"""Initializes the CompactTrie from its arrays"""
+		self.states = {state: node for node, state in enumerate(states)}
+		self.num_states = len(states)
+		self.labels = labels
+		self.starts = starts
+		self.parents = parents
+		self.words = words
+
+	def __path(self, state, node):
+		"""Rebuild the string spelled by the path from the root to node"""
+		chars = []
+		while self.parents[node] >= 0:
+			chars.append(chr(self.labels[node - self.num_states]))
+			node = self.parents[node]
+		return state + "".join(reversed(chars))
+
+	def find_node(self, word):
+		"""Return the id of the node reached by word, without wildcards, or -1"""
+		node = self.states.get(word[:2], -1)
+		labels, starts = self.labels, self.starts
+		for char in encode_label(word[2:]):
+			if node < 0:
+				break
+			position = labels.find(char, starts[node], starts[node + 1])
+			node = position + self.num_states if position >= 0 else -1
+		return node
+
+	def search(self, word):
+		"""Searches to see if the word is in the CompactTrie. The period character (.)
+		signifies any letter; returns the matching string or False, like Trie.search."""
+		any_char = ord(".")
+		state = word[:2]
+		node = self.states.get(state)
+		if node is None:
+			return False
+		word = encode_label(word[2:])
+		word_length = len(word)
+		labels, starts, words = self.labels, self.starts, self.words
+		offset = self.num_states
+
+		# Depth first search with an explicit stack of (node, position in word)
+		stack = [(node, 0)]
+		while stack:
+			node, index = stack.pop()
+			if index == word_length:
+				if words[node]:
+					return self.__path(state, node)
+				continue
+			char = word[index]
+			if char == any_char:
+				if words[node]:
+					return self.__path(state, node)
+				# Push in reverse so that children are visited in order
+				for position in range(starts[node + 1] - 1, starts[node] - 1, -1):
+					stack.append((position + offset, index + 1))
+			else:
+				position = labels.find(char, starts[node], starts[node + 1])
+				if position >= 0:
+					stack.append((position + offset, index + 1))
+		return False
+
+	def longest_reverse_match(self, state, text, end, min_length):
+		"""For a CompactTrie of reversed words, walk text backwards from end and
+		return the smallest start such that state + text[start:end] is a word of
+		at least min_length characters, or -1. text must be encoded."""
+		node = self.states.get(state)
+		if node is None:
+			return -1
+		labels, starts, words = self.labels, self.starts, self.words
+		offset = self.num_states
+		best = -1
+		for index in range(end - 1, -1, -1):
+			position = labels.find(text[index], starts[node], starts[node + 1])
+			if position < 0:
+				break
+			node = position + offset
+			if words[node] and end - index >= min_length:
+				best = index
+		return best
+
+	def __len__(self):
+		"""Return the number of nodes"""
+		return len(self.words)
+
+	@staticmethod
+	def from_trie(trie):
+		"""Build a CompactTrie from a Trie"""
+		states, labels, nodes = [], [], []
+		starts, parents, words = array("I"), array("i"), bytearray()
+
+		# The first level of nodes is keyed by two letter states
+		for state, node in trie.root.children.items():
+			states.append(state)
+			nodes.append(node)
+			parents.append(-1)
+
+		index = 0
+		while index < len(nodes):
+			node = nodes[index]
+			starts.append(len(labels))
+			words.append(node.isword)
+			for char, child in node.children.items():
+				labels.append(char)
+				parents.append(index)
+				nodes.append(child)
+			nodes[index] = None
+			index += 1
+		starts.append(len(labels))
+
+		labels = "".join(labels)
+		if "?" in labels or len(encode_label(labels)) != len(labels):
+			raise ValueError("City names must be latin-1 and must not contain '?'")
+		return CompactTrie(states, encode_label(labels), starts, parents, words)
+
+	def to_sections(self):
+		"""Return the byte strings save writes for this CompactTrie"""
+		return ["".join(self.states).encode("ascii"), self.starts.tobytes(),
+			self.parents.tobytes(), bytes(self.words), bytes(self.labels)]
+
+	@staticmethod
+	def section_formats(num_states, num_nodes, labels_length):
+		"""Return the (length, format) of each section written by to_sections"""
+		return [(num_states * 2, "B"), ((num_nodes + 1) * 4, "I"), (num_nodes * 4, "i"),
+			(num_nodes, "B"), (labels_length, "B")]
+
+	@staticmethod
+	def from_sections(states, starts, parents, words, labels):
+		"""Build a CompactTrie from memoryviews of the sections written by to_sections"""
+		states = bytes(states).decode("ascii")
+		states = [states[i:i + 2] for i in range(0, len(states), 2)]
+		# Labels are small and need bytes.find, so they are the only section copied
+		return CompactTrie(states, bytes(labels), starts, parents, words)
+
+def encode_label(text):
+	"""Encode trie labels as one byte per character; characters that cannot be
+	encoded become '?', which never appears in the trie"""
+	return text.encode("latin-1", "replace")
+
+class GeoIndex():
+	"""A CompactTrie of the short forms of every city, a CompactTrie of the same
+	words with the city reversed, and the city name each short form maps to. It
+	is saved to and memory-mapped from a binary file, so worker processes share
+	one page-cache copy instead of each building one."""
+	__slots__ = ("trie", "reverse", "values", "name_offsets", "names", "source")
+
+	def __init__(self, trie, reverse, values, name_offsets, names, source=None):
+		"""Initializes the GeoIndex, source is kept open for memory-mapped indexes"""
+		self.trie = trie
+		self.reverse = reverse
+		self.values = values
+		self.name_offsets = name_offsets
+		self.names = names
+		self.source = source
+
+	def get(self, place, default=None):
+		"""Return the (city, state) tuple for a place found in the trie"""
+		node = self.trie.find_node(place)
+		if node < 0 or self.values[node] < 0:
+			return default
+		city = self.values[node]
+		name = bytes(self.names[self.name_offsets[city]:self.name_offsets[city + 1]])
+		return (name.decode("utf-8"), place[:2])
+
+	def __contains__(self, place):
+		return self.get(place) is not None
+
+	def __getitem__(self, place):
+		result = self.get(place)
+		if result is None:
+			raise KeyError(place)
+		return result
+
+	@staticmethod
+	def from_trie(trie, city_map):
+		"""Build a GeoIndex from a Trie and the city map returned by build_trie"""
+		compact = CompactTrie.from_trie(trie)
+
+		reverse_trie = Trie()
+		for place in city_map:
+			reverse_trie.add(place[:2] + place[:1:-1])
+		reverse = CompactTrie.from_trie(reverse_trie)
+
+		# Store each distinct city name once, and a city id per word node
+		values = array("i", [-1]) * len(compact)
+		name_ids, name_offsets, names = {}, array("I", [0]), bytearray()
+		for place, (city, _) in city_map.items():
+			if city not in name_ids:
+				name_ids[city] = len(name_ids)
+				names.extend(city.encode("utf-8"))
+				name_offsets.append(len(names))
+			values[compact.find_node(place)] = name_ids[city]
+
+		return GeoIndex(compact, reverse, values, name_offsets, bytes(names))
+
+	def save(self, filename):
+		"""Write the GeoIndex to a binary file, atomically replacing filename"""
+		sections = self.trie.to_sections() + self.reverse.to_sections() + \
+			[self.values.tobytes(), self.name_offsets.tobytes(), bytes(self.names)]
+		counts = []
+		for trie in (self.trie, self.reverse):
+			counts.extend([trie.num_states, len(trie), len(trie.labels)])
+		header = GEO_INDEX_HEADER.pack(GEO_INDEX_MAGIC, sys.byteorder.encode("ascii"),
+			*(counts + [len(self.name_offsets) - 1, len(self.names)]))
+
+		temp_filename = "{0}.{1}.{2}.tmp".format(filename, os.getpid(), threading.get_ident())
+		with open(temp_filename, "wb") as output_file:
+			output_file.write(header)
+			for section in sections:
+				output_file.write(section)
+				output_file.write(b"\0" * (-len(section) % 4))
+		os.replace(temp_filename, filename)
+
+	@staticmethod
+	def load(filename):
+		"""Memory-map a GeoIndex written by save, or return None if the file
+		was written by an incompatible version or machine"""
+		with open(filename, "rb") as input_file:
+			source = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+		header = GEO_INDEX_HEADER.unpack_from(source)
+		magic, byteorder = header[:2]
+		if magic != GEO_INDEX_MAGIC or byteorder.rstrip(b"\0").decode("ascii") != sys.byteorder:
+			source.close()
+			return None
+		num_names, names_length = header[-2:]
+		formats = CompactTrie.section_formats(*header[2:5]) + \
+			CompactTrie.section_formats(*header[5:8]) + \
+			[(header[3] * 4, "i"), ((num_names + 1) * 4, "I"), (names_length, "B")]
+
+		view = memoryview(source)
+		position = GEO_INDEX_HEADER.size
+		sections = []
+		for length, fmt in formats:
+			sections.append(view[position:position + length].cast(fmt))
+			position += length + (-length % 4)
+
+		trie = CompactTrie.from_sections(*sections[0:5])
+		reverse = CompactTrie.from_sections(*sections[5:10])
+		values, name_offsets, names = sections[10:]
+		return GeoIndex(trie, reverse, values, name_offsets, names, source=source)
+
 def standardize(text):
 	"""converts text to all caps, no punctuation, and no whitespace"""
-	text = text.upper()
-	text = ''.join(text.split())
-	for mark in r'!"#$%&\'()*+,-./:;<=>?@[\]^_`{|}~':
-		text = text.replace(mark, "")
-	return text
+	return text.upper().translate(STANDARDIZE_TABLE)
 
 def get_short_forms(city):
 	"""Generate a list of all possible strings where we abbreviate certain words.
@@ -194,8 +479,46 @@ def build_trie(csv_filename, json_filename):
 
 	return trie, city_map
 
-TRIE, MAP = build_trie("meerkat/classification/bloom_filter/assets/us_cities_larger.csv",
-	'meerkat/classification/bloom_filter/assets/locations.json')
+def build_geo_index(csv_filename=CITIES_FILE, json_filename=LOCATIONS_FILE,
+	index_filename=GEO_INDEX_FILE):
+	"""Builds a GeoIndex using a CSV and a JSON file and saves it to index_filename,
+	the intermediate Trie is discarded."""
+	trie, city_map = build_trie(csv_filename, json_filename)
+	geo_index = GeoIndex.from_trie(trie, city_map)
+	if index_filename:
+		geo_index.save(index_filename)
+	return geo_index
+
+# GeoIndex by filename, loaded or built by one thread at a time
+GEO_INDEXES = dict()
+GEO_INDEX_LOCK = threading.Lock()
+
+def get_geo_index(index_filename=GEO_INDEX_FILE):
+	"""Memory-map the prebuilt GeoIndex on first use. If it is missing, older
+	than the source files or unreadable it is rebuilt and saved first, by one
+	thread while the others wait for it."""
+	geo_index = GEO_INDEXES.get(index_filename)
+	if geo_index is None:
+		with GEO_INDEX_LOCK:
+			geo_index = GEO_INDEXES.get(index_filename)
+			if geo_index is None:
+				geo_index = GEO_INDEXES[index_filename] = load_geo_index(index_filename)
+	return geo_index
+
+def load_geo_index(index_filename=GEO_INDEX_FILE):
+	"""Load the GeoIndex, rebuilding it first if needed"""
+	sources = [CITIES_FILE, LOCATIONS_FILE]
+	if os.path.isfile(index_filename) and \
+		os.path.getmtime(index_filename) >= max(map(os.path.getmtime, sources)):
+		geo_index = GeoIndex.load(index_filename)
+		if geo_index is not None:
+			return geo_index
+	logging.warning("Building {0}, run meerkat.classification.bloom_filter.build_geo_index "
+		"to prebuild it".format(index_filename))
+	build_geo_index(index_filename=index_filename)
+	return GeoIndex.load(index_filename)
+
+STATE_WORDS = load_state_words()
 
 def get_biggest_match(my_string, use_wildcards=False):
 	"""Return the largest match for my_string that is within the trie."""
@@ -211,23 +534,27 @@ def get_biggest_match(my_string, use_wildcards=False):
 		return None
 
 	state = my_string[-state_size:] #last two chars are the state
-	biggest = None
+	city_end = len(my_string) - state_size
+	geo_index = get_geo_index()
 
 	if not use_wildcards:
-		for i in range(len(my_string) - min_string_length, -1, -1):
-			city = my_string[i:-state_size]
-			place = TRIE.search(state + city)
+		# One walk of the reversed trie finds the longest city ending at the state
+		start = geo_index.reverse.longest_reverse_match(state, encode_label(my_string),
+			city_end, min_city_size)
+		return state + my_string[start:city_end] if start >= 0 else None
+
+	# The longest partial city is the one starting furthest left, so stop at the
+	# first start that matches. Most starts fail within a character or two.
+	max_wildcard_chars = 4
+	trie = geo_index.trie
+	for i in range(0, len(my_string) - min_wildcard_length + 1):
+		city = my_string[i:city_end]
+		if trie.find_node(state + city) >= 0:
+			place = trie.search(state + city + '.' * max_wildcard_chars)
 			if place:
-				biggest = place
-	else:
-		max_wildcard_chars = 4
-		for i in range(len(my_string) - min_wildcard_length, -1, -1):
-			city = my_string[i:-state_size]
-			place = TRIE.search(state + city + '.' * max_wildcard_chars)
-			if place:
-				biggest = place
+				return place
 
-	return biggest
+	return None
 
 def location_split(description):
 	"""
@@ -235,50 +562,71 @@ def location_split(description):
 	input: string - the transaction's description
 	returns: (string, string) - A (city, state) tuple or None
 	"""
-	pattern = re.compile(" co id:", re.IGNORECASE)
-	description = pattern.sub('', description)
+	geo_index = get_geo_index()
+	description = CO_ID_PATTERN.sub('', description)
 	beginning_indices = get_beginning_indices(description)
 	text = standardize(description)
-	json_file = 'meerkat/classification/bloom_filter/assets/words_start_with_states.json'
-	words = load_params(json_file)
-	if not isinstance(words, dict): 
-		generate_js()
-		words = load_params(json_file)
-	length = len(text)
+	boundaries = set(beginning_indices)
+	candidates, wildcard_candidates = find_states(text, beginning_indices, boundaries)
 
 	direction_abbreviations = ["E", "W", "S", "N"]
-	for i in range(length - 2, -1, -1):
-		if (text[i:i+2] in STATES and i+1 not in beginning_indices and
-			get_word(beginning_indices, text, i) not in words[text[i:i+2]]):
-			place = get_biggest_match(text[:i+2])
-			if place:
-				# check if the first letter is a direction_abbreviation AND if it is word unto itself
-				if place[2] in direction_abbreviations and i - (len(place) - 2) not in beginning_indices: 
-					# remove the non-abbreviation and then search again
-					plc = place[:2] + place[3:]
-					if plc == TRIE.search(plc):
-						place = plc
-				if place in MAP: 
-					return MAP[place]
-
-	for i in range(length - 2, -1, -1):
-		if text[i:i+2] in STATES and (i == length - 2 or i + 2 in beginning_indices):
-			place = get_biggest_match(text[:i+2], True)
-			if place:
-				if place in MAP: 
-					return MAP[place]
+	for i in candidates:
+		place = get_biggest_match(text[:i+2])
+		if place:
+			# check if the first letter is a direction_abbreviation AND if it is word unto itself
+			if place[2] in direction_abbreviations and i - (len(place) - 2) not in boundaries:
+				# remove the non-abbreviation and then search again
+				plc = place[:2] + place[3:]
+				if plc == geo_index.trie.search(plc):
+					place = plc
+			city_state = geo_index.get(place)
+			if city_state:
+				return city_state
+
+	for i in wildcard_candidates:
+		place = get_biggest_match(text[:i+2], True)
+		if place:
+			city_state = geo_index.get(place)
+			if city_state:
+				return city_state
 
 	return None
 
+def location_split_batch(descriptions):
+	"""
+	Locate many descriptions at once, each distinct description is only located once
+	input: list - transaction descriptions
+	returns: list - A (city, state) tuple or None for each description, in order
+	"""
+	locations = dict()
+	for description in descriptions:
+		if description not in locations:
+			locations[description] = location_split(description)
+	return [locations[description] for description in descriptions]
+
+def find_states(text, beginning_indices, boundaries):
+	"""Scan standardized text once, from the end, for state abbreviations.
+	Returns the positions worth a full match, those not starting a token nor a
+	word from STATE_WORDS, and the positions worth a wildcard match, those
+	ending text or a token."""
+	candidates, wildcard_candidates = [], []
+	length = len(text)
+	for i in range(length - 2, -1, -1):
+		state = text[i:i+2]
+		if state not in STATE_CODES:
+			continue
+		if i+1 not in boundaries and \
+			get_word(beginning_indices, text, i) not in STATE_WORDS[state]:
+			candidates.append(i)
+		if i == length - 2 or i + 2 in boundaries:
+			wildcard_candidates.append(i)
+	return candidates, wildcard_candidates
+
 def get_beginning_indices(text):
 	'''Record the index that shows where each token begins.'''
-	text = text.replace('\'', '')
-	for mark in r'!"#$%&\'()*+,-./:;<=>?@[\]^_`{|}~':
-		text = text.replace(mark, ' ')
-	text = text.strip()
 	beginning_indices = []
 	index = 0
-	for _, token in enumerate(text.split()):
+	for token in text.translate(TOKENIZE_TABLE).split():
 		beginning_indices.append(index)
 		index += len(token)
 	beginning_indices.append(index)
@@ -286,7 +634,7 @@ def get_beginning_indices(text):
 
 def get_word(beginning_indices, text, idx):
 	'''get the substring starting with the state name'''
-	position = [pos for pos in beginning_indices if pos > idx][0]
+	position = beginning_indices[bisect_right(beginning_indices, idx)]
 	return text[idx:position]
 
 if __name__ == "__main__":
@@ -19,13 +19,15 @@ from tensorflow.python.framework import ops
 from sklearn.externals import joblib
 from meerkat.various_tools import load_params
 from meerkat.classification.auto_load import main_program as load_models_from_s3
-from meerkat.classification.tensorflow_cnn import (validate_config, get_tensor, string_to_tensor)
+from meerkat.classification.tensorflow_cnn import (validate_config, get_tensor, strings_to_tensor)
+from meerkat.classification.tools import EncodedBatch
 from meerkat.longtail.bilstm_tagger import trans_to_tensor, get_tags
 from meerkat.longtail.bilstm_tagger import validate_config as bilstm_validate_config
 
-def load_scikit_model(model_name):
+def load_scikit_model(model_name, batch=False):
 	"""Load either Card or Bank classifier depending on
-	requested model"""
+	requested model. With batch=True the returned helper takes a list of
+	descriptions and classifies them with a single predict call"""
 
 	# Switch on Models
 	if model_name == "card_sws":
@@ -46,7 +48,16 @@ def load_scikit_model(model_name):
 		"""classify the variable description with Card or Bank model"""
 		result = list(model.predict([description]))[0]
 		return result
-			
+
+	def batch_classifier(descriptions):
+		"""classify a list of descriptions with Card or Bank model, returns
+		an array of labels in the same order"""
+		if len(descriptions) == 0:
+			return np.array([])
+		return model.predict(descriptions)
+
+	if batch:
+		return batch_classifier
 	return classifier
 
 def get_tf_cnn_by_name(model_name, gpu_mem_fraction=False):
@@ -134,8 +145,10 @@ def get_tf_rnn_by_path(model_path, w2i_path, gpu_mem_fraction=False, model_name=
 
 	return apply_rnn
 
-def get_tf_cnn_by_path(model_path, label_map_path, gpu_mem_fraction=False, model_name=False):
-	"""Load a tensorFlow module by name"""
+def get_tf_cnn_by_path(model_path, label_map_path, gpu_mem_fraction=False, model_name=False,
+	intra_op_threads=0, inter_op_threads=0):
+	"""Load a tensorFlow module by name, thread counts of 0 let TensorFlow
+	use every core"""
 
 	# Load Config
 	config_path = "meerkat/classification/config/default_tf_config.json"
@@ -153,18 +166,23 @@ def get_tf_cnn_by_path(model_path, label_map_path, gpu_mem_fraction=False, model
 	config = validate_config(config)
 	label_map = config["label_map"]
 
-	# Load Session and Graph
-	ops.reset_default_graph()
-	saver = tf.train.import_meta_graph(meta_path)
+	# Load Session and Graph, each model has its own graph so models can be
+	# loaded while others serve requests
+	graph = tf.Graph()
+	with graph.as_default():
+		saver = tf.train.import_meta_graph(meta_path)
 
+	threads = {"intra_op_parallelism_threads": intra_op_threads,
+		"inter_op_parallelism_threads": inter_op_threads}
 	if gpu_mem_fraction:
 		gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.25)
-		sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True, gpu_options=gpu_options))
+		sess = tf.Session(graph=graph, config=tf.ConfigProto(allow_soft_placement=True,
+			gpu_options=gpu_options, **threads))
 	else:
-		sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
+		sess = tf.Session(graph=graph, config=tf.ConfigProto(allow_soft_placement=True,
+			**threads))
 
 	saver.restore(sess, config["model_path"])
-	graph = sess.graph
 
 	if not model_name:
 		model = get_tensor(graph, "model:0")
@@ -173,17 +191,16 @@ def get_tf_cnn_by_path(model_path, label_map_path, gpu_mem_fraction=False, model
 
 	# Generate Helper Function
 	def apply_cnn(trans, doc_key="description", label_key="CNN", label_only=True, soft_target=False):
-		"""Apply CNN to transactions"""
-
-		doc_length = config["doc_length"]
-		batch_size = len(trans)
+		"""Apply CNN to transactions, trans may be a list of transactions or an
+		EncodedBatch whose tensor is shared with other models"""
 
-		tensor = np.zeros(shape=(batch_size, 1, config["alphabet_length"], doc_length))
-
-		for index, doc in enumerate(trans):
-			tensor[index][0] = string_to_tensor(config, doc[doc_key], doc_length)
+		if isinstance(trans, EncodedBatch):
+			tensor = trans.get_tensor(config)
+			trans = trans.trans
+		else:
+			doc_length = config["doc_length"]
+			tensor = strings_to_tensor(config, [doc[doc_key] for doc in trans], doc_length)
 
-		tensor = np.transpose(tensor, (0, 1, 3, 2))
 		feed_dict_test = {get_tensor(graph, "x:0"): tensor}
 		output = sess.run(model, feed_dict=feed_dict_test)
 		if not soft_target:
@@ -212,6 +229,8 @@ def get_tf_cnn_by_path(model_path, label_map_path, gpu_mem_fraction=False, model
 
 		return trans
 
+	# Close the session once the model is replaced
+	apply_cnn.close = sess.close
 	return apply_cnn
 
 if __name__ == "__main__":
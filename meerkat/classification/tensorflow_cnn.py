@@ -38,7 +38,7 @@ import tensorflow as tf
 
 from .tools import (fill_description_unmasked, reverse_map, batch_normalization, chunks,
 	accuracy, get_tensor, get_op, get_variable, threshold, bias_variable, weight_variable, conv2d,
-	max_pool, get_cost_list, string_to_tensor)
+	max_pool, get_cost_list, strings_to_tensor)
 from meerkat.various_tools import load_params, load_piped_dataframe, validate_configuration
 
 logging.basicConfig(level=logging.INFO)
@@ -146,19 +146,13 @@ def batch_to_tensor(config, batch, soft_target=False):
 	"""Convert a batch to a tensor representation"""
 
 	doc_length = config["doc_length"]
-	alphabet_length = config["alphabet_length"]
 	num_labels = config["num_labels"]
-	batch_size = len(batch.index)
 
 	labels = np.array(batch["LABEL_NUM"].astype(int)) - 1
 	labels = (np.arange(num_labels) == labels[:, None]).astype(np.float32)
 	docs = batch["DESCRIPTION_UNMASKED"].tolist()
-	transactions = np.zeros(shape=(batch_size, 1, alphabet_length, doc_length))
-	
-	for index, trans in enumerate(docs):
-		transactions[index][0] = string_to_tensor(config, trans, doc_length)
+	transactions = strings_to_tensor(config, docs, doc_length)
 
-	transactions = np.transpose(transactions, (0, 1, 3, 2))
 	if soft_target:
 		soft_labels = load_soft_target(batch, num_labels)
 		return transactions, labels, soft_labels
@@ -34,15 +34,37 @@ from datetime import datetime
 from elasticsearch import Elasticsearch, helpers
 
 from meerkat.custom_exceptions import Misconfiguration
-from meerkat.various_tools import validate_configuration
+from meerkat.various_tools import validate_configuration, load_params
+from meerkat.web_service.search_cache import invalidate_index, SEARCH_CACHE_DIR
+
+WEB_SERVICE_CONFIG = "meerkat/web_service/config/web_service.json"
 
 def parse_arguments(args):
 	"""Parse command line arguments"""
 	parser = argparse.ArgumentParser()
 	parser.add_argument("configuration_file",
 		help="Location on the local drive where the configuration file can be found")
+	parser.add_argument("--search_cache_dir", "--search-cache-dir", default=None,
+		help="Search cache directory of the web service to invalidate, by default the "
+		"cache_dir of --web_service_config")
+	parser.add_argument("--web_service_config", "--web-service-config",
+		default=WEB_SERVICE_CONFIG, help="Configuration of the web service")
 	return parser.parse_args(args)
 
+def get_search_cache_dir(args):
+	"""Return the search cache directory of the web service, given on the
+	command line or read from its configuration"""
+	if args.search_cache_dir:
+		return args.search_cache_dir
+	try:
+		params = load_params(args.web_service_config)
+	except (OSError, ValueError):
+		logging.warning("Unable to read {0}, using the default search cache "
+			"directory".format(args.web_service_config))
+		return SEARCH_CACHE_DIR
+	search_cache = params.get("elasticsearch", {}).get("search_cache", {})
+	return search_cache.get("cache_dir", SEARCH_CACHE_DIR)
+
 def load_document_queue(params):
 	"""Opens a file of merchants, one per line, and loads a document queue."""
 	filename, encoding = None, None
@@ -421,6 +443,10 @@ def run_from_command_line():
 	my_params["document_queue"].join()
 	logging.info("Documents joined")
 
+	# Cached web service searches of the reloaded index are stale, in the
+	# processes sharing the search cache directory
+	invalidate_index(my_params["elasticsearch"]["index"], get_search_cache_dir(args))
+
 	logging.critical("End of program.")
 
 if __name__ == "__main__":
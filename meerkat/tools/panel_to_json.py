@@ -9,24 +9,21 @@ with the web service."""
 #####################################################
 
 import sys
-import re
 import json
 import numpy as np
 
-from meerkat.various_tools import load_piped_dataframe
+from meerkat.various_tools import load_piped_dataframe, Normalizer
 
 def dict_2_json(obj, filename):
 	"""Saves a dict as a json file"""
 	with open(filename, 'w') as output_file:
 		json.dump(obj, output_file, indent=4)
 
+NORMALIZER = Normalizer(bad_characters=[r"'", r"\*<"], synonyms_file=None, lower=False)
+
 def string_cleanse(original_string):
 	"""Strips out characters that might confuse ElasticSearch."""
-	bad_characters = [r"'", r"\*<"]
-	bad_character_regex = "|".join(bad_characters)
-	cleanse_pattern = re.compile(bad_character_regex)
-	with_spaces = re.sub(cleanse_pattern, " ", original_string)
-	return ' '.join(with_spaces.split())
+	return NORMALIZER.cleanse(original_string)
 
 def sample_panel_to_json():
 	"""This function brings it all together."""
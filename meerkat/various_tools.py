@@ -19,6 +19,7 @@ import boto
 import numpy as np
 import pandas as pd
 
+from functools import lru_cache
 from boto.s3.key import Key
 from boto.s3.connection import Location
 from jsonschema import validate
@@ -256,14 +257,87 @@ def safely_remove_file(filename):
 		logging.critical("Unable to remove {0}".format(filename))
 	logging.info("{0} removed".format(filename))
 
+BAD_CHARACTERS = [r"\[", r"\]", r"\{", r"\}", r'"', r"/", r"\\", r"\:", r"\(",\
+	r"\)", r"-", r"\+", r"<", r">", r"'", r"!", r"\*", r"\|\|", r"&&", r"~"]
+
+STOPWORD_PATTERNS = [
+	r"^ach",
+	r"\d{2}\/\d{2}",
+	r"X{4}\d{4}"
+	r"X{5}\d{4}",
+	r"~{2}\d{5}~{2}\d{16}~{2}\d{5}~{2}\d~{4}\d{4}",
+	r"checkcard \d{4}",
+	r"\d{15}"
+]
+
+STOP_WORDS = [" pos ", r"^pos ", " ach ", "electronic", "debit",
+	"purchase", " card ", " pin ", "recurring", " check ", "checkcard",
+	"qps", "q35", "q03", " sq "]
+
+SYNONYMS_FILE = "meerkat/config/synonyms.json"
+
+class Normalizer():
+	"""Precompiled description normalization pipeline. Every pattern, including
+	a single alternation over the whole synonym table, is compiled once when
+	the Normalizer is created rather than on every call."""
+
+	def __init__(self, bad_characters=None, synonyms_file=SYNONYMS_FILE, lower=True):
+		"""Initializes the Normalizer, synonyms_file=None disables synonyms"""
+		if bad_characters is None:
+			bad_characters = BAD_CHARACTERS
+		self.lower = lower
+		self.cleanse_pattern = re.compile("|".join(bad_characters))
+		self.stopwords_pattern = re.compile("|".join(STOPWORD_PATTERNS + STOP_WORDS))
+		self.valid_short_pattern = re.compile('^[a-zA-Z0-9_]+$')
+		self.synonyms_map, self.synonyms_pattern = {}, None
+		if synonyms_file is not None:
+			# Alternatives keep the order of the file, the first match wins
+			self.synonyms_map = load_params(synonyms_file)
+			self.synonyms_pattern = re.compile("|".join(map(re.escape, self.synonyms_map)))
+
+	def cleanse(self, original_string):
+		"""Strips out characters that might confuse ElasticSearch."""
+		with_spaces = self.cleanse_pattern.sub(" ", original_string)
+		cleansed = ' '.join(with_spaces.split())
+		return cleansed.lower() if self.lower else cleansed
+
+	def stopwords(self, transaction):
+		"""Remove stopwords"""
+		with_spaces = self.stopwords_pattern.sub(" ", transaction.lower())
+		return ' '.join(with_spaces.split()).upper()
+
+	def synonyms(self, transaction):
+		"""Replaces transactions tokens with manually
+		mapped factual representations"""
+		transaction = transaction.lower()
+		if self.synonyms_pattern is not None:
+			transaction = self.synonyms_pattern.sub(
+				lambda match: self.synonyms_map[match.group(0)], transaction)
+		return transaction.upper()
+
+	def query_string(self, description, use_stopwords=False):
+		"""Run the full pipeline used to build search queries, returns None
+		for descriptions too short to search"""
+		transaction = self.cleanse(description).rstrip()
+
+		# Input transaction must not be empty
+		if len(transaction) <= 2 and self.valid_short_pattern.match(transaction):
+			return None
+
+		# Replace synonyms
+		if use_stopwords:
+			transaction = self.stopwords(transaction)
+		transaction = self.synonyms(transaction)
+		return self.cleanse(transaction)
+
+@lru_cache(maxsize=None)
+def get_normalizer():
+	"""Return the shared Normalizer, built on first use"""
+	return Normalizer()
+
 def string_cleanse(original_string):
 	"""Strips out characters that might confuse ElasticSearch."""
-	bad_characters = [r"\[", r"\]", r"\{", r"\}", r'"', r"/", r"\\", r"\:", r"\(",\
-	 r"\)", r"-", r"\+", r"<", r">", r"'", r"!", r"\*", r"\|\|", r"&&", r"~"]
-	bad_character_regex = "|".join(bad_characters)
-	cleanse_pattern = re.compile(bad_character_regex)
-	with_spaces = re.sub(cleanse_pattern, " ", original_string)
-	return ' '.join(with_spaces.split()).lower()
+	return get_normalizer().cleanse(original_string)
 
 def build_boost_vectors(hyperparams):
 	"""Turns field boosts into dictionary of numpy arrays"""
@@ -298,17 +372,13 @@ def get_magic_query(params, transaction, boost=1.0):
 	result_size = hyperparameters.get("es_result_size", "10")
 	fields = params["output"]["results"]["fields"]
 	good_description = transaction["GOOD_DESCRIPTION"]
-	transaction = string_cleanse(transaction["DESCRIPTION_UNMASKED"]).rstrip()
+	normalizer = get_normalizer()
+	transaction = normalizer.query_string(transaction["DESCRIPTION_UNMASKED"], use_stopwords=True)
 
 	# Input transaction must not be empty
-	if len(transaction) <= 2 and re.match('^[a-zA-Z0-9_]+$', transaction):
+	if transaction is None:
 		return
 
-	# Replace synonyms
-	transaction = stopwords(transaction)
-	transaction = synonyms(transaction)
-	transaction = string_cleanse(transaction)
-
 	# Construct Main Query
 	magic_query = get_bool_query(size=result_size)
 	magic_query["fields"] = fields
@@ -322,7 +392,7 @@ def get_magic_query(params, transaction, boost=1.0):
 	if good_description != ""\
 		and hyperparameters.get("good_description", "") != "":
 		good_description_boost = hyperparameters["good_description"]
-		name_query = get_qs_query(string_cleanse(good_description),\
+		name_query = get_qs_query(normalizer.cleanse(good_description),\
 			['name'], good_description_boost)
 		should_clauses.append(name_query)
 
@@ -364,53 +434,12 @@ def get_us_cities(testing=False):
 
 def stopwords(transaction):
 	"""Remove stopwords"""
-	patterns = [
-		r"^ach",
-		r"\d{2}\/\d{2}",
-		r"X{4}\d{4}"
-		r"X{5}\d{4}",
-		r"~{2}\d{5}~{2}\d{16}~{2}\d{5}~{2}\d~{4}\d{4}",
-		r"checkcard \d{4}",
-		r"\d{15}"
-	]
-	stop_words = [" pos ", r"^pos ", " ach ", "electronic", "debit",
-		"purchase", " card ", " pin ", "recurring", " check ", "checkcard",
-		"qps", "q35", "q03", " sq "]
-
-	patterns = patterns + stop_words
-	transaction = transaction.lower()
-	regex = "|".join(patterns)
-	cleanse_pattern = re.compile(regex)
-	with_spaces = re.sub(cleanse_pattern, " ", transaction)
-	return ' '.join(with_spaces.split()).upper()
+	return get_normalizer().stopwords(transaction)
 
 def synonyms(transaction):
 	"""Replaces transactions tokens with manually
-	mapped factual representations. This method
-	should be expanded to manage a file of synonyms"""
-	rep = {
-		"wal-mart" : " Walmart ",
-		"wal mart" : " Walmart ",
-		"samsclub" : " Sam's Club ",
-		"usps" : " US Post Office ",
-		"lowes" : " Lowe's ",
-		"wholefds" : " Whole Foods ",
-		"shell oil" : " Shell Gas ",
-		"wm supercenter" : " Walmart ",
-		"exxonmobil" : " exxonmobil exxon mobil ",
-		"mcdonalds" : " mcdonald's ",
-		"costco whse" : " costco ",
-		"franciscoca" : " francisco ca ",
-		"qt" : " Quicktrip ",
-		"macy's east" : " Macy's ",
- 	}
-
-	transaction = transaction.lower()
-	rep = dict((re.escape(k), v) for k, v in rep.items())
-	pattern = re.compile("|".join(rep.keys()))
-	text = pattern.sub(lambda m: rep[re.escape(m.group(0))], transaction)
-
-	return text.upper()
+	mapped factual representations, see meerkat/config/synonyms.json"""
+	return get_normalizer().synonyms(transaction)
 
 #Print a warning to not execute this file as a module
 if __name__ == "__main__":
@@ -2,54 +2,82 @@
 """This module starts an HTTPS web service.
 USAGE:
 # sudo python3 -m meerkat.web_service
+# sudo python3 -m meerkat.web_service 443 --workers=8
+
+With --workers N the service pre-forks N processes sharing the listening
+socket, each loading its own models. Send SIGHUP to the parent process to
+replace the workers one at a time, for instance after new models are saved.
+
+Send SIGUSR1, or POST to /admin/models, to load new models in the background
+and swap them in without restarting; the parent process forwards SIGUSR1 to
+every worker. /admin/models needs "Authorization: Bearer <token>" where the
+token is MEERKAT_ADMIN_TOKEN or admin.token in the config, and is refused
+when neither is set.
 
 EXAMPLE CURL COMMAND TO TEST WEB SERVICE:
 # curl --insecure -s -X POST -d @big.json https://localhost:443/meerkat/ \
 --header "Content-Type:application/json" | python3.3 -m json.tool
 
+EXAMPLE CURL COMMAND TO STREAM ONE TRANSACTION PER LINE:
+# curl --insecure -sN -X POST -T transactions.ndjson \
+"https://localhost:443/meerkat/bulk?container=card" \
+--header "Content-Type:application/x-ndjson" --header "Transfer-Encoding: chunked"
+
 @author: J. Andrew Key
 @author: Sivan Mehta
 
 """
 import logging
+import logging.config
 import os
+import signal
 import sys
+import time
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import yaml
 
 from tornado_json.application import Application
 from tornado.options import define, options
-from meerkat.web_service.api import Meerkat_API
+from meerkat.web_service.prefork import PreforkSupervisor
+from meerkat.classification.bloom_filter.trie import get_geo_index
 
 # Define Some Defaults
-define("port", default=(len(sys.argv) > 1 and str(sys.argv[1]) or 443),
+PORT_ARGUMENT = len(sys.argv) > 1 and sys.argv[1].isdigit()
+define("port", default=(PORT_ARGUMENT and int(sys.argv[1]) or 443),
 	help="run on the given port", type=int)
+define("workers", default=0, type=int,
+	help="pre-fork this many worker processes, 0 serves from this process")
+define("drain_seconds", default=30, type=int,
+	help="how long a stopping worker waits for requests in flight")
 
-def main():
-	"""Launches an HTTPS web service."""
+def get_routes(api, bulk_api, metrics_api, models_api):
+	"""Return the valid routes"""
+	return [
+		("/meerkat/bulk/?", bulk_api),
+		("/meerkat/v2.4/?", api),
+		("/meerkat/v2.3/?", api),
+		("/meerkat/v2.2/?", api),
+		("/meerkat/v2.1/?", api),
+		("/meerkat/v2.0/?", api),
+		("/meerkat/v1.9/?", api),
+		("/meerkat/v1.8/?", api),
+		("/meerkat/v1.7/?", api),
+		("/meerkat/v1.6/?", api),
+		("/meerkat/?", api),
+		("/status/index.html", api),
+		("/metrics", metrics_api),
+		("/admin/models/?", models_api)
+	]
 
-	# Log access to the web service
-	tornado.options.parse_command_line()
+def serve(sockets, ready=None):
+	"""Serve requests on sockets until SIGTERM, then stop accepting and let
+	the requests in flight finish"""
 
-	# Start the logs, configured by the following file
-	logging.config.dictConfig(yaml.load( \
-		open('meerkat/web_service/logging.yaml', 'r')))
+	# Models are loaded on import, after the fork in pre-fork mode
+	from meerkat.web_service.api import Meerkat_API, Bulk_API, Metrics_API, Models_API
 
-	# Define valid routes
-	routes = [
-		("/meerkat/v2.4/?", Meerkat_API),
-		("/meerkat/v2.3/?", Meerkat_API),
-		("/meerkat/v2.2/?", Meerkat_API),
-		("/meerkat/v2.1/?", Meerkat_API),
-		("/meerkat/v2.0/?", Meerkat_API),
-		("/meerkat/v1.9/?", Meerkat_API),
-		("/meerkat/v1.8/?", Meerkat_API),
-		("/meerkat/v1.7/?", Meerkat_API),
-		("/meerkat/v1.6/?", Meerkat_API),
-		("/meerkat/?", Meerkat_API),
-		("/status/index.html", Meerkat_API)
-	]
 	data_dir = "./"
 	# Provide SSL key and certificate
 	ssl_options = {
@@ -57,14 +85,59 @@ def main():
 		"keyfile" : os.path.join(data_dir, "server.key"),
 	}
 	# Create the tornado_json.application
-	application = Application(routes=routes, settings={})
+	application = Application(routes=get_routes(Meerkat_API, Bulk_API, Metrics_API,
+		Models_API), settings={})
 	# Create the http server
 	http_server = tornado.httpserver.HTTPServer(application,\
 		ssl_options=ssl_options)
+	http_server.add_sockets(sockets)
+	io_loop = tornado.ioloop.IOLoop.current()
+
+	def drain(deadline):
+		"""Stop the IOLoop once no request is in flight"""
+		if Meerkat_API.in_flight + Bulk_API.in_flight == 0 or time.time() > deadline:
+			io_loop.stop()
+		else:
+			io_loop.call_later(0.1, drain, deadline)
+
+	def shutdown():
+		"""Stop accepting requests"""
+		http_server.stop()
+		drain(time.time() + options.drain_seconds)
+
+	signal.signal(signal.SIGTERM,
+		lambda signum, frame: io_loop.add_callback_from_signal(shutdown))
+	signal.signal(signal.SIGUSR1,
+		lambda signum, frame: io_loop.add_callback_from_signal(Meerkat_API.meerkat.reload_models))
+	if ready is not None:
+		ready()
+	io_loop.start()
+
+def main():
+	"""Launches an HTTPS web service."""
+
+	# Log access to the web service, a leading port argument is positional
+	tornado.options.parse_command_line(sys.argv if not PORT_ARGUMENT else
+		sys.argv[:1] + sys.argv[2:])
+
+	# Start the logs, configured by the following file
+	logging.config.dictConfig(yaml.load( \
+		open('meerkat/web_service/logging.yaml', 'r')))
+
+	# Build the geo index once, before any request or worker needs it
+	get_geo_index()
+
+	# Bind before forking so every worker shares the listening socket
+	sockets = tornado.netutil.bind_sockets(options.port)
+	if options.workers < 1:
+		serve(sockets)
+		return
 
-	# Start the http_server listening on default port
-	http_server.listen(options.port)
-	tornado.ioloop.IOLoop.instance().start()
+	# Each worker divides the TensorFlow threads by the number of workers
+	os.environ["MEERKAT_WORKERS"] = str(options.workers)
+	supervisor = PreforkSupervisor(options.workers,
+		lambda worker_id, ready: serve(sockets, ready))
+	supervisor.run()
 
 #MAIN PROGRAM
 if __name__ == '__main__':
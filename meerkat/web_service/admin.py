@@ -0,0 +1,48 @@
+"""This module serves the administrative endpoints of the web service. They
+share the public port, so every request must carry the admin token.
+
+@author: J. Andrew Key
+"""
+
+import hmac
+
+import tornado.web
+
+def is_authorized(authorization, token):
+	"""Return whether an Authorization header carries the bearer token, never
+	when no token is configured"""
+	if not token or not authorization:
+		return False
+	scheme, _, credentials = authorization.partition(" ")
+	return scheme.lower() == "bearer" and \
+		hmac.compare_digest(credentials.strip().encode("utf-8"), token.encode("utf-8"))
+
+class AdminHandler(tornado.web.RequestHandler):
+	"""Rejects requests without "Authorization: Bearer <token>". Without a
+	token configured every request is rejected."""
+	token = None
+
+	def prepare(self):
+		"""Check the token before handling the request"""
+		if not self.token:
+			raise tornado.web.HTTPError(403, reason="No admin token is configured")
+		if not is_authorized(self.request.headers.get("Authorization"), self.token):
+			self.set_header("WWW-Authenticate", "Bearer")
+			raise tornado.web.HTTPError(401, reason="Invalid admin token")
+
+class ModelsHandler(AdminHandler):
+	"""Shows the models being served and swaps in new ones"""
+	consumer = None
+
+	def get(self):
+		"""Handle get requests"""
+		self.write(self.consumer.model_info())
+
+	def post(self):
+		"""Load new models in the background, they are served once ready"""
+		started = self.consumer.reload_models()
+		self.set_status(202)
+		self.write(dict(self.consumer.model_info(), started=started))
+
+if __name__ == "__main__":
+	print("This module is a Class; it should not be run from the console.")
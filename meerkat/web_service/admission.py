@@ -0,0 +1,124 @@
+"""This module sheds load before it queues. Requests are admitted while the
+transactions in flight stay under a limit, and the limit adapts to how long
+admitted work waits for a thread.
+
+@author: J. Andrew Key
+"""
+
+import threading
+import time
+
+import tornado.web
+
+class Overloaded(Exception):
+	"""Raised when a request is not admitted, retry after retry_after seconds"""
+
+	def __init__(self, retry_after):
+		Exception.__init__(self, "Overloaded, retry after {0} seconds".format(retry_after))
+		self.retry_after = retry_after
+
+class AdmissionController():
+	"""Limits the transactions in flight on an executor with additive
+	increase, multiplicative decrease. Work which waited longer than
+	target_delay for a thread shrinks the limit by decrease_factor, at most
+	once per target_delay; otherwise each finished transaction grows the limit
+	by increase / limit. A request is always admitted when nothing is in
+	flight, so requests larger than the limit still run."""
+
+	def __init__(self, initial_limit=2000, min_limit=100, max_limit=20000, target_delay=0.05,
+		increase=10.0, decrease_factor=0.9, retry_after=1):
+		"""Initializes the AdmissionController"""
+		self.limit = float(initial_limit)
+		self.min_limit = min_limit
+		self.max_limit = max_limit
+		self.target_delay = target_delay
+		self.increase = increase
+		self.decrease_factor = decrease_factor
+		self.retry_after = retry_after
+		self.in_flight = 0
+		self.admitted, self.rejected = 0, 0
+		self.__last_decrease = 0.0
+		self.__lock = threading.Lock()
+
+	def try_acquire(self, transactions):
+		"""Admit transactions if they fit under the limit"""
+		with self.__lock:
+			if self.in_flight > 0 and self.in_flight + transactions > self.limit:
+				self.rejected += 1
+				return False
+			self.in_flight += transactions
+			self.admitted += 1
+			return True
+
+	def release(self, transactions, delay):
+		"""Stop counting transactions which waited delay seconds for a thread,
+		and adapt the limit"""
+		with self.__lock:
+			self.in_flight -= transactions
+			now = time.time()
+			if delay > self.target_delay:
+				if now - self.__last_decrease >= self.target_delay:
+					self.__last_decrease = now
+					self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+			else:
+				self.limit = min(self.max_limit,
+					self.limit + self.increase * transactions / self.limit)
+
+	def submit(self, executor, transactions, func, *args):
+		"""Submit func(*args) for transactions to executor, returns its Future.
+		Raises Overloaded instead of queueing past the limit."""
+		if not self.try_acquire(transactions):
+			raise Overloaded(self.retry_after)
+		submitted = time.time()
+		started = []
+
+		def timed():
+			"""Record how long the work waited for a thread"""
+			started.append(time.time())
+			return func(*args)
+
+		try:
+			future = executor.submit(timed)
+		except Exception:
+			self.release(transactions, 0.0)
+			raise
+		future.add_done_callback(lambda _: self.release(transactions,
+			(started[0] if started else time.time()) - submitted))
+		return future
+
+	def stats(self):
+		"""Return the limit, transactions in flight and requests admitted and
+		rejected"""
+		with self.__lock:
+			return {"limit": self.limit, "in_flight": self.in_flight,
+				"admitted": self.admitted, "rejected": self.rejected}
+
+class AdmissionMixin():
+	"""Admits the work of a tornado_json APIHandler through its admission
+	controller, and answers rejected requests with a 503 and Retry-After"""
+	admission = None
+
+	def admit(self, executor, transactions, func, *args):
+		"""Submit func(*args) to executor, through the admission controller if
+		there is one. Raises a 503 HTTPError instead of queueing past its limit."""
+		if self.admission is None:
+			return executor.submit(func, *args)
+		try:
+			return self.admission.submit(executor, transactions, func, *args)
+		except Overloaded as overloaded:
+			raise tornado.web.HTTPError(503, reason=str(overloaded))
+
+	def write_error(self, status_code, **kwargs):
+		"""Tell rejected clients when to retry. APIHandler.write_error clears
+		and finishes the response, so the 503 is written here instead."""
+		if status_code != 503 or self.admission is None:
+			super().write_error(status_code, **kwargs)
+			return
+		reason = self._reason
+		self.clear()
+		self.set_status(503, reason=reason)
+		self.set_header("Retry-After", str(self.admission.retry_after))
+		self.error(message=reason, code=503)
+
+if __name__ == "__main__":
+	print("This module is a Class; it should not be run from the console.")
@@ -1,25 +1,47 @@
 """This module defines the Meerkat web service API."""
 import concurrent.futures
 import json
+import os
 
+import tornado.web
 from tornado import gen
 from tornado_json.requesthandlers import APIHandler
 
 from meerkat.web_service.web_consumer import WebConsumer
 from meerkat.web_service import schema
+from meerkat.web_service.bulk import BulkHandler, get_transaction_schema
+from meerkat.web_service.metrics import format_metric, get_queue_depth
+from meerkat.web_service.admission import AdmissionController, AdmissionMixin
+from meerkat.web_service.admin import ModelsHandler
 from meerkat.various_tools import (load_params, get_us_cities,\
 	load_hyperparameters)
 
-class Meerkat_API(APIHandler):
+class Meerkat_API(AdmissionMixin, APIHandler):
 	"""This class is the Meerkat API."""
 	cities = get_us_cities()
 	base_dir = "meerkat/web_service/"
 	params = load_params(base_dir + "config/web_service.json")
+	# Set by meerkat.web_service when pre-forking worker processes
+	params["workers"] = int(os.environ.get("MEERKAT_WORKERS", "1"))
 	hyperparams = load_hyperparameters(params)
 	meerkat = WebConsumer(params, hyperparams, cities)
 	#This thread pool can deal with 'blocking functions' like meerkat.classify
 	# 14 is best thread number Andy has tried.
 	thread_pool = concurrent.futures.ThreadPoolExecutor(14)
+	# Requests being classified, a stopping worker waits for them
+	in_flight = 0
+	# Reject requests with a 503 rather than queue them past an adaptive limit
+	admission = None
+	if params.get("admission", {}).get("enabled", False):
+		admission_params = params["admission"]
+		admission = AdmissionController(
+			initial_limit=admission_params.get("initial_limit", 2000),
+			min_limit=admission_params.get("min_limit", 100),
+			max_limit=admission_params.get("max_limit", 20000),
+			target_delay=admission_params.get("target_queue_delay_ms", 50) / 1000.0,
+			increase=admission_params.get("increase", 10),
+			decrease_factor=admission_params.get("decrease_factor", 0.9),
+			retry_after=admission_params.get("retry_after_seconds", 1))
 
 	# pylint: disable=bad-continuation
 	with open(base_dir + "schema_input.json") as data_file:
@@ -46,13 +68,15 @@ class Meerkat_API(APIHandler):
 		output_schema=schema_output,
 		output_example=example_output,
 		debug_output_schema=schema_debug_output,
-		debug_output_example=example_debug_output
+		debug_output_example=example_debug_output,
+		output_sample_rate=params.get("output_validation", {}).get("sample_rate", 1.0)
 	)
 
 	@gen.coroutine
 	def post(self):
 		"""Handle post requests asynchonously"""
-		data = json.loads(self.request.body.decode())
+		# Decoded and validated once by schema.validate
+		data = self.body
 		# Identify Metadata with Meerkat
 		# Futures, threadpools, generator coroutines, and functions as arguments
 		# allow us to submit the normally 'blocking function' meerkat.classify
@@ -60,7 +84,14 @@ class Meerkat_API(APIHandler):
 		# the function to its completion.  However, the 'Future' class encapsulates
 		# the execution, which we can return even before the Executor reaches a 'done'
 		# state.
-		results = yield self.thread_pool.submit(self.meerkat.classify, data)
+		# Rejected with a 503 when the admission controller is full
+		future = self.admit(self.thread_pool, len(data["transaction_list"]),
+			self.meerkat.classify, data)
+		Meerkat_API.in_flight += 1
+		try:
+			results = yield future
+		finally:
+			Meerkat_API.in_flight -= 1
 		#results = self.meerkat.classify(data)
 		return results
 
@@ -69,6 +100,74 @@ class Meerkat_API(APIHandler):
 		"""Handle get requests"""
 		return None
 
+class Bulk_API(BulkHandler):
+	"""This class is the Meerkat bulk API, it streams newline delimited
+	transactions through the same classifier, threads and admission controller
+	as Meerkat_API"""
+	consumer = Meerkat_API.meerkat
+	executor = Meerkat_API.thread_pool
+	admission = Meerkat_API.admission
+	transaction_validator = schema.get_validator(
+		get_transaction_schema(Meerkat_API.schema_input))
+	batch_size = Meerkat_API.params.get("bulk", {}).get("batch_size", 500)
+	max_pending = Meerkat_API.params.get("bulk", {}).get("max_pending_batches", 4)
+	max_line_bytes = Meerkat_API.params.get("bulk", {}).get("max_line_bytes", 65536)
+	max_body_size = Meerkat_API.params.get("bulk", {}).get("max_body_bytes", None)
+
+class Metrics_API(tornado.web.RequestHandler):
+	"""This class serves the metrics of this process in the Prometheus text
+	format"""
+
+	def get(self):
+		"""Handle get requests"""
+		meerkat = Meerkat_API.meerkat
+		output = [meerkat.metrics.format()]
+		output.append(format_metric("meerkat_thread_pool_queue_depth",
+			"Tasks waiting for a thread", [([("pool", "api")],
+			get_queue_depth(Meerkat_API.thread_pool)),
+			([("pool", "stage")], meerkat.stage_queue_depth())]))
+		output.append(format_metric("meerkat_in_flight_requests", "Requests being classified",
+			[([("api", "meerkat")], Meerkat_API.in_flight),
+			([("api", "bulk")], Bulk_API.in_flight)]))
+		model_info = meerkat.model_info()
+		output.append(format_metric("meerkat_model_info", "Models being served",
+			[([("model", key), ("path", path), ("generation", model_info["generation"])], 1)
+			for key, path in sorted(model_info["models"].items())]))
+		if Meerkat_API.admission is not None:
+			stats = Meerkat_API.admission.stats()
+			output.append(format_metric("meerkat_admission_limit",
+				"Transactions admitted at once", [([], stats["limit"])]))
+			output.append(format_metric("meerkat_admission_in_flight",
+				"Transactions admitted and not finished", [([], stats["in_flight"])]))
+			for outcome in ["admitted", "rejected"]:
+				output.append(format_metric("meerkat_admission_{0}_total".format(outcome),
+					"Requests {0}".format(outcome), [([], stats[outcome])], "counter"))
+		if meerkat.memo_cache is not None:
+			stats = meerkat.memo_cache.stats()
+			output.append(format_metric("meerkat_memo_cache_size", "Entries in the memo cache",
+				[([], stats["size"])]))
+			for outcome in ["hits", "misses"]:
+				output.append(format_metric("meerkat_memo_cache_{0}_total".format(outcome),
+					"Memo cache {0} of each stage".format(outcome),
+					[([("stage", stage)], counts[outcome])
+					for stage, counts in sorted(stats["stages"].items())], "counter"))
+		if meerkat.search_cache is not None:
+			stats = meerkat.search_cache.stats()
+			output.append(format_metric("meerkat_search_cache_size",
+				"Entries in the search cache", [([], stats["size"])]))
+			for outcome in ["hits", "misses"]:
+				output.append(format_metric("meerkat_search_cache_{0}_total".format(outcome),
+					"Search cache {0}".format(outcome), [([], stats[outcome])], "counter"))
+		self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+		self.write("".join(output))
+
+class Models_API(ModelsHandler):
+	"""This class shows the models being served and swaps in new ones, for
+	requests carrying the admin token"""
+	consumer = Meerkat_API.meerkat
+	token = os.environ.get("MEERKAT_ADMIN_TOKEN") or \
+		Meerkat_API.params.get("admin", {}).get("token", None)
+
 #Print a warning to not execute this file as a module
 if __name__ == "__main__":
 	print("This module is a Class; it should not be run from the console.")
@@ -0,0 +1,119 @@
+"""This module sends Elasticsearch msearch requests from a tornado IOLoop,
+so a slow node costs a request its deadline instead of holding a worker
+thread for the full client timeout. Connections to each node are kept
+alive with libcurl when pycurl is installed.
+
+@author: J. Andrew Key
+"""
+
+import concurrent.futures
+import itertools
+import json
+import logging
+import threading
+
+from urllib.parse import urlsplit
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+
+try:
+	from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+	CurlAsyncHTTPClient = None
+
+def get_node_url(node, port=9200):
+	"""Return the base URL of a cluster node given as a host, host:port or URL"""
+	if "://" not in node:
+		node = "http://" + node
+	if urlsplit(node).port is None:
+		node = "{0}:{1}".format(node.rstrip("/"), port)
+	return node.rstrip("/")
+
+class AsyncSearch():
+	"""Runs msearch requests on a dedicated IOLoop thread. Each cluster node
+	has its own HTTP client running at most max_clients requests at once,
+	and requests are spread over the nodes round robin. With pycurl the
+	clients are CurlAsyncHTTPClients, which keep up to max_clients
+	connections per node alive and reuse them. Without it they fall back to
+	simple_httpclient, which opens a new connection for every request."""
+
+	def __init__(self, cluster_nodes, index, max_clients=10, deadline=2.0, port=9200):
+		"""Initializes the AsyncSearch and starts its IOLoop thread"""
+		self.urls = [get_node_url(node, port) + "/" + index + "/_msearch"
+			for node in cluster_nodes]
+		self.deadline = deadline
+		self.reuses_connections = CurlAsyncHTTPClient is not None
+		self.loop = None
+		self.__clients = []
+		self.__next_node = itertools.count()
+		started = threading.Event()
+		self.__thread = threading.Thread(target=self.__run, args=(max_clients, started),
+			name="async_search")
+		self.__thread.daemon = True
+		self.__thread.start()
+		started.wait()
+
+	def __run(self, max_clients, started):
+		"""IOLoop thread, the clients must be created on the loop they use"""
+		def create_clients():
+			"""Create one client per node once the loop is running"""
+			client_class = CurlAsyncHTTPClient or AsyncHTTPClient
+			self.__clients = [client_class(force_instance=True, max_clients=max_clients)
+				for _ in self.urls]
+			started.set()
+		self.loop = IOLoop()
+		self.loop.add_callback(create_clients)
+		self.loop.start()
+
+	def msearch(self, body):
+		"""Send an msearch body to the next node. Returns a concurrent Future
+		of the parsed response, which fails if the request does."""
+		# Elasticsearch rejects an msearch body without a final newline
+		if not body.endswith("\n"):
+			body += "\n"
+		future = concurrent.futures.Future()
+		node = next(self.__next_node) % len(self.urls)
+
+		def resolve(fetch_future):
+			"""Parse the response on the IOLoop"""
+			try:
+				response = fetch_future.result()
+				response.rethrow()
+				future.set_result(json.loads(response.body.decode()))
+			except Exception as exception:
+				future.set_exception(exception)
+
+		def start():
+			"""Start the request on the IOLoop"""
+			request = HTTPRequest(self.urls[node], method="POST", body=body,
+				headers={"Content-Type": "application/x-ndjson"},
+				request_timeout=self.deadline)
+			self.loop.add_future(self.__clients[node].fetch(request, raise_error=False), resolve)
+
+		self.loop.add_callback(start)
+		return future
+
+	def search(self, body):
+		"""Send an msearch body and wait at most deadline seconds for the
+		parsed response, returns None if it fails or is late"""
+		try:
+			return self.msearch(body).result(timeout=self.deadline)
+		except concurrent.futures.TimeoutError:
+			logging.warning("Elasticsearch msearch passed its {0}s deadline".format(self.deadline))
+		except Exception as exception:
+			logging.warning("Elasticsearch msearch failed: {0}".format(exception))
+		return None
+
+	def close(self):
+		"""Close the HTTP clients and stop the IOLoop thread"""
+		def stop():
+			"""Stop on the IOLoop"""
+			for client in self.__clients:
+				client.close()
+			self.loop.stop()
+		self.loop.add_callback(stop)
+		self.__thread.join()
+
+if __name__ == "__main__":
+	print("This module is a Class; it should not be run from the console.")
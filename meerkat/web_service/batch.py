@@ -0,0 +1,320 @@
+#/usr/local/bin/python3.3
+# pylint: disable=pointless-string-statement
+"""This module runs the full WebConsumer pipeline over a piped file without
+the web service. Chunks are read, classified and written concurrently, and
+a checkpoint after every written chunk lets an interrupted run resume.
+
+@author: J. Andrew Key
+"""
+
+#################### USAGE ##########################
+"""
+python3 -m meerkat.web_service.batch \
+<path_to_piped_input> \
+<path_to_output> \
+--format <optional_piped_or_parquet> \
+--container <optional_bank_or_card> \
+--chunksize <optional_rows_per_chunk> \
+--workers <optional_chunks_classified_at_once>
+# Start over instead of resuming from the checkpoint
+--restart
+
+# Piped output is one file, Parquet output is a directory of one file per chunk.
+# The checkpoint is <path_to_output>.checkpoint unless --checkpoint is given.
+"""
+#####################################################
+
+import argparse
+import concurrent.futures
+import csv
+import io
+import itertools
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+
+import pandas as pd
+
+from meerkat.web_service import json_codec
+from meerkat.various_tools import load_params, get_us_cities, load_hyperparameters
+
+SCHEMA_OUTPUT = "meerkat/web_service/schema_output.json"
+EMPTY_CHECKPOINT = {"chunks": 0, "rows": 0, "offset": 0, "bytes": 0, "columns": None}
+
+def parse_arguments(args):
+	""" Create the parser """
+	parser = argparse.ArgumentParser(description="Classify a piped file with the full\
+		web service pipeline")
+	# Required arguments
+	parser.add_argument("input", help="Path to the piped input file")
+	parser.add_argument("output", help="Path to the output file, or directory for Parquet")
+	# Optional arguments
+	parser.add_argument("--format", choices=["piped", "parquet"], default=None,
+		help="Output format, Parquet if output ends with .parquet and piped otherwise")
+	parser.add_argument("--container", choices=["bank", "card"], default="card",
+		help="Container of every transaction")
+	parser.add_argument("--cobrand_region", type=int, default=None, help="Cobrand's region")
+	parser.add_argument("--services_list", default="",
+		help="Comma separated services to enable, all of them by default")
+	parser.add_argument("--ledger_entry", choices=["debit", "credit"], default="credit",
+		help="Ledger entry of rows without a LEDGER_ENTRY column")
+	parser.add_argument("--chunksize", type=int, default=1000, help="Rows per chunk")
+	parser.add_argument("--workers", type=int, default=4,
+		help="Chunks classified at once, concurrent chunks share CNN batches")
+	parser.add_argument("--queue_size", type=int, default=8,
+		help="Chunks read ahead of the writer")
+	parser.add_argument("--config", default="meerkat/web_service/config/web_service.json",
+		help="Web service configuration")
+	parser.add_argument("--checkpoint", default=None, help="Path to the checkpoint file")
+	parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint")
+	parser.add_argument("-d", "--debug", help="Show 'debug'+ level logs", action="store_true")
+	parser.add_argument("-v", "--info", help="Show 'info'+ level logs", action="store_true")
+	return parser.parse_args(args)
+
+def get_transaction_list(records, first_id, ledger_entry="credit"):
+	"""Map piped rows into the transaction_list format, like
+	format_web_consumer. Input columns are kept, so they reach the output."""
+	for offset, trans in enumerate(records):
+		trans["transaction_id"] = first_id + offset
+		trans["description"] = trans["DESCRIPTION_UNMASKED"]
+		trans["amount"] = trans["AMOUNT"]
+		trans["date"] = trans["TRANSACTION_DATE"]
+		trans["ledger_entry"] = trans.get("LEDGER_ENTRY", "").lower() or ledger_entry
+	return records
+
+def load_checkpoint(filename):
+	"""Return the checkpoint in filename, or an empty one"""
+	try:
+		with open(filename) as checkpoint_file:
+			return json.load(checkpoint_file)
+	except (OSError, ValueError):
+		return dict(EMPTY_CHECKPOINT)
+
+def save_checkpoint(filename, checkpoint):
+	"""Replace the checkpoint in filename atomically"""
+	temp_filename = filename + ".tmp"
+	with open(temp_filename, "w") as checkpoint_file:
+		json.dump(checkpoint, checkpoint_file)
+	os.replace(temp_filename, filename)
+
+def read_header(filename):
+	"""Return the columns of a piped file and the byte offset of its first row"""
+	with open(filename, "rb") as input_file:
+		header = input_file.readline()
+	return header.decode("utf-8").rstrip("\r\n").split("|"), len(header)
+
+def parse_rows(lines, columns):
+	"""Return a record per piped line. Like load_piped_dataframe, fields are
+	not quoted, blank lines and lines with too many fields are dropped and
+	missing fields are empty."""
+	records = []
+	for line in lines:
+		line = line.decode("utf-8", errors="replace").rstrip("\r\n")
+		if not line:
+			continue
+		fields = line.split("|")
+		if len(fields) > len(columns):
+			logging.warning("Skipping a line with {0} fields, expected {1}".format(len(fields),
+				len(columns)))
+			continue
+		fields += [""] * (len(columns) - len(fields))
+		records.append(dict(zip(columns, fields)))
+	return records
+
+def read_chunks(filename, chunksize, first_chunk=0, first_row=0, offset=0):
+	"""Yield (chunk index, first row, records, end offset) of each chunk of
+	chunksize lines. Reading starts at byte offset, or after the header, so
+	resuming does not parse the rows already classified."""
+	columns, header_size = read_header(filename)
+	rows = first_row
+	with open(filename, "rb") as input_file:
+		input_file.seek(max(offset, header_size))
+		for index in itertools.count(first_chunk):
+			lines = list(itertools.islice(input_file, chunksize))
+			if not lines:
+				return
+			records = parse_rows(lines, columns)
+			yield index, rows, records, input_file.tell()
+			rows += len(records)
+
+def get_output_columns(input_columns, schema_filename=SCHEMA_OUTPUT):
+	"""Return the input columns followed by every field of each response
+	type of the output schema, so no field is left out of the output"""
+	with open(schema_filename) as schema_file:
+		schema = json.load(schema_file)
+	columns = dict.fromkeys(input_columns)
+	for definition in schema["definitions"].values():
+		columns.update(dict.fromkeys(definition.get("properties", {})))
+	return list(columns)
+
+def check_columns(transactions, columns):
+	"""Raise ValueError if a transaction has a field outside columns"""
+	known = set(columns)
+	for trans in transactions:
+		extra = set(trans) - known
+		if extra:
+			raise ValueError("Output fields missing from the columns: {0}".format(sorted(extra)))
+
+class PipedWriter():
+	"""Writes chunks of transactions to one piped file. Resuming truncates
+	the file to the size recorded by the checkpoint."""
+
+	def __init__(self, filename, checkpoint, columns):
+		"""Initializes the PipedWriter, a resumed file keeps the columns of
+		its checkpoint"""
+		self.columns = checkpoint["columns"] or columns
+		if checkpoint["chunks"] and os.path.exists(filename):
+			self.__file = open(filename, "r+b")
+			self.__file.truncate(checkpoint["bytes"])
+			self.__file.seek(checkpoint["bytes"])
+		else:
+			self.__file = open(filename, "wb")
+
+	def write(self, transactions):
+		"""Append transactions, returns the size of the file"""
+		check_columns(transactions, self.columns)
+		text = io.StringIO()
+		writer = csv.DictWriter(text, delimiter="|", fieldnames=self.columns)
+		if self.__file.tell() == 0:
+			writer.writeheader()
+		for trans in transactions:
+			writer.writerow({key: json_codec.dumps(value) if isinstance(value, (list, dict))
+				else value for key, value in trans.items()})
+		self.__file.write(text.getvalue().encode("utf-8", errors="replace"))
+		self.__file.flush()
+		os.fsync(self.__file.fileno())
+		return self.__file.tell()
+
+	def close(self):
+		"""Close the file"""
+		self.__file.close()
+
+class ParquetWriter():
+	"""Writes each chunk of transactions to its own Parquet file in a
+	directory, so a resumed run only writes the chunks still missing"""
+
+	def __init__(self, dirname, checkpoint, columns):
+		"""Initializes the ParquetWriter, fails early without a Parquet engine"""
+		pd.io.parquet.get_engine("auto")
+		self.dirname = dirname
+		self.columns = checkpoint["columns"] or columns
+		self.index = checkpoint["chunks"]
+		os.makedirs(dirname, exist_ok=True)
+
+	def write(self, transactions):
+		"""Write transactions to the next part file"""
+		check_columns(transactions, self.columns)
+		filename = os.path.join(self.dirname, "part-{0:06d}.parquet".format(self.index))
+		pd.DataFrame(transactions, columns=self.columns).to_parquet(filename + ".tmp")
+		os.replace(filename + ".tmp", filename)
+		self.index += 1
+		return 0
+
+	def close(self):
+		"""Nothing to close"""
+		return
+
+def run_pipeline(chunks, classify, write, workers=4, queue_size=8):
+	"""Classify each chunk on workers threads while the next chunks are read
+	and finished ones are written, in order, by a writer thread. At most
+	queue_size chunks wait for the writer, so memory stays bounded."""
+	pending = queue.Queue(maxsize=queue_size)
+	errors = []
+
+	def write_all():
+		"""Writer thread, keeps draining the queue after an error so the
+		reader never blocks"""
+		while True:
+			item = pending.get()
+			if item is None:
+				return
+			chunk, future = item
+			if errors:
+				continue
+			try:
+				write(chunk, future.result())
+			except BaseException as exception:
+				errors.append(exception)
+
+	writer = threading.Thread(target=write_all, name="batch_writer")
+	writer.start()
+	with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+		try:
+			for chunk in chunks:
+				if errors:
+					break
+				pending.put((chunk, executor.submit(classify, chunk)))
+		finally:
+			pending.put(None)
+			writer.join()
+	if errors:
+		raise errors[0]
+
+def main_process(args=None):
+	"""This is the main stream"""
+	if args is None:
+		args = parse_arguments(sys.argv[1:])
+	log_format = "%(asctime)s %(levelname)s: %(message)s"
+	if args.debug:
+		logging.basicConfig(format=log_format, level=logging.DEBUG)
+	elif args.info:
+		logging.basicConfig(format=log_format, level=logging.INFO)
+	else:
+		logging.basicConfig(format=log_format, level=logging.WARNING)
+
+	output_format = args.format or ("parquet" if args.output.endswith(".parquet") else "piped")
+	checkpoint_file = args.checkpoint or args.output.rstrip("/") + ".checkpoint"
+	checkpoint = load_checkpoint(checkpoint_file)
+	if args.restart:
+		checkpoint = dict(EMPTY_CHECKPOINT)
+	if checkpoint["chunks"]:
+		logging.warning("Resuming after chunk {0}, row {1}".format(checkpoint["chunks"],
+			checkpoint["rows"]))
+	# Every output field is known before the first chunk is written
+	columns = get_output_columns(read_header(args.input)[0])
+	if output_format == "parquet":
+		writer = ParquetWriter(args.output, checkpoint, columns)
+	else:
+		writer = PipedWriter(args.output, checkpoint, columns)
+
+	# Loading models is slow, so WebConsumer is only imported once arguments are valid
+	from meerkat.web_service.web_consumer import WebConsumer
+	params = load_params(args.config)
+	consumer = WebConsumer(params, load_hyperparameters(params), get_us_cities())
+
+	metadata = {"container": args.container}
+	if args.cobrand_region is not None:
+		metadata["cobrand_region"] = args.cobrand_region
+	if args.services_list:
+		metadata["services_list"] = args.services_list.split(",")
+
+	def classify(chunk):
+		"""Classify the records of a chunk"""
+		_, first_row, records, _ = chunk
+		data = dict(metadata, transaction_list=get_transaction_list(records, first_row,
+			args.ledger_entry))
+		return consumer.classify(data)["transaction_list"]
+
+	def write(chunk, transactions):
+		"""Write a classified chunk, then checkpoint it"""
+		index, first_row, records, offset = chunk
+		checkpoint["bytes"] = writer.write(transactions)
+		checkpoint["columns"] = writer.columns
+		checkpoint["chunks"], checkpoint["rows"] = index + 1, first_row + len(records)
+		checkpoint["offset"] = offset
+		save_checkpoint(checkpoint_file, checkpoint)
+		logging.info("Wrote chunk {0}, {1} rows in total".format(index, checkpoint["rows"]))
+
+	try:
+		run_pipeline(read_chunks(args.input, args.chunksize, checkpoint["chunks"],
+			checkpoint["rows"], checkpoint.get("offset", 0)), classify, write,
+			workers=args.workers, queue_size=args.queue_size)
+	finally:
+		writer.close()
+	logging.warning("Classified {0} rows into {1}".format(checkpoint["rows"], args.output))
+
+if __name__ == "__main__":
+	main_process()
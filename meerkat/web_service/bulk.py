@@ -0,0 +1,203 @@
+"""This module streams newline delimited transactions through the classifier
+in fixed-size batches, writing each batch of results back as newline
+delimited JSON as soon as it is classified
+
+@author: J. Andrew Key
+"""
+
+import concurrent.futures
+import logging
+import sys
+
+from collections import deque
+
+import tornado.web
+from tornado import gen
+from tornado.iostream import StreamClosedError
+
+from meerkat.web_service import json_codec
+from meerkat.web_service.admission import Overloaded
+
+def get_transaction_schema(schema_input):
+	"""Return the schema of one transaction_record of the input schema"""
+	schema = dict(schema_input["properties"]["transaction_list"]["items"])
+	schema["definitions"] = schema_input["definitions"]
+	return schema
+
+def get_request_metadata(get_argument):
+	"""Return the request fields shared by every transaction of a bulk
+	request, read from its query arguments. Raises ValueError if they are
+	not valid."""
+	container = get_argument("container", None)
+	if container not in ["bank", "card"]:
+		raise ValueError("container must be bank or card")
+	metadata = {"container": container}
+	if get_argument("cobrand_region", None) is not None:
+		metadata["cobrand_region"] = int(get_argument("cobrand_region"))
+	if get_argument("services_list", None):
+		metadata["services_list"] = get_argument("services_list").split(",")
+	metadata["debug"] = get_argument("debug", "false").lower() == "true"
+	return metadata
+
+@tornado.web.stream_request_body
+class BulkHandler(tornado.web.RequestHandler):
+	"""Classifies a request body of one JSON transaction per line. Lines are
+	classified batch_size at a time on executor, at most max_pending batches
+	at once; reading the upload waits while that many are pending, so memory
+	does not grow with the size of the upload. Results are written in the
+	order of the input, a line which is not a valid transaction gets an
+	error object instead. Uploads are not limited by the max_body_size of the
+	server, only by the max_body_size of the handler, if any. With an
+	admission controller, batches are only submitted once admitted, an
+	overloaded service slows the upload down instead of queueing it."""
+	consumer = None
+	executor = None
+	transaction_validator = None
+	batch_size = 500
+	max_pending = 4
+	max_line_bytes = 65536
+	# Bytes of body accepted, None for no limit
+	max_body_size = None
+	# AdmissionController shared with the other requests on executor, if any
+	admission = None
+	# Seconds to wait before submitting a batch which was not admitted again
+	admission_backoff = 0.1
+	# Bulk requests being classified, a stopping worker waits for them
+	in_flight = 0
+
+	def prepare(self):
+		"""Read the query arguments before the body arrives"""
+		self.__counted = False
+		self.request.connection.set_max_body_size(self.max_body_size or sys.maxsize)
+		try:
+			self.metadata = get_request_metadata(self.get_query_argument)
+		except ValueError as error:
+			raise tornado.web.HTTPError(400, reason=str(error))
+		self.__buffer = b""
+		self.__oversized = False
+		self.__line_number = 0
+		self.__batch = []
+		self.__pending = deque()
+		self.__closed = False
+		self.__counted = True
+		type(self).in_flight += 1
+		self.set_header("Content-Type", "application/x-ndjson")
+
+	def on_finish(self):
+		"""Stop counting the request once it is done"""
+		if self.__counted:
+			self.__counted = False
+			type(self).in_flight -= 1
+
+	def on_connection_close(self):
+		"""Pending batches still finish, but their results are dropped"""
+		self.__closed = True
+		self.on_finish()
+
+	def __add_line(self, line):
+		"""Decode and validate one line of the body into the current batch"""
+		self.__line_number += 1
+		if self.__oversized or len(line) > self.max_line_bytes:
+			self.__oversized = False
+			self.__batch.append((self.__line_number, None,
+				"line is longer than {0} bytes".format(self.max_line_bytes)))
+			return
+		if not line.strip():
+			self.__line_number -= 1
+			return
+		try:
+			transaction = json_codec.loads(line)
+			if self.transaction_validator is not None:
+				self.transaction_validator.validate(transaction)
+			self.__batch.append((self.__line_number, transaction, None))
+		except Exception as error:
+			message = getattr(error, "message", None) or str(error)
+			self.__batch.append((self.__line_number, None, message))
+
+	def classify_batch(self, batch):
+		"""Classify the valid transactions of a batch, runs on executor.
+		Returns one result per line of the batch."""
+		transactions = [transaction for _, transaction, error in batch if error is None]
+		if transactions:
+			data = dict(self.metadata, transaction_list=transactions)
+			try:
+				transactions = self.consumer.classify(data)["transaction_list"]
+			except Exception:
+				logging.exception("Unable to classify a bulk batch")
+				return [{"line": line_number, "error": error or "classification failed"}
+					for line_number, _, error in batch]
+
+		classified = iter(transactions)
+		return [next(classified) if error is None else {"line": line_number, "error": error}
+			for line_number, _, error in batch]
+
+	@gen.coroutine
+	def __write_next(self):
+		"""Wait for the oldest pending batch and stream out its results"""
+		results = yield self.__pending.popleft()
+		if self.__closed:
+			return
+		self.write("".join(json_codec.dumps(result) + "\n" for result in results))
+		try:
+			yield self.flush()
+		except StreamClosedError:
+			self.__closed = True
+
+	@gen.coroutine
+	def __admit(self, batch):
+		"""Submit a batch to executor once admitted, returns its Future.
+		While the service is overloaded the oldest pending batch is written
+		out, or the upload waits admission_backoff seconds."""
+		if self.admission is None:
+			return self.executor.submit(self.classify_batch, batch)
+		while not self.__closed:
+			try:
+				return self.admission.submit(self.executor, len(batch), self.classify_batch, batch)
+			except Overloaded:
+				if self.__pending:
+					yield self.__write_next()
+				else:
+					yield gen.sleep(self.admission_backoff)
+		# Nobody is waiting for the results any more
+		future = concurrent.futures.Future()
+		future.set_result([])
+		return future
+
+	@gen.coroutine
+	def __submit(self):
+		"""Start classifying the current batch, then write out every finished
+		batch at the head of the queue and wait while too many are pending"""
+		if self.__batch:
+			batch, self.__batch = self.__batch, []
+			future = yield self.__admit(batch)
+			self.__pending.append(future)
+		while self.__pending and (self.__pending[0].done() or
+			len(self.__pending) >= self.max_pending):
+			yield self.__write_next()
+
+	@gen.coroutine
+	def data_received(self, chunk):
+		"""Split a chunk of the body into lines, the last partial line is kept
+		for the next chunk. Tornado waits for this coroutine before reading
+		more of the body."""
+		lines = (self.__buffer + chunk).split(b"\n")
+		self.__buffer = lines.pop()
+		if len(self.__buffer) > self.max_line_bytes:
+			self.__buffer, self.__oversized = b"", True
+		for line in lines:
+			self.__add_line(line)
+			if len(self.__batch) >= self.batch_size:
+				yield self.__submit()
+
+	@gen.coroutine
+	def post(self):
+		"""Classify what is left once the body has arrived"""
+		if self.__buffer.strip() or self.__oversized:
+			self.__add_line(self.__buffer)
+		self.__buffer = b""
+		yield self.__submit()
+		while self.__pending:
+			yield self.__write_next()
+
+if __name__ == "__main__":
+	print("This module is a Class; it should not be run from the console.")
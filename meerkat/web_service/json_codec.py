@@ -0,0 +1,29 @@
+"""This module decodes and encodes the JSON of web service requests with
+orjson when it is installed, and with the json module otherwise
+
+@author: J. Andrew Key
+"""
+
+import json
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+def loads(data):
+	"""Decode a JSON document given as UTF-8 bytes or a string"""
+	if orjson is not None:
+		return orjson.loads(data)
+	if isinstance(data, bytes):
+		data = data.decode("utf-8")
+	return json.loads(data)
+
+def dumps(obj):
+	"""Encode obj as a JSON string"""
+	if orjson is not None:
+		return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+	return json.dumps(obj)
+
+if __name__ == "__main__":
+	print("This module is a library; it should not be run from the console.")
@@ -0,0 +1,63 @@
+"""This module remembers the per-description outputs of each classifier
+stage, so descriptions seen in earlier requests skip the classifiers
+
+@author: J. Andrew Key
+"""
+
+import threading
+
+from collections import OrderedDict
+
+class MemoCache():
+	"""A bounded, thread-safe least recently used cache. Hits and misses are
+	counted per stage, so the cache can be sized from its hit rate."""
+
+	def __init__(self, max_size=100000):
+		"""Initializes the MemoCache"""
+		self.max_size = max_size
+		self.__entries = OrderedDict()
+		self.__lock = threading.Lock()
+		self.__hits = dict()
+		self.__misses = dict()
+
+	def get(self, stage, key):
+		"""Return the cached value of stage for key, or None on a miss"""
+		with self.__lock:
+			value = self.__entries.get((stage, key))
+			if value is None:
+				self.__misses[stage] = self.__misses.get(stage, 0) + 1
+				return None
+			self.__entries.move_to_end((stage, key))
+			self.__hits[stage] = self.__hits.get(stage, 0) + 1
+			return value
+
+	def put(self, stage, key, value):
+		"""Cache the value of stage for key, evicting the least recently used
+		entries beyond max_size"""
+		with self.__lock:
+			self.__entries[(stage, key)] = value
+			self.__entries.move_to_end((stage, key))
+			while len(self.__entries) > self.max_size:
+				self.__entries.popitem(last=False)
+
+	def clear(self):
+		"""Drop every entry, counters are kept"""
+		with self.__lock:
+			self.__entries.clear()
+
+	def __len__(self):
+		return len(self.__entries)
+
+	def stats(self):
+		"""Return the size of the cache and the hits, misses and hit rate of
+		each stage"""
+		with self.__lock:
+			stages = dict()
+			for stage in set(self.__hits) | set(self.__misses):
+				hits, misses = self.__hits.get(stage, 0), self.__misses.get(stage, 0)
+				stages[stage] = {"hits": hits, "misses": misses,
+					"hit_rate": hits / (hits + misses)}
+			return {"size": len(self.__entries), "max_size": self.max_size, "stages": stages}
+
+if __name__ == "__main__":
+	print("This module is a Class; it should not be run from the console.")
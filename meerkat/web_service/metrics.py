@@ -0,0 +1,133 @@
+"""This module records latency and batch size histograms of the stages of
+the web service, and formats them for Prometheus
+
+@author: J. Andrew Key
+"""
+
+import threading
+import time
+
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+	2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+class Histogram():
+	"""A histogram without locks. Each thread counts into its own shard and
+	shards are only summed when the histogram is read."""
+
+	def __init__(self, bounds):
+		"""Initializes the Histogram"""
+		self.bounds = tuple(bounds)
+		self.__shards = dict()
+
+	def observe(self, value):
+		"""Count one value, from any thread"""
+		thread = threading.get_ident()
+		shard = self.__shards.get(thread)
+		if shard is None:
+			# Bucket counts, then the +Inf bucket, then the sum
+			shard = self.__shards.setdefault(thread, [0] * (len(self.bounds) + 1) + [0.0])
+		shard[bisect_left(self.bounds, value)] += 1
+		shard[-1] += value
+
+	def snapshot(self):
+		"""Return the cumulative count of each bucket, ending with +Inf, and
+		the sum of the values"""
+		totals = [0] * (len(self.bounds) + 2)
+		for shard in list(self.__shards.values()):
+			for index, value in enumerate(shard):
+				totals[index] += value
+		cumulative, count = [], 0
+		for value in totals[:-1]:
+			count += value
+			cumulative.append(count)
+		return cumulative, totals[-1]
+
+class StageTimer():
+	"""Context manager recording the wall-time of a stage"""
+
+	def __init__(self, metrics, stage, batch_size=None):
+		"""Initializes the StageTimer"""
+		self.metrics, self.stage, self.batch_size = metrics, stage, batch_size
+		self.start = None
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc_info):
+		self.metrics.observe(self.stage, time.perf_counter() - self.start, self.batch_size)
+		return False
+
+class StageMetrics():
+	"""Latency and batch size histograms of each stage"""
+
+	def __init__(self, latency_buckets=LATENCY_BUCKETS, batch_size_buckets=BATCH_SIZE_BUCKETS):
+		"""Initializes the StageMetrics"""
+		self.latency_buckets = latency_buckets
+		self.batch_size_buckets = batch_size_buckets
+		self.latency = dict()
+		self.batch_size = dict()
+
+	def observe(self, stage, seconds, batch_size=None):
+		"""Record one run of stage"""
+		histogram = self.latency.get(stage)
+		if histogram is None:
+			histogram = self.latency.setdefault(stage, Histogram(self.latency_buckets))
+		histogram.observe(seconds)
+		if batch_size is not None:
+			histogram = self.batch_size.get(stage)
+			if histogram is None:
+				histogram = self.batch_size.setdefault(stage, Histogram(self.batch_size_buckets))
+			histogram.observe(batch_size)
+
+	def timer(self, stage, batch_size=None):
+		"""Return a context manager recording the wall-time of stage"""
+		return StageTimer(self, stage, batch_size)
+
+	def format(self, prefix="meerkat"):
+		"""Return the histograms in the Prometheus text format"""
+		return format_histograms(prefix + "_stage_latency_seconds",
+			"Wall-time of each stage", self.latency, "stage") + \
+			format_histograms(prefix + "_stage_batch_size",
+			"Transactions handled by each run of a stage", self.batch_size, "stage")
+
+def format_labels(labels):
+	"""Return labels in the Prometheus text format"""
+	if not labels:
+		return ""
+	return "{" + ",".join('{0}="{1}"'.format(name, str(value).replace("\\", "\\\\")
+		.replace('"', '\\"').replace("\n", "\\n")) for name, value in labels) + "}"
+
+def format_histograms(name, description, histograms, label):
+	"""Return histograms keyed by the value of label in the Prometheus text format"""
+	lines = ["# HELP {0} {1}".format(name, description), "# TYPE {0} histogram".format(name)]
+	# Copy the items first, stage threads may add a histogram meanwhile
+	for value, histogram in sorted(list(histograms.items())):
+		cumulative, total = histogram.snapshot()
+		for bound, count in zip(histogram.bounds + ("+Inf",), cumulative):
+			lines.append("{0}_bucket{1} {2}".format(name,
+				format_labels([(label, value), ("le", bound)]), count))
+		lines.append("{0}_sum{1} {2}".format(name, format_labels([(label, value)]), total))
+		lines.append("{0}_count{1} {2}".format(name, format_labels([(label, value)]),
+			cumulative[-1]))
+	return "\n".join(lines) + "\n"
+
+def format_metric(name, description, samples, metric_type="gauge"):
+	"""Return a gauge or counter with a value per list of (label, value)
+	pairs in the Prometheus text format"""
+	lines = ["# HELP {0} {1}".format(name, description),
+		"# TYPE {0} {1}".format(name, metric_type)]
+	for labels, value in samples:
+		lines.append("{0}{1} {2}".format(name, format_labels(labels), value))
+	return "\n".join(lines) + "\n"
+
+def get_queue_depth(executor):
+	"""Return the number of tasks waiting for a thread of a ThreadPoolExecutor"""
+	work_queue = getattr(executor, "_work_queue", None)
+	return work_queue.qsize() if work_queue is not None else 0
+
+if __name__ == "__main__":
+	print("This module is a Class; it should not be run from the console.")
@@ -0,0 +1,115 @@
+"""This module merges the CNN calls of concurrent requests into larger
+batches, so TensorFlow runs one big batch instead of many tiny ones
+
+@author: J. Andrew Key
+"""
+
+import logging
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+
+from meerkat.classification.tools import EncodedBatch, join_encoded_batches
+
+class MicroBatcher():
+	"""Wraps an apply_cnn closure from get_tf_cnn_by_path. Calls from
+	concurrent requests are queued and flushed as one batch once
+	max_batch_size transactions are waiting or the oldest call has waited
+	max_wait seconds. Each caller gets back its own transactions."""
+
+	def __init__(self, apply_cnn, max_batch_size=256, max_wait=0.002, name="cnn"):
+		"""Initializes the MicroBatcher and starts its worker thread"""
+		self.apply_cnn = apply_cnn
+		self.max_batch_size = max_batch_size
+		self.max_wait = max_wait
+		self.__queue = queue.Queue()
+		self.__closed = False
+		self.__lock = threading.Lock()
+		self.__worker = threading.Thread(target=self.__run, name="micro_batcher_" + name)
+		self.__worker.daemon = True
+		self.__worker.start()
+
+	def __call__(self, trans, doc_key="description", label_key="CNN", label_only=True,
+		soft_target=False):
+		"""Queue transactions for the next batch and wait for the result, with
+		the same signature and return value as apply_cnn"""
+		future = Future()
+		encoded = trans if isinstance(trans, EncodedBatch) else EncodedBatch(trans, doc_key=doc_key)
+		with self.__lock:
+			queued = not self.__closed
+			if queued:
+				self.__queue.put((encoded, (label_key, label_only, soft_target), future))
+		if not queued:
+			return self.apply_cnn(trans, doc_key=doc_key, label_key=label_key,
+				label_only=label_only, soft_target=soft_target)
+		return future.result()
+
+	def close(self):
+		"""Stop the worker thread once queued calls are flushed, later calls
+		go straight to apply_cnn"""
+		with self.__lock:
+			self.__closed = True
+			self.__queue.put(None)
+
+	def __collect(self):
+		"""Block for the first call, then collect calls until the batch is full
+		or the deadline of the first call passes. Returns None once closed."""
+		first = self.__queue.get()
+		if first is None:
+			return None
+		pending, size = [first], len(first[0])
+		deadline = time.time() + self.max_wait
+		while size < self.max_batch_size:
+			timeout = deadline - time.time()
+			if timeout <= 0:
+				break
+			try:
+				item = self.__queue.get(timeout=timeout)
+			except queue.Empty:
+				break
+			if item is None:
+				# Flush what we have, then stop
+				self.__queue.put(None)
+				break
+			pending.append(item)
+			size += len(item[0])
+		return pending
+
+	def __flush(self, pending):
+		"""Run one apply_cnn call per distinct set of options and scatter the
+		results back to each caller"""
+		groups = dict()
+		for item in pending:
+			groups.setdefault(item[1], []).append(item)
+
+		for (label_key, label_only, soft_target), items in groups.items():
+			try:
+				joined = join_encoded_batches([item[0] for item in items])
+				output = self.apply_cnn(joined, label_key=label_key, label_only=label_only,
+					soft_target=soft_target)
+			except Exception as exception:
+				for _, _, future in items:
+					future.set_exception(exception)
+				continue
+
+			offset = 0
+			for trans, _, future in items:
+				if soft_target:
+					future.set_result(output[offset:offset + len(trans)])
+				else:
+					future.set_result(trans.trans)
+				offset += len(trans)
+
+	def __run(self):
+		"""Worker loop"""
+		while True:
+			pending = self.__collect()
+			if pending is None:
+				logging.info("Stopping {0}".format(self.__worker.name))
+				return
+			self.__flush(pending)
+
+if __name__ == "__main__":
+	print("This module is a Class; it should not be run from the console.")
@@ -0,0 +1,151 @@
+"""This module swaps complete sets of models while the web service runs.
+A new set is loaded and warmed up in the background, becomes current with
+a single reference flip, and the sessions of the old set are closed once
+the requests using them finish.
+
+@author: J. Andrew Key
+"""
+
+import logging
+import threading
+
+from meerkat.web_service.micro_batcher import MicroBatcher
+
+def close_model(model):
+	"""Stop the micro batcher of a model, if any, and close its session"""
+	if isinstance(model, MicroBatcher):
+		model.close()
+		model = model.apply_cnn
+	close = getattr(model, "close", None)
+	if callable(close):
+		close()
+
+class ModelSet():
+	"""One version of every model. Requests acquire the set they use and
+	release it when done, a retired set is closed once none is using it."""
+
+	def __init__(self, version, models, paths=None):
+		"""Initializes the ModelSet"""
+		self.version = version
+		self.models = models
+		self.paths = paths if paths is not None else dict()
+		self.in_flight = 0
+		self.__retired = False
+		self.__closed = False
+		self.__lock = threading.Lock()
+
+	def acquire(self):
+		"""Count a request using this set"""
+		with self.__lock:
+			self.in_flight += 1
+		return self
+
+	def release(self):
+		"""Stop counting a request, closing a retired set it was the last of"""
+		with self.__lock:
+			self.in_flight -= 1
+			drained = self.__retired and self.in_flight == 0
+		if drained:
+			self.close()
+
+	def retire(self):
+		"""Close this set once its requests in flight finish"""
+		with self.__lock:
+			self.__retired = True
+			drained = self.in_flight == 0
+		if drained:
+			self.close()
+
+	def close(self):
+		"""Close the session of every model, once"""
+		with self.__lock:
+			if self.__closed:
+				return
+			self.__closed = True
+		for model in self.models.values():
+			close_model(model)
+		logging.warning("Closed models version {0}".format(self.version))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.release()
+		return False
+
+class ModelRegistry():
+	"""Holds the current ModelSet. load_models() returns a dict of models and
+	a dict of their paths, each model is passed to warm_up before the set
+	becomes current and on_swap is called with every new current set."""
+
+	def __init__(self, load_models, warm_up=None, on_swap=None):
+		"""Initializes the ModelRegistry"""
+		self.load_models = load_models
+		self.warm_up = warm_up
+		self.on_swap = on_swap
+		self.current = None
+		self.reloading = False
+		self.__lock = threading.Lock()
+		self.__load_lock = threading.Lock()
+
+	def acquire(self):
+		"""Return the current ModelSet, counted as in use until released"""
+		with self.__lock:
+			return self.current.acquire()
+
+	def load(self):
+		"""Load, warm up and swap in a new set of models, returns the new
+		ModelSet. If loading fails the current set is kept and the error is
+		raised."""
+		with self.__load_lock:
+			version = self.current.version + 1 if self.current is not None else 1
+			logging.warning("Loading models version {0}".format(version))
+			models, paths = self.load_models()
+			model_set = ModelSet(version, models, paths)
+			try:
+				# A partial set must not replace a complete one
+				if self.current is not None:
+					missing = set(self.current.models) - set(models)
+					if missing:
+						raise ValueError("Models version {0} is missing {1}".format(version,
+							sorted(missing)))
+				if self.warm_up is not None:
+					for model in models.values():
+						self.warm_up(model)
+			except Exception:
+				model_set.close()
+				raise
+
+			with self.__lock:
+				old, self.current = self.current, model_set
+			if self.on_swap is not None:
+				self.on_swap(model_set)
+			logging.warning("Serving models version {0}".format(version))
+			if old is not None:
+				old.retire()
+			return model_set
+
+	def reload(self):
+		"""Load a new set of models on a background thread, returns False if
+		a reload is already running"""
+		with self.__lock:
+			if self.reloading:
+				return False
+			self.reloading = True
+		thread = threading.Thread(target=self.__reload, name="model_reload")
+		thread.daemon = True
+		thread.start()
+		return True
+
+	def __reload(self):
+		"""Background reload"""
+		try:
+			self.load()
+		except Exception:
+			logging.exception("Unable to reload models, keeping version {0}".format(
+				self.current.version if self.current is not None else None))
+		finally:
+			self.reloading = False
+
+if __name__ == "__main__":
+	print("This module is a Class; it should not be run from the console.")
@@ -0,0 +1,147 @@
+"""This module pre-forks worker processes for the web service. The workers
+share the listening sockets and each one loads its own models after the fork.
+
+@author: J. Andrew Key
+"""
+
+import logging
+import os
+import select
+import signal
+import time
+
+class PreforkSupervisor():
+	"""Keeps workers processes running serve(worker_id, ready), restarting any
+	which die. serve calls ready() once it accepts requests and returns once
+	asked to stop by SIGTERM. SIGHUP replaces the workers one at a time, each
+	replacement is ready before the old worker is stopped. SIGUSR1 is passed
+	on to every worker. SIGTERM or SIGINT stops every worker."""
+
+	def __init__(self, workers, serve, ready_timeout=600, poll_interval=0.2):
+		"""Initializes the PreforkSupervisor"""
+		self.workers = workers
+		self.serve = serve
+		self.ready_timeout = ready_timeout
+		self.poll_interval = poll_interval
+		self.children = dict()
+		self.__reload = False
+		self.__forward = False
+		self.__stop = False
+
+	def __spawn(self, worker_id):
+		"""Fork a worker, returns its pid and the pipe it signals ready on"""
+		read_fd, write_fd = os.pipe()
+		pid = os.fork()
+		if pid == 0:
+			os.close(read_fd)
+			for signum in [signal.SIGHUP, signal.SIGTERM, signal.SIGINT]:
+				signal.signal(signum, signal.SIG_DFL)
+			# Until serve handles it
+			signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+			def ready():
+				"""Tell the supervisor this worker accepts requests"""
+				try:
+					os.write(write_fd, b"1")
+					os.close(write_fd)
+				except OSError:
+					# Only replacement workers are waited for
+					pass
+
+			status = 0
+			try:
+				self.serve(worker_id, ready)
+			except BaseException:
+				logging.exception("Worker {0} failed".format(worker_id))
+				status = 1
+			os._exit(status)
+
+		os.close(write_fd)
+		self.children[pid] = worker_id
+		logging.warning("Started worker {0} as pid {1}".format(worker_id, pid))
+		return pid, read_fd
+
+	def __wait_ready(self, pid, read_fd):
+		"""Wait until a new worker is ready, returns False if it died first"""
+		deadline = time.time() + self.ready_timeout
+		try:
+			while time.time() < deadline:
+				readable, _, _ = select.select([read_fd], [], [], self.poll_interval)
+				if readable:
+					return os.read(read_fd, 1) == b"1"
+				if os.waitpid(pid, os.WNOHANG)[0] == pid:
+					self.children.pop(pid, None)
+					return False
+			return False
+		finally:
+			os.close(read_fd)
+
+	def __stop_worker(self, pid):
+		"""Ask a worker to finish its requests and exit, then reap it"""
+		worker_id = self.children.pop(pid)
+		try:
+			os.kill(pid, signal.SIGTERM)
+			os.waitpid(pid, 0)
+		except (ProcessLookupError, ChildProcessError):
+			pass
+		logging.warning("Stopped worker {0} (pid {1})".format(worker_id, pid))
+
+	def __reload_workers(self):
+		"""Replace every worker, one at a time"""
+		logging.warning("Reloading {0} workers".format(len(self.children)))
+		for old_pid, worker_id in list(self.children.items()):
+			pid, read_fd = self.__spawn(worker_id)
+			if not self.__wait_ready(pid, read_fd):
+				logging.error("Worker {0} failed to start, keeping pid {1}".format(worker_id,
+					old_pid))
+				continue
+			self.__stop_worker(old_pid)
+
+	def __reap(self):
+		"""Restart workers which died"""
+		while self.children:
+			pid, status = os.waitpid(-1, os.WNOHANG)
+			if pid == 0:
+				return
+			worker_id = self.children.pop(pid, None)
+			if worker_id is not None and not self.__stop:
+				logging.error("Worker {0} (pid {1}) exited with status {2}, restarting".format(
+					worker_id, pid, status))
+				os.close(self.__spawn(worker_id)[1])
+
+	def __on_signal(self, signum, _):
+		"""Record signals, they are handled by the supervisor loop"""
+		if signum == signal.SIGHUP:
+			self.__reload = True
+		elif signum == signal.SIGUSR1:
+			self.__forward = True
+		else:
+			self.__stop = True
+
+	def run(self):
+		"""Start the workers and supervise them until SIGTERM or SIGINT"""
+		for signum in [signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGUSR1]:
+			signal.signal(signum, self.__on_signal)
+
+		for worker_id in range(self.workers):
+			os.close(self.__spawn(worker_id)[1])
+
+		while self.children and not self.__stop:
+			if self.__reload:
+				self.__reload = False
+				self.__reload_workers()
+			if self.__forward:
+				self.__forward = False
+				for pid in list(self.children):
+					os.kill(pid, signal.SIGUSR1)
+			self.__reap()
+			time.sleep(self.poll_interval)
+
+		# Let every worker drain at once
+		for pid in list(self.children):
+			os.kill(pid, signal.SIGTERM)
+		for pid in list(self.children):
+			self.__stop_worker(pid)
+
+if __name__ == "__main__":
+	print("This module is a Class; it should not be run from the console.")
@@ -0,0 +1,62 @@
+"""This module runs the independent stages of a request as a dependency
+graph on a shared executor
+
+@author: J. Andrew Key
+"""
+
+import time
+
+from concurrent.futures import wait, FIRST_COMPLETED
+
+class StageScheduler():
+	"""Runs named stages on an executor, starting each stage as soon as the
+	stages it depends on have finished. Records the wall-time of each stage."""
+
+	def __init__(self, executor):
+		"""Initializes the StageScheduler"""
+		self.executor = executor
+		self.stages = dict()
+		self.timings = dict()
+		self.results = dict()
+
+	def add(self, name, func, *args, depends_on=()):
+		"""Adds a stage called name which runs func(*args) after every stage
+		in depends_on has finished"""
+		for dependency in depends_on:
+			if dependency not in self.stages:
+				raise ValueError("Stage {0} depends on unknown stage {1}".format(name, dependency))
+		self.stages[name] = (func, args, set(depends_on))
+
+	def __timed(self, name, func, args):
+		"""Runs a stage and records its wall-time"""
+		start = time.time()
+		try:
+			return func(*args)
+		finally:
+			self.timings[name] = time.time() - start
+
+	def run(self):
+		"""Runs every stage and waits for all of them, returning a dict of
+		results by stage name. The first exception raised by a stage is
+		re-raised here and stages that have not started yet are skipped."""
+		pending = {name: set(stage[2]) for name, stage in self.stages.items()}
+		running = dict()
+
+		while pending or running:
+			# Submit every stage whose dependencies have all finished
+			for name in [name for name, deps in pending.items() if not deps]:
+				func, args, _ = self.stages[name]
+				running[self.executor.submit(self.__timed, name, func, args)] = name
+				del pending[name]
+
+			done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+			for future in done:
+				name = running.pop(future)
+				self.results[name] = future.result()
+				for deps in pending.values():
+					deps.discard(name)
+
+		return self.results
+
+if __name__ == "__main__":
+	print("This module is a Class; it should not be run from the console.")
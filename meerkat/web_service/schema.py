@@ -1,5 +1,5 @@
 """Process and validate the schema"""
-import json
+import random
 from functools import wraps
 import jsonschema
 
@@ -8,6 +8,25 @@ from tornado.concurrent import Future
 
 from tornado_json.utils import container
 
+from meerkat.web_service import json_codec
+
+def get_validator(schema):
+	"""Check a schema and return a validator for it, validators are built
+	once instead of on every call to jsonschema.validate"""
+	if schema is None:
+		return None
+	validator_class = jsonschema.validators.validator_for(schema)
+	validator_class.check_schema(schema)
+	return validator_class(schema)
+
+def write_success(handler, output):
+	"""Write output as a JSend success, like JSendMixin.success, encoded
+	with the fastest installed JSON codec"""
+	handler.set_header("Content-Type", "application/json; charset=UTF-8")
+	# Escape "</" the way tornado does when writing a dict
+	handler.write(json_codec.dumps({"status": "success", "data": output}).replace("</", "<\\/"))
+	handler.finish()
+
 def services_list_validation(services_list):
 	"""check whether a services combination is valid"""
 	if services_list != []:
@@ -28,8 +47,12 @@ def services_list_validation(services_list):
 # pylint: disable=too-many-arguments
 def validate(input_schema=None, output_schema=None,\
 	input_example=None, output_example=None,\
-	debug_output_example=None, debug_output_schema=None):
-	"""validate schema"""
+	debug_output_example=None, debug_output_schema=None,\
+	output_sample_rate=1.0):
+	"""validate schema, only output_sample_rate of the outputs are validated"""
+	input_validator = get_validator(input_schema)
+	output_validator = get_validator(output_schema)
+	debug_output_validator = get_validator(debug_output_schema)
 
 	@container
 	def _validate(rh_method):
@@ -63,24 +86,22 @@ def validate(input_schema=None, output_schema=None,\
 					# TODO: Assuming UTF-8 encoding for all requests,
 					#   find a nice way of determining this from charset
 					#   in headers if provided
-					encoding = "UTF-8"
-					input_ = json.loads(self.request.body.decode(encoding))
+					input_ = json_codec.loads(self.request.body)
 				except ValueError as _:
 					raise jsonschema.ValidationError(
 						"Input is malformed; could not decode JSON object."
 					)
 				# Validate the received input
-				jsonschema.validate(
-					input_,
-					input_schema
-				)
+				input_validator.validate(input_)
 				# services_list_validation(input_.get("services_list", []))
 			else:
 				input_ = None
 
 			# A json.loads'd version of self.request["body"] is now available
-			#   as self.body
+			#   as self.body, the method may modify it in place
 			setattr(self, "body", input_)
+			debug = input_ is not None and input_.get("debug", False)
+			validate_output = output_sample_rate >= 1.0 or random.random() < output_sample_rate
 			# Call the requesthandler method
 			output = rh_method(self, *args, **kwargs)
 			# If the rh_method returned a Future a la `raise Return(value)`
@@ -88,30 +109,24 @@ def validate(input_schema=None, output_schema=None,\
 			if isinstance(output, Future):
 				output = yield output
 
-			if "debug" not in input_ or input_["debug"] is False:
-				if output_schema is not None:
+			if validate_output and debug is False:
+				if output_validator is not None:
 					# We wrap output in an object before validating in case
 					#  output is a string (and ergo not a validatable JSON object)
 					try:
-						jsonschema.validate(
-							output,
-							output_schema
-						)
+						output_validator.validate(output)
 					except jsonschema.ValidationError as err:
 						# We essentially re-raise this as a TypeError because
 						#  we don't want this error data passed back to the client
 						#  because it's a fault on our end. The client should
 						#  only see a 500 - Internal Server Error.
 						raise TypeError(str(err))
-			elif input_["debug"] is True:
-				if debug_output_schema is not None:
+			elif validate_output and debug is True:
+				if debug_output_validator is not None:
 					# We wrap output in an object before validating in case
 					#  output is a string (and ergo not a validatable JSON object)
 					try:
-						jsonschema.validate(
-							output,
-							debug_output_schema
-						)
+						debug_output_validator.validate(output)
 					except jsonschema.ValidationError as err:
 						# We essentially re-raise this as a TypeError because
 						#  we don't want this error data passed back to the client
@@ -121,7 +136,7 @@ def validate(input_schema=None, output_schema=None,\
 
 			# If no ValidationError has been raised up until here, we write
 			#  back output
-			self.success(output)
+			write_success(self, output)
 
 		setattr(_wrapper, "input_schema", input_schema)
 		setattr(_wrapper, "output_schema", output_schema)
@@ -0,0 +1,145 @@
+"""This module caches Elasticsearch responses by query, so identical
+merchant lookups are only sent to the cluster once per TTL
+
+@author: J. Andrew Key
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+SEARCH_CACHE_DIR = "meerkat/web_service/cache/search/"
+
+def get_query_key(header, query):
+	"""Return the cache key of an msearch header and query, the header holds
+	the index name and routing"""
+	text = json.dumps([header, query], sort_keys=True, separators=(",", ":"))
+	return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def get_stamp_file(index, cache_dir=SEARCH_CACHE_DIR):
+	"""Return the file whose modification time marks the last reload of index"""
+	return os.path.join(cache_dir, index + ".stamp")
+
+def invalidate_index(index, cache_dir=SEARCH_CACHE_DIR):
+	"""Mark every cached response of index as stale, in this and every other
+	process sharing cache_dir. Called once load_index_from_file reloads index.
+	Only processes reading this cache_dir, on this host or a shared
+	filesystem, see it; others serve cached responses until their TTL."""
+	os.makedirs(cache_dir, exist_ok=True)
+	with open(get_stamp_file(index, cache_dir), "w") as stamp_file:
+		stamp_file.write(str(time.time()))
+	logging.warning("Invalidated cached searches of {0}".format(index))
+
+class SearchCache():
+	"""A least recently used cache of msearch responses with a TTL, and an
+	optional tier of one JSON file per response in cache_dir. Responses stored
+	before the index was last reloaded are stale."""
+
+	def __init__(self, max_size=50000, ttl=3600, cache_dir=SEARCH_CACHE_DIR, disk_tier=False,
+		stamp_interval=1.0):
+		"""Initializes the SearchCache"""
+		self.max_size = max_size
+		self.ttl = ttl
+		self.cache_dir = cache_dir
+		self.disk_tier = disk_tier
+		self.stamp_interval = stamp_interval
+		self.hits, self.misses = 0, 0
+		self.__entries = OrderedDict()
+		self.__stamps = dict()
+		self.__lock = threading.Lock()
+
+	def index_version(self, index):
+		"""Return the time index was last reloaded, re-read from its stamp file
+		at most once every stamp_interval seconds"""
+		now = time.time()
+		checked, version = self.__stamps.get(index, (0, 0))
+		if now - checked >= self.stamp_interval:
+			try:
+				version = os.path.getmtime(get_stamp_file(index, self.cache_dir))
+			except OSError:
+				version = 0
+			self.__stamps[index] = (now, version)
+		return version
+
+	def __disk_file(self, key):
+		"""Return the disk tier file of key"""
+		return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+	def __is_fresh(self, index, stored):
+		"""A response is fresh within its TTL and after the last reload of its index"""
+		return time.time() - stored < self.ttl and stored >= self.index_version(index)
+
+	def get(self, header, query):
+		"""Return the cached response of a query, or None"""
+		index, key = header.get("index", ""), get_query_key(header, query)
+		with self.__lock:
+			entry = self.__entries.get(key)
+			if entry is not None and self.__is_fresh(index, entry[0]):
+				self.__entries.move_to_end(key)
+				self.hits += 1
+				return entry[1]
+			self.__entries.pop(key, None)
+
+		if self.disk_tier:
+			try:
+				filename = self.__disk_file(key)
+				stored = os.path.getmtime(filename)
+				if self.__is_fresh(index, stored):
+					with open(filename, encoding="utf-8") as disk_file:
+						response = json.load(disk_file)
+					self.__put(key, stored, response)
+					with self.__lock:
+						self.hits += 1
+					return response
+			except (OSError, ValueError):
+				pass
+
+		with self.__lock:
+			self.misses += 1
+		return None
+
+	def put(self, header, query, response):
+		"""Cache the response of a query"""
+		key, stored = get_query_key(header, query), time.time()
+		self.__put(key, stored, response)
+		if self.disk_tier:
+			filename = self.__disk_file(key)
+			temp_filename = "{0}.{1}.{2}.tmp".format(filename, os.getpid(), threading.get_ident())
+			try:
+				os.makedirs(os.path.dirname(filename), exist_ok=True)
+				with open(temp_filename, "w", encoding="utf-8") as disk_file:
+					json.dump(response, disk_file)
+				os.replace(temp_filename, filename)
+			except OSError as exception:
+				logging.warning("Unable to write {0}: {1}".format(filename, exception))
+
+	def __put(self, key, stored, response):
+		"""Add a response to the in-process tier"""
+		with self.__lock:
+			self.__entries[key] = (stored, response)
+			self.__entries.move_to_end(key)
+			while len(self.__entries) > self.max_size:
+				self.__entries.popitem(last=False)
+
+	def clear(self):
+		"""Drop the in-process tier"""
+		with self.__lock:
+			self.__entries.clear()
+
+	def __len__(self):
+		return len(self.__entries)
+
+	def stats(self):
+		"""Return the size, hits, misses and hit rate of the cache"""
+		with self.__lock:
+			total = self.hits + self.misses
+			return {"size": len(self.__entries), "max_size": self.max_size, "hits": self.hits,
+				"misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+if __name__ == "__main__":
+	print("This module is a Class; it should not be run from the console.")
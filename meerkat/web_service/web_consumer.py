@@ -7,37 +7,104 @@ Created on Nov 3, 2014
 @author: Matthew Sevrens
 """
 
+import concurrent.futures
 import json
+import math
 # pylint:disable=deprecated-module
 import string
-import re
 import logging
 import os
-from multiprocessing.pool import ThreadPool
+import time
 from scipy.stats.mstats import zscore
 
-from meerkat.various_tools import get_es_connection, string_cleanse, get_boosted_fields
-from meerkat.various_tools import synonyms, get_bool_query, get_qs_query
+from meerkat.various_tools import get_es_connection, get_normalizer, get_boosted_fields
+from meerkat.various_tools import get_bool_query, get_qs_query
 from meerkat.classification.load_model import load_scikit_model, get_tf_cnn_by_path
 from meerkat.classification.auto_load import main_program as load_models_from_s3
+from meerkat.classification.tools import EncodedBatch
+from meerkat.web_service.scheduler import StageScheduler
+from meerkat.web_service.micro_batcher import MicroBatcher
+from meerkat.web_service.memo_cache import MemoCache
+from meerkat.web_service.async_search import AsyncSearch
+from meerkat.web_service.search_cache import SearchCache, SEARCH_CACHE_DIR
+from meerkat.web_service.metrics import StageMetrics, get_queue_depth
+from meerkat.web_service.model_registry import ModelRegistry, close_model
 
 # pylint:disable=no-name-in-module
-from meerkat.classification.bloom_filter.trie import location_split
+from meerkat.classification.bloom_filter.trie import location_split_batch, get_geo_index
 
 # Enabled Models
-BANK_SWS = load_scikit_model("bank_sws")
-CARD_SWS = load_scikit_model("card_sws")
+BANK_SWS = load_scikit_model("bank_sws", batch=True)
+CARD_SWS = load_scikit_model("card_sws", batch=True)
+
+# Output fields every transaction gets, then those physical ones get, with
+# the default of each when missing
+OUTPUT_DEFAULTS = (("city", ""), ("state", ""), ("transaction_id", None),
+	("is_physical_merchant", ""), ("merchant_name", ""), ("txn_sub_type", ""), ("txn_type", ""))
+PHYSICAL_OUTPUT_DEFAULTS = (("chain_name", ""), ("confidence_score", ""), ("country", ""),
+	("fax_number", ""), ("latitude", ""), ("longitude", ""), ("match_found", False),
+	("neighbourhood", ""), ("phone_number", ""), ("postal_code", ""), ("source", "OTHER"),
+	("source_merchant_id", ""), ("store_id", ""), ("street", ""), ("txn_sub_type", ""),
+	("txn_type", ""), ("website", ""))
+# Fields of physical transactions copied to "search" in debug mode
+DEBUG_SEARCH_FIELDS = ("merchant_name", "street", "city", "country", "state", "postal_code",
+	"source_merchant_id", "store_id", "latitude", "longitude", "website", "phone_number",
+	"fax_number", "chain_name", "neighbourhood")
+# Fields stripped from the output
+INTERNAL_FIELDS = ("locale_bloom", "description", "amount", "date", "ledger_entry", "CNN",
+	"container", "category_CNN", "merchant_score", "subtype_score", "category_score")
+
+CATEGORY_RULES = "meerkat/web_service/config/category.json"
+
+def load_category_rules(filename=CATEGORY_RULES):
+	"""Return the category rules by (ledger_entry, container), each a set of
+	categories and whether the merchant CNN decides the category of a
+	transaction in the set (credit) or of one outside it (debit)"""
+	with open(filename) as json_file:
+		json_data = json.load(json_file)
+	rules = dict()
+	for key, categories in json_data.items():
+		container, ledger_entry = key.split("_")
+		rules[(ledger_entry, container)] = (frozenset(categories), ledger_entry == "credit")
+	return rules
+
+def get_session_threads(tf_threads, workers=1):
+	"""Return the intra_op and inter_op thread counts of each TensorFlow
+	session. With several worker processes the configured counts, or every
+	core when unset, are divided between them."""
+	counts = []
+	for key in ["intra_op", "inter_op"]:
+		count = tf_threads.get(key, 0)
+		if workers > 1:
+			count = max(1, (count or os.cpu_count() or 1) // workers)
+		counts.append(count)
+	return counts
+
+def get_shards(transactions, shard_size=0, max_shards=1):
+	"""Split transactions into consecutive shards of shard_size, making them
+	larger when needed so there are at most max_shards. A shard_size of 0
+	keeps every transaction in one shard."""
+	if shard_size <= 0 or len(transactions) <= shard_size:
+		return [transactions]
+	shard_size = max(shard_size, int(math.ceil(len(transactions) / max(max_shards, 1))))
+	return [transactions[start:start + shard_size]
+		for start in range(0, len(transactions), shard_size)]
 
 class WebConsumer():
 	"""Acts as a web service client to process and enrich
 	transactions in real time"""
 
-	# 14 is the best thread number Andy has tried
-	__cpu_pool = ThreadPool(processes=14)
+	# 14 is the best thread number Andy has tried, each request runs
+	# up to four stages (cpu, subtype, category, merchant) at once
+	__stage_pool = concurrent.futures.ThreadPoolExecutor(max_workers=14 * 4)
+	# Shards of large requests wait on the stage pool from their own threads,
+	# so they never hold a stage thread another shard needs
+	__shard_pool = concurrent.futures.ThreadPoolExecutor(max_workers=14 * 4)
 
 	def __init__(self, params=None, hyperparams=None, cities=None):
 		"""Constructor"""
 
+		self.async_search, self.search_cache = None, None
 		if params is None:
 			self.params = dict()
 		else:
@@ -48,46 +115,177 @@ class WebConsumer():
 				index = params["elasticsearch"]["index"]
 				index_type = params["elasticsearch"]["type"]
 				self.params["routed"] = "_routing" in mapping[index]["mappings"][index_type]
-
+				# Search from an IOLoop with a deadline per request, if enabled
+				async_search = params["elasticsearch"].get("async_search", {})
+				if async_search.get("enabled", False):
+					self.async_search = AsyncSearch(params["elasticsearch"]["cluster_nodes"], index,
+						max_clients=async_search.get("max_clients_per_node", 10),
+						deadline=async_search.get("deadline_ms", 2000) / 1000.0,
+						port=async_search.get("port", 9200))
+				# Cache responses by query, if enabled
+				search_cache = params["elasticsearch"].get("search_cache", {})
+				if search_cache.get("enabled", False):
+					self.search_cache = SearchCache(max_size=search_cache.get("max_size", 50000),
+						ttl=search_cache.get("ttl_seconds", 3600),
+						cache_dir=search_cache.get("cache_dir", SEARCH_CACHE_DIR),
+						disk_tier=search_cache.get("disk_tier", False))
+
+		# Remember the output of each stage for descriptions seen before, if enabled
+		memo_cache = self.params.get("memo_cache", {})
+		self.memo_cache = None
+		if memo_cache.get("enabled", False):
+			self.memo_cache = MemoCache(max_size=memo_cache.get("max_size", 100000))
+		self.__model_generation = 0
+		self.category_rules = dict()
+		# Map each search result field to its output label once
+		results = self.params.get("output", {}).get("results", {})
+		self.__attr_map = dict(zip(results.get("fields", []), results.get("labels", [])))
+		self.__output_fields = [(field, self.__attr_map.get(field, field))
+			for field in results.get("fields", [])]
+		self.__empty_result = dict.fromkeys([label for _, label in self.__output_fields], "")
+		self.__name_label = self.__attr_map.get("name", "name")
+		# Large requests are split into shards which are classified concurrently
+		sharding = self.params.get("sharding", {})
+		self.shard_size = sharding.get("shard_size", 0) if sharding.get("enabled", False) else 0
+		self.max_shards = sharding.get("max_shards_per_request", 1)
+		# Latency and batch size of each stage, served on /metrics
+		self.metrics = StageMetrics()
+
+		# Complete sets of models are swapped in without stopping requests
+		self.model_registry = ModelRegistry(self.__load_model_set, warm_up=self.__warm_up,
+			on_swap=self.__on_model_swap)
 		self.load_tf_models()
+		self.normalizer = get_normalizer()
+		# Load the geo index now rather than on the first request
+		get_geo_index()
 		self.hyperparams = hyperparams if hyperparams else {}
 		self.cities = cities if cities else {}
 
 	def load_tf_models(self):
-		"""Load all tensorFlow models"""
+		"""Load all tensorFlow models and serve them once they are ready, raises
+		if they fail to load"""
+		self.model_registry.load()
+
+	def reload_models(self):
+		"""Load all tensorFlow models in the background, requests are served by
+		the current models until the new ones are ready. Returns False if a
+		reload is already running."""
+		return self.model_registry.reload()
+
+	@property
+	def models(self):
+		"""The current models by name"""
+		return self.model_registry.current.models
+
+	def __load_model_set(self):
+		"""Load every tensorFlow model into its own graph and session, returns
+		the models and their paths by name"""
 
 		gmf = self.params.get("gpu_mem_fraction", False)
 		auto_load_config = self.params.get("auto_load_config", None)
 
-		#Auto load cnn models from S2, if necessary
+		#Auto load cnn models from S3, if necessary. Downloads replace each
+		#file in place, the current sessions no longer read them.
 		if auto_load_config is not None:
-			#Flush old models, to be safe
-			target_dir = "meerkat/classification/models/"
-			for file_name in os.listdir(target_dir):
-				if file_name.endswith(".meta") or file_name.endswith(".ckpt"):
-					file_path = os.path.join(target_dir, file_name)
-					logging.warning("Removing {0}".format(file_path))
-					os.unlink(file_path)
-			#Load new models from S3
 			load_models_from_s3(config=auto_load_config)
 
 		# Get CNN Models
-		self.models = dict()
+		models, paths = dict(), dict()
+		micro_batching = self.params.get("micro_batching", {})
+		intra_op, inter_op = get_session_threads(self.params.get("tf_threads", {}),
+			self.params.get("workers", 1))
 		models_dir = 'meerkat/classification/models/'
 		label_maps_dir = "meerkat/classification/label_maps/"
-		for filename in os.listdir(models_dir):
-			if filename.endswith('.ckpt') and not filename.startswith('train'):
-				temp = filename.split('.')[:-1]
-				if temp[-1][-1].isdigit():
-					key = '_'.join(temp[1:-1] + [temp[0], temp[-1], 'cnn'])
-				else:
-					key = '_'.join(temp[1:] + [temp[0], 'cnn'])
-				self.models[key] = get_tf_cnn_by_path(models_dir + filename, \
-					label_maps_dir + filename[:-4] + 'json', gpu_mem_fraction=gmf)
+		try:
+			for filename in os.listdir(models_dir):
+				if filename.endswith('.ckpt') and not filename.startswith('train'):
+					temp = filename.split('.')[:-1]
+					if temp[-1][-1].isdigit():
+						key = '_'.join(temp[1:-1] + [temp[0], temp[-1], 'cnn'])
+					else:
+						key = '_'.join(temp[1:] + [temp[0], 'cnn'])
+					paths[key] = models_dir + filename
+					models[key] = get_tf_cnn_by_path(models_dir + filename, \
+						label_maps_dir + filename[:-4] + 'json', gpu_mem_fraction=gmf,
+						intra_op_threads=intra_op, inter_op_threads=inter_op)
+					# Merge concurrent requests into larger batches, if enabled
+					if micro_batching.get("enabled", False):
+						models[key] = MicroBatcher(models[key],
+							max_batch_size=micro_batching.get("max_batch_size", 256),
+							max_wait=micro_batching.get("max_wait_ms", 2) / 1000.0, name=key)
+		except Exception:
+			for model in models.values():
+				close_model(model)
+			raise
+		return models, paths
+
+	@staticmethod
+	def __warm_up(model):
+		"""Run a model once, so the first request does not pay for it"""
+		model([{"description": "WARM UP TRANSACTION"}], label_only=False)
+
+	def __on_model_swap(self, model_set):
+		"""Outputs of the replaced models must not be served from the memo cache,
+		and the category rules are reloaded with them"""
+		self.category_rules = load_category_rules()
+		self.__model_generation += 1
+		if self.memo_cache is not None:
+			self.memo_cache.clear()
+
+	def model_info(self):
+		"""Return the generation of the loaded models and the path of each"""
+		model_set = self.model_registry.current
+		return {"generation": self.__model_generation, "version": model_set.version,
+			"models": dict(model_set.paths), "reloading": self.model_registry.reloading}
+
+	def stage_queue_depth(self):
+		"""Return the number of stages waiting for a thread"""
+		return get_queue_depth(self.__stage_pool)
 
 	def update_hyperparams(self, hyperparams):
 		"""Updates a WebConsumer object's hyper-parameters"""
 		self.hyperparams = hyperparams
+		# Cached search results depend on the hyper-parameters of their queries
+		if self.memo_cache is not None:
+			self.memo_cache.clear()
+
+	def __memo_get(self, stage, data, transactions, version=None):
+		"""Look up the output of stage for each transaction in the memo cache.
+		Returns the memo keys, or None when memoization is off, and the cached
+		values with None for every miss."""
+		if self.memo_cache is None or data is None:
+			return None, [None] * len(transactions)
+		generation, region = (self.__model_generation, version), data.get("cobrand_region")
+		keys = [(generation, data["container"], trans.get("ledger_entry"), region,
+			trans.get("description")) for trans in transactions]
+		return keys, [self.memo_cache.get(stage, key) for key in keys]
+
+	def __memo_put(self, stage, keys, values):
+		"""Cache the output of stage for each key"""
+		if keys is None:
+			return
+		for key, value in zip(keys, values):
+			self.memo_cache.put(stage, key, value)
+
+	def __memo_get_fields(self, stage, data, transactions, version=None):
+		"""Copy the fields cached for stage into each transaction found in the
+		memo cache. Returns the memo keys and the indices of the misses."""
+		keys, values = self.__memo_get(stage, data, transactions, version)
+		misses = []
+		for index, (trans, value) in enumerate(zip(transactions, values)):
+			if value is None:
+				misses.append(index)
+			else:
+				trans.update(value)
+		return keys, misses
+
+	def __memo_put_fields(self, stage, keys, transactions, misses, fields):
+		"""Cache the fields of the transactions missed by __memo_get_fields"""
+		if keys is None:
+			return
+		self.__memo_put(stage, [keys[index] for index in misses],
+			[tuple((field, transactions[index][field]) for field in fields
+			if field in transactions[index]) for index in misses])
 
 	def __get_query(self, transaction):
 		"""Create an optimized query"""
@@ -95,16 +293,12 @@ class WebConsumer():
 		result_size = self.hyperparams.get("es_result_size", "10")
 		fields = self.params["output"]["results"]["fields"]
 		locale_bloom = transaction["locale_bloom"]
-		transaction = string_cleanse(transaction["description"]).rstrip()
+		transaction = self.normalizer.query_string(transaction["description"])
 
 		# Input transaction must not be empty
-		if len(transaction) <= 2 and re.match('^[a-zA-Z0-9_]+$', transaction):
+		if transaction is None:
 			return
 
-		# Replace synonyms
-		transaction = synonyms(transaction)
-		transaction = string_cleanse(transaction)
-
 		# Construct Optimized Query
 		o_query = get_bool_query(size=result_size)
 		o_query["fields"] = fields
@@ -125,16 +319,40 @@ class WebConsumer():
 
 	def __search_index(self, queries):
 		"""Search against a structured index"""
+		if self.async_search is not None:
+			return self.async_search.search(queries)
 		index = self.params["elasticsearch"]["index"]
 		results = self.elastic_search.msearch(queries, index=index)
 		return results
-		#try:
-		#	# pull routing out of queries and append to below msearch
-		#	results = self.elastic_search.msearch(queries, index=index)
-		#except Exception as exception:
-		#	logging.warning(exception)
-		#	return None
-		#return results
+
+	def __cached_search(self, queries):
+		"""Search for a list of (header, query) pairs, sending only the distinct
+		queries missing from the search cache. Returns a response per query in
+		order, searches which failed or passed their deadline have an empty
+		response."""
+		responses = [None] * len(queries)
+		if self.search_cache is not None:
+			responses = [self.search_cache.get(header, query) for header, query in queries]
+		misses = [position for position, response in enumerate(responses) if response is None]
+		if len(misses) == 0:
+			return responses
+
+		# Send each distinct query once
+		bodies = dict()
+		for position in misses:
+			bodies.setdefault('\n'.join(map(json.dumps, queries[position])), []).append(position)
+		with self.metrics.timer("msearch", len(bodies)):
+			results = self.__search_index('\n'.join(bodies))
+		if results is None:
+			results = {"responses": [{} for _ in bodies]}
+
+		for positions, response in zip(bodies.values(), results['responses']):
+			for position in positions:
+				responses[position] = response
+			if self.search_cache is not None and "hits" in response:
+				header, query = queries[positions[0]]
+				self.search_cache.put(header, query, response)
+		return responses
 
 	@staticmethod
 	def __z_score_delta(scores):
@@ -167,6 +385,9 @@ class WebConsumer():
 			transaction = self.__no_result(transaction)
 			return transaction
 
+		# Cached responses are shared, so enrich a copy of the fields
+		hit_fields = dict(hit_fields)
+
 		# Elasticsearch v1.0 bug workaround
 		if top_hit["_source"].get("pin", "") != "":
 			coordinates = top_hit["_source"]["pin"]["location"]["coordinates"]
@@ -212,17 +433,11 @@ class WebConsumer():
 	def __no_result(self, transaction):
 		"""Make sure transactions have proper attribute names"""
 
-		params = self.params
-		fields = params["output"]["results"]["fields"]
-		labels = params["output"]["results"]["labels"]
-		attr_map = dict(zip(fields, labels))
-
-		for field in fields:
-			transaction[attr_map.get(field, field)] = ""
+		transaction.update(self.__empty_result)
 
 		transaction["match_found"] = False
 		# Add fields required
-		if transaction["country"] == "":
+		if transaction.get("country", "") == "":
 			transaction["country"] = "US"
 		transaction["source"] = "FACTUAL"
 		transaction["confidence_score"] = ""
@@ -241,23 +456,19 @@ class WebConsumer():
 		state_names = argv[5]
 
 		params = self.params
-		field_names = params["output"]["results"]["fields"]
-		fields_in_hit = [field for field in hit_fields]
+		attr_map, name_label = self.__attr_map, self.__name_label
 		transaction["match_found"] = False
 
-		# Collect Mapping Details
-		attr_map = dict(zip(params["output"]["results"]["fields"], params["output"]["results"]["labels"]))
-
 		# Enrich with found data
 		if decision is True:
 			transaction["match_found"] = True
-			for field in field_names:
-				if field in fields_in_hit:
+			for field, label in self.__output_fields:
+				if field in hit_fields:
 					field_content = hit_fields[field][0] if isinstance(hit_fields[field],\
  						(list)) else str(hit_fields[field])
-					transaction[attr_map.get(field, field)] = field_content
+					transaction[label] = field_content
 				else:
-					transaction[attr_map.get(field, field)] = ""
+					transaction[label] = ""
 
 			if not transaction.get("country") or transaction["country"] == "":
 				logging.warning(("Factual response for merchant {} has no country code. "
@@ -265,16 +476,15 @@ class WebConsumer():
 				transaction["country"] = "US"
 		# Add Business Name, City and State as a fallback
 		if decision is False:
-			for field in field_names:
-				transaction[attr_map.get(field, field)] = ""
+			transaction.update(self.__empty_result)
 			transaction = self.__business_name_fallback(business_names, transaction, attr_map)
 			transaction = self.__geo_fallback(city_names, state_names, transaction, attr_map)
 			#Ensuring that there is a country code that matches the schema limitation
 			transaction["country"] = "US"
 
 		# Ensure Proper Casing
-		if transaction[attr_map['name']] == transaction[attr_map['name']].upper():
-			transaction[attr_map['name']] = string.capwords(transaction[attr_map['name']], " ")
+		if transaction[name_label] == transaction[name_label].upper():
+			transaction[name_label] = string.capwords(transaction[name_label], " ")
 
 		# Add Source
 		index = params["elasticsearch"]["index"]
@@ -342,12 +552,7 @@ class WebConsumer():
 
 	def __apply_category(self, transactions):
 		"""Fix category_labels with category_cnn"""
-		json_obj = open('meerkat/web_service/config/category.json')
-		json_data = json.loads(json_obj.read())
-		bank_credit = json_data['bank_credit']
-		card_credit = json_data['card_credit']
-		bank_debit = json_data['bank_debit']
-		card_debit = json_data['card_debit']
+		rules = self.category_rules
 
 		for trans in transactions:
 			try:
@@ -358,17 +563,8 @@ class WebConsumer():
 				else:
 					category = 'Other Expenses'
 
-			if trans['ledger_entry'] == 'credit' and trans['container'] == 'bank' and \
-				category in bank_credit:
-				self.__apply_category_with_merchant(trans)
-			elif trans['ledger_entry'] == 'credit' and trans['container'] == 'card' and \
-				category in card_credit:
-				self.__apply_category_with_merchant(trans)
-			elif trans['ledger_entry'] == 'debit' and trans['container'] == 'bank' and \
-				category not in bank_debit:
-				self.__apply_category_with_merchant(trans)
-			elif trans['ledger_entry'] == 'debit' and trans['container'] == 'card' and \
-				category not in card_debit:
+			rule = rules.get((trans['ledger_entry'], trans['container']))
+			if rule is not None and (category in rule[0]) == rule[1]:
 				self.__apply_category_with_merchant(trans)
 			else:
 				trans['CNN'] = trans.get('CNN', {}).get('label', '')
@@ -381,62 +577,26 @@ class WebConsumer():
 	def ensure_output_schema(self, transactions, debug):
 		"""Clean output to proper schema"""
 
-		# Collect Mapping Details
-		fields = self.params["output"]["results"]["fields"]
-		labels = self.params["output"]["results"]["labels"]
-		attr_map = dict(zip(fields, labels))
+		name_label = self.__name_label
 
 		# Override / Strip Fields
 		for trans in transactions:
 			if trans["is_physical_merchant"]:
-				trans["chain_name"] = trans.get("chain_name", "")
-				trans["confidence_score"] = trans.get("confidence_score", "")
-				trans["country"] = trans.get("country", "")
-				trans["fax_number"] = trans.get("fax_number", "")
-				trans["latitude"] = trans.get("latitude", "")
-				trans["longitude"] = trans.get("longitude", "")
-				trans["match_found"] = trans.get("match_found", False)
-				trans["neighbourhood"] = trans.get("neighbourhood", "")
-				trans["phone_number"] = trans.get("phone_number", "")
-				trans["postal_code"] = trans.get("postal_code", "")
-				trans["source"] = trans.get("source", "OTHER")
-				trans["source_merchant_id"] = trans.get("source_merchant_id", "")
-				trans["store_id"] = trans.get("store_id", "")
-				trans["street"] = trans.get("street", "")
-				trans["txn_sub_type"] = trans.get("txn_sub_type", "")
-				trans["txn_type"] = trans.get("txn_type", "")
-				trans["website"] = trans.get("website", "")
-
-			trans["city"] = trans.get("city", "")
-			trans["state"] = trans.get("state", "")
-			trans["transaction_id"] = trans.get("transaction_id", None)
-			trans["is_physical_merchant"] = trans.get("is_physical_merchant", "")
-			trans["merchant_name"] = trans.get("merchant_name", "")
-			trans["txn_sub_type"] = trans.get("txn_sub_type", "")
-			trans["txn_type"] = trans.get("txn_type", "")
+				for key, default in PHYSICAL_OUTPUT_DEFAULTS:
+					trans.setdefault(key, default)
+			for key, default in OUTPUT_DEFAULTS:
+				trans.setdefault(key, default)
 
 			if debug and trans.get("is_physical_merchant", None):
-				trans["search"]["merchant_name"] = trans["merchant_name"]
-				trans["search"]["street"] = trans["street"]
-				trans["search"]["city"] = trans["city"]
-				trans["search"]["country"] = trans["country"]
-				trans["search"]["state"] = trans["state"]
-				trans["search"]["postal_code"] = trans["postal_code"]
-				trans["search"]["source_merchant_id"] = trans["source_merchant_id"]
-				trans["search"]["store_id"] = trans["store_id"]
-				trans["search"]["latitude"] = trans["latitude"]
-				trans["search"]["longitude"] = trans["longitude"]
-				trans["search"]["website"] = trans["website"]
-				trans["search"]["phone_number"] = trans["phone_number"]
-				trans["search"]["fax_number"] = trans["fax_number"]
-				trans["search"]["chain_name"] = trans["chain_name"]
-				trans["search"]["neighbourhood"] = trans["neighbourhood"]
+				search = trans["search"]
+				for key in DEBUG_SEARCH_FIELDS:
+					search[key] = trans[key]
 			else:
 				trans.pop("search", None)
 
 			# Override output with CNN v1
 			if trans.get("CNN", "") != "":
-				trans[attr_map["name"]] = trans.get("CNN", "")
+				trans[name_label] = trans.get("CNN", "")
 
 			# Override Locale with Bloom Results
 			# Add city and state to each transaction
@@ -460,71 +620,63 @@ class WebConsumer():
 					"category_score" : trans.get("category_score", "0.0")
 					}
 
-			trans.pop("locale_bloom", None)
-			trans.pop("description", None)
-			trans.pop("amount", None)
-			trans.pop("date", None)
-			trans.pop("ledger_entry", None)
-			trans.pop("CNN", None)
-			trans.pop("container", None)
-			trans.pop("category_CNN", None)
-			trans.pop("merchant_score", None)
-			trans.pop("subtype_score", None)
-			trans.pop("category_score", None)
+			for key in INTERNAL_FIELDS:
+				trans.pop(key, None)
 
 		# return transactions
 
 	def __enrich_physical(self, transactions):
-		"""Enrich physical transactions with Meerkat"""
+		"""Enrich physical transactions with Meerkat. Responses are cached by
+		query and index version in the search cache, not in the memo cache,
+		since the query also depends on locale_bloom."""
 		if len(transactions) == 0:
 			return transactions
 
 		enriched, queries = [], []
 		index = self.params["elasticsearch"]["index"]
 
-		for trans in transactions:
-			query = self.__get_query(trans)
-
-			header = {"index": index}
-			# add routing to header
-			if self.params["routed"] and trans.get("locale_bloom", None):
-				region = trans["locale_bloom"][1]
-				header["routing"] = region.upper()
+		with self.metrics.timer("es_query_build", len(transactions)):
+			for trans in transactions:
+				query = self.__get_query(trans)
 
-			queries.append(header)
-			queries.append(query)
+				header = {"index": index}
+				# add routing to header
+				if self.params["routed"] and trans.get("locale_bloom", None):
+					region = trans["locale_bloom"][1]
+					header["routing"] = region.upper()
 
-		queries = '\n'.join(map(json.dumps, queries))
-		results = self.__search_index(queries)
-
-		# Error Handling
-		if results is None:
-			return transactions
+				queries.append((header, query))
 
-		results = results['responses']
-
-		for result, transaction in zip(results, transactions):
+		for result, transaction in zip(self.__cached_search(queries), transactions):
 			trans_plus = self.__process_results(result, transaction)
 			enriched.append(trans_plus)
 
 		return enriched
 
-	@staticmethod
-	def __sws(data):
+	def __sws(self, data):
 		"""Split transactions into physical and non-physical"""
 		physical, non_physical = [], []
+		transactions = data["transaction_list"]
+		keys, misses = self.__memo_get_fields("sws", data, transactions)
 
-		# Determine Whether to Search
-		for trans in data["transaction_list"]:
-			classifier = BANK_SWS if (data["container"] == "bank") else CARD_SWS
-			label = classifier(trans["description"])
-			trans["is_physical_merchant"] = True if (label == "1") else False
-			(non_physical, physical)[label == "1"].append(trans)
+		# Determine Whether to Search, one predict call per container
+		classifier = BANK_SWS if (data["container"] == "bank") else CARD_SWS
+		with self.metrics.timer("sws", len(misses)):
+			labels = classifier([transactions[index]["description"] for index in misses])
+
+		for index, label in zip(misses, labels):
+			transactions[index]["is_physical_merchant"] = True if (label == "1") else False
+		self.__memo_put_fields("sws", keys, transactions, misses, ["is_physical_merchant"])
+
+		for trans in transactions:
+			(non_physical, physical)[trans["is_physical_merchant"]].append(trans)
 
 		return physical, non_physical
 
-	def __apply_merchant_cnn(self, data):
+	def __apply_merchant_cnn(self, data, encoded=None, model_set=None):
 		"""Apply the merchant CNN to transactions"""
+		model_set = model_set or self.model_registry.current
+		models = model_set.models
 
 		if "cobrand_region" in data:
 			region = 'region_' + str(data["cobrand_region"])
@@ -533,19 +685,29 @@ class WebConsumer():
 
 		classifier = None
 		if data["container"] == "bank":
-			if 'bank_merchant_' + region + '_cnn' not in self.models:
-				classifier = self.models['bank_merchant_cnn']
+			if 'bank_merchant_' + region + '_cnn' not in models:
+				classifier = models['bank_merchant_cnn']
 			else:
-				classifier = self.models['bank_merchant_' + region + '_cnn']
+				classifier = models['bank_merchant_' + region + '_cnn']
 		else:
-			if 'card_merchant_' + region + '_cnn' not in self.models:
-				classifier = self.models['card_merchant_cnn']
+			if 'card_merchant_' + region + '_cnn' not in models:
+				classifier = models['card_merchant_cnn']
 			else:
-				classifier = self.models['card_merchant_' + region + '_cnn']
-		return classifier(data["transaction_list"], label_only=False)
+				classifier = models['card_merchant_' + region + '_cnn']
+		if encoded is None:
+			encoded = EncodedBatch(data["transaction_list"])
+		keys, misses = self.__memo_get_fields("merchant_cnn", data, data["transaction_list"],
+			model_set.version)
+		if len(misses) > 0:
+			classifier(encoded.subset(misses), label_only=False)
+		self.__memo_put_fields("merchant_cnn", keys, data["transaction_list"], misses,
+			["CNN", "merchant_score"])
+		return data["transaction_list"]
 
-	def __apply_subtype_cnn(self, data):
+	def __apply_subtype_cnn(self, data, encoded=None, model_set=None):
 		"""Apply the subtype CNN to transactions"""
+		model_set = model_set or self.model_registry.current
+		models = model_set.models
 
 		if len(data["transaction_list"]) == 0:
 			return data["transaction_list"]
@@ -556,38 +718,45 @@ class WebConsumer():
 			region = 'default'
 
 		if data["container"] == "card":
-			if 'card_credit_subtype_' + region + '_cnn' not in self.models:
-				credit_subtype_classifer = self.models['card_credit_subtype_cnn']
+			if 'card_credit_subtype_' + region + '_cnn' not in models:
+				credit_subtype_classifer = models['card_credit_subtype_cnn']
 			else:
-				credit_subtype_classifer = self.models['card_credit_subtype_' + region + '_cnn']
-			if 'card_debit_subtype_' + region + '_cnn' not in self.models:
-				debit_subtype_classifer = self.models['card_debit_subtype_cnn']
+				credit_subtype_classifer = models['card_credit_subtype_' + region + '_cnn']
+			if 'card_debit_subtype_' + region + '_cnn' not in models:
+				debit_subtype_classifer = models['card_debit_subtype_cnn']
 			else:
-				debit_subtype_classifer = self.models['card_debit_subtype_' + region + '_cnn']
+				debit_subtype_classifer = models['card_debit_subtype_' + region + '_cnn']
 		elif data["container"] == "bank":
-			if 'bank_credit_subtype_' + region + '_cnn' not in self.models:
-				credit_subtype_classifer = self.models['bank_credit_subtype_cnn']
+			if 'bank_credit_subtype_' + region + '_cnn' not in models:
+				credit_subtype_classifer = models['bank_credit_subtype_cnn']
 			else:
-				credit_subtype_classifer = self.models['bank_credit_subtype_' + region + '_cnn']
-			if 'bank_debit_subtype_' + region + '_cnn' not in self.models:
-				debit_subtype_classifer = self.models['bank_debit_subtype_cnn']
+				credit_subtype_classifer = models['bank_credit_subtype_' + region + '_cnn']
+			if 'bank_debit_subtype_' + region + '_cnn' not in models:
+				debit_subtype_classifer = models['bank_debit_subtype_cnn']
 			else:
-				debit_subtype_classifer = self.models['bank_debit_subtype_' + region + '_cnn']
+				debit_subtype_classifer = models['bank_debit_subtype_' + region + '_cnn']
 
-		# Split transactions into groups
+		# Split transactions into groups, sharing the encoded tensor
+		if encoded is None:
+			encoded = EncodedBatch(data["transaction_list"])
 		credit, debit = [], []
+		keys, misses = self.__memo_get_fields("subtype_cnn", data, data["transaction_list"],
+			model_set.version)
 
-		for transaction in data["transaction_list"]:
+		for index in misses:
+			transaction = data["transaction_list"][index]
 			if transaction["ledger_entry"] == "credit":
-				credit.append(transaction)
+				credit.append(index)
 			if transaction["ledger_entry"] == "debit":
-				debit.append(transaction)
+				debit.append(index)
 
 		# Apply classifiers
 		if len(credit) > 0:
-			credit_subtype_classifer(credit, label_key="subtype_CNN", label_only=False)
+			credit_subtype_classifer(encoded.subset(credit), label_key="subtype_CNN", label_only=False)
 		if len(debit) > 0:
-			debit_subtype_classifer(debit, label_key="subtype_CNN", label_only=False)
+			debit_subtype_classifer(encoded.subset(debit), label_key="subtype_CNN", label_only=False)
+		self.__memo_put_fields("subtype_cnn", keys, data["transaction_list"], misses,
+			["subtype_CNN", "subtype_score"])
 
 		# Split label into type and subtype
 		for transaction in data["transaction_list"]:
@@ -611,8 +780,10 @@ class WebConsumer():
 
 		return data["transaction_list"]
 
-	def __apply_category_cnn(self, data):
+	def __apply_category_cnn(self, data, encoded=None, model_set=None):
 		"""Apply the category CNN to transactions"""
+		model_set = model_set or self.model_registry.current
+		models = model_set.models
 
 		if len(data["transaction_list"]) == 0:
 			return data["transaction_list"]
@@ -623,38 +794,45 @@ class WebConsumer():
 			region = 'default'
 
 		if data["container"] == "card":
-			if 'card_credit_category_' + region + '_cnn' not in self.models:
-				credit_category_classifer = self.models['card_credit_category_cnn']
+			if 'card_credit_category_' + region + '_cnn' not in models:
+				credit_category_classifer = models['card_credit_category_cnn']
 			else:
-				credit_category_classifer = self.models['card_credit_category_' + region + '_cnn']
-			if 'card_debit_category_' + region + '_cnn' not in self.models:
-				debit_category_classifer = self.models['card_debit_category_cnn']
+				credit_category_classifer = models['card_credit_category_' + region + '_cnn']
+			if 'card_debit_category_' + region + '_cnn' not in models:
+				debit_category_classifer = models['card_debit_category_cnn']
 			else:
-				debit_category_classifer = self.models['card_debit_category_' + region + '_cnn']
+				debit_category_classifer = models['card_debit_category_' + region + '_cnn']
 		elif data["container"] == "bank":
-			if 'bank_credit_category_' + region + '_cnn' not in self.models:
-				credit_category_classifer = self.models['bank_credit_category_cnn']
+			if 'bank_credit_category_' + region + '_cnn' not in models:
+				credit_category_classifer = models['bank_credit_category_cnn']
 			else:
-				credit_category_classifer = self.models['bank_credit_category_' + region + '_cnn']
-			if 'bank_debit_category_' + region + '_cnn' not in self.models:
-				debit_category_classifer = self.models['bank_debit_category_cnn']
+				credit_category_classifer = models['bank_credit_category_' + region + '_cnn']
+			if 'bank_debit_category_' + region + '_cnn' not in models:
+				debit_category_classifer = models['bank_debit_category_cnn']
 			else:
-				debit_category_classifer = self.models['bank_debit_category_' + region + '_cnn']
+				debit_category_classifer = models['bank_debit_category_' + region + '_cnn']
 
-		# Split transactions into groups
+		# Split transactions into groups, sharing the encoded tensor
+		if encoded is None:
+			encoded = EncodedBatch(data["transaction_list"])
 		credit, debit = [], []
+		keys, misses = self.__memo_get_fields("category_cnn", data, data["transaction_list"],
+			model_set.version)
 
-		for transaction in data["transaction_list"]:
+		for index in misses:
+			transaction = data["transaction_list"][index]
 			if transaction["ledger_entry"] == "credit":
-				credit.append(transaction)
+				credit.append(index)
 			if transaction["ledger_entry"] == "debit":
-				debit.append(transaction)
+				debit.append(index)
 
 		# Apply classifiers
 		if len(credit) > 0:
-			credit_category_classifer(credit, label_key="category_CNN", label_only=False)
+			credit_category_classifer(encoded.subset(credit), label_key="category_CNN", label_only=False)
 		if len(debit) > 0:
-			debit_category_classifer(debit, label_key="category_CNN", label_only=False)
+			debit_category_classifer(encoded.subset(debit), label_key="category_CNN", label_only=False)
+		self.__memo_put_fields("category_cnn", keys, data["transaction_list"], misses,
+			["category_CNN", "category_score"])
 
 		refund_transactions = []
 
@@ -673,15 +851,16 @@ class WebConsumer():
 
 		return data["transaction_list"]
 
-	@staticmethod
-	def __apply_locale_bloom(data):
+	def __apply_locale_bloom(self, data):
 		""" Apply the locale bloom filter to transactions"""
-		for trans in data["transaction_list"]:
-			try:
-				description = trans["description"]
-				trans["locale_bloom"] = location_split(description)
-			except KeyError:
-				pass
+		transactions = [trans for trans in data["transaction_list"] if "description" in trans]
+		keys, misses = self.__memo_get_fields("locale_bloom", data, transactions)
+		with self.metrics.timer("locale_bloom", len(misses)):
+			locations = location_split_batch([transactions[index]["description"]
+				for index in misses])
+		for index, location in zip(misses, locations):
+			transactions[index]["locale_bloom"] = location
+		self.__memo_put_fields("locale_bloom", keys, transactions, misses, ["locale_bloom"])
 
 		return data["transaction_list"]
 
@@ -737,17 +916,66 @@ class WebConsumer():
 			physical = self.__enrich_physical_no_search(physical)
 		return physical, non_physical
 
-	def classify(self, data, optimizing=False):
-		"""Classify a set of transactions"""
-		services_list = data.get("services_list", [])
+	def classify(self, data, optimizing=False, timings=None):
+		"""Classify a set of transactions. The CPU bound classifiers and each
+		CNN run concurrently as independent stages, and large requests are
+		split into shards which run concurrently too; if a timings dict is
+		provided it is filled with the wall-time of each stage in seconds."""
+		# Every CNN of a request uses the same models, even during a swap
+		with self.model_registry.acquire() as model_set:
+			return self.__classify(data, optimizing, timings, model_set)
+
+	def __classify(self, data, optimizing, timings, model_set):
+		"""Classify a set of transactions with one set of models"""
 		debug = data.get("debug", False)
+		batch_size = len(data["transaction_list"])
+		start = time.perf_counter()
 
-		cpu_result = self.__cpu_pool.apply_async(self.__apply_cpu_classifiers, (data, ))
+		shards = get_shards(data["transaction_list"], self.shard_size, self.max_shards)
+		if len(shards) == 1:
+			self.__run_stages(data, optimizing, timings, model_set)
+		else:
+			# Every shard runs its stages at once, results keep the order of the request
+			shard_data = [dict(data, transaction_list=shard) for shard in shards]
+			shard_timings = [dict() for _ in shards]
+			futures = [self.__shard_pool.submit(self.__run_stages, shard, optimizing,
+				shard_timing, model_set) for shard, shard_timing in zip(shard_data, shard_timings)]
+			for future in futures:
+				future.result()
+			data["transaction_list"] = [trans for shard in shard_data
+				for trans in shard["transaction_list"]]
+			if timings is not None:
+				for shard_timing in shard_timings:
+					for stage, seconds in shard_timing.items():
+						timings[stage] = max(timings.get(stage, 0.0), seconds)
 
 		if not optimizing:
+			with self.metrics.timer("apply_category", batch_size):
+				self.__apply_category(data["transaction_list"])
+
+		with self.metrics.timer("ensure_output_schema", batch_size):
+			self.ensure_output_schema(data["transaction_list"], debug)
+
+		self.metrics.observe("classify", time.perf_counter() - start, batch_size)
+		return data
+
+	def __run_stages(self, data, optimizing, timings, model_set):
+		"""Run the classifiers of a request, or of one shard of it, as
+		concurrent stages"""
+		services_list = data.get("services_list", [])
+		batch_size = len(data["transaction_list"])
+
+		scheduler = StageScheduler(self.__stage_pool)
+		scheduler.add("cpu", self.__apply_cpu_classifiers, data)
+
+		if not optimizing:
+			# Encode descriptions once for every CNN
+			encoded = EncodedBatch(data["transaction_list"])
+
 			# Apply Subtype CNN
 			if "cnn_subtype" in services_list or services_list == []:
-				self.__apply_subtype_cnn(data)
+				scheduler.add("subtype_cnn", self.__apply_subtype_cnn, data, encoded,
+					model_set)
 			else:
 				# Add the filed to ensure output schema pass
 				for transaction in data["transaction_list"]:
@@ -756,20 +984,21 @@ class WebConsumer():
 
 			# Apply Category CNN
 			if "cnn_category" in services_list or "cnn_subtype" in services_list or services_list == []:
-				self.__apply_category_cnn(data)
+				scheduler.add("category_cnn", self.__apply_category_cnn, data, encoded,
+					model_set)
 
 			# Apply Merchant CNN
 			if "cnn_merchant" in services_list or services_list == []:
-				self.__apply_merchant_cnn(data)
-
-		cpu_result.get() # Wait for CPU bound classifiers to finish
-
-		if not optimizing:
-			self.__apply_category(data["transaction_list"])
-
-		self.ensure_output_schema(data["transaction_list"], debug)
-
-		return data
+				scheduler.add("merchant_cnn", self.__apply_merchant_cnn, data, encoded,
+					model_set)
+
+		# Wait for every stage to finish
+		scheduler.run()
+		logging.debug("Stage timings: {0}".format(scheduler.timings))
+		if timings is not None:
+			timings.update(scheduler.timings)
+		for stage, seconds in scheduler.timings.items():
+			self.metrics.observe(stage, seconds, batch_size)
 
 if __name__ == "__main__":
 	# Print a warning to not execute this file as a module
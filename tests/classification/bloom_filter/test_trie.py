@@ -1,6 +1,12 @@
 """Unit tests for meerkat.classification.bloom_filter.trie"""
 
+import logging
+import os
+import shutil
 import sys
+import tempfile
+import threading
+import time
 import unittest
 
 import meerkat.classification.bloom_filter.trie as trie
@@ -102,6 +108,156 @@ class TrieTests(unittest.TestCase):
 		result = trie.location_split(my_text)
 		self.assertEqual(expected, result)
 
+	def test_location_split_batch(self):
+		"""location_split_batch returns the location_split result of every
+		description in order, locating repeated descriptions once"""
+		descriptions = ["CHICAGO PIZZA SAN JOSE CA", "CANDLESTICK PARK FAKE CITY CA SHIRT",
+			"Debit Card Purchase LA MICHOACANA # 26 IRVING TX", "CHICAGO PIZZA SAN JOSE CA",
+			"NewYork,NYisthemostpopulouscityintheUS", "", "CHICAGO PIZZA SAN JOSE CA"]
+		calls = []
+		original = trie.location_split
+		def counting_location_split(description):
+			calls.append(description)
+			return original(description)
+		trie.location_split = counting_location_split
+		try:
+			result = trie.location_split_batch(descriptions)
+		finally:
+			trie.location_split = original
+		self.assertEqual([original(description) for description in descriptions], result)
+		self.assertEqual(5, len(calls))
+		self.assertEqual([], trie.location_split_batch([]))
+
+	def test_standardize_and_beginning_indices(self):
+		"""standardize and get_beginning_indices strip punctuation and every
+		kind of whitespace"""
+		text = "O'Reilly\u00a0Auto-Parts,\tSAN  JOSE CA"
+		self.assertEqual("OREILLYAUTOPARTSSANJOSECA", trie.standardize(text))
+		self.assertEqual([0, 7, 11, 16, 19, 23, 25], trie.get_beginning_indices(text))
+		self.assertEqual("CA", trie.get_word([0, 7, 11, 16, 19, 23, 25],
+			trie.standardize(text), 23))
+
+	def test_state_words_loaded_once(self):
+		"""location_split uses the exclusion words loaded at import instead of
+		reading words_start_with_states.json on every call"""
+		original = trie.load_params
+		trie.load_params = None
+		try:
+			result = trie.location_split("PAYMENT PARK CITY UT CARD")
+		finally:
+			trie.load_params = original
+		self.assertEqual(("Park City", "UT"), result)
+		self.assertTrue(isinstance(trie.STATE_WORDS["CA"], frozenset))
+		self.assertTrue("CARD" in trie.STATE_WORDS["CA"])
+
+	def test_compact_trie_benchmark(self):
+		"""Compare memory and lookup time of the CompactTrie against a Trie built
+		from the same files, and check both give identical matches"""
+		old_trie, _ = trie.build_trie(trie.CITIES_FILE, trie.LOCATIONS_FILE)
+		compact = trie.get_geo_index().trie
+
+		# Estimate the resident size of each representation
+		old_size, stack = 0, [old_trie.root]
+		while stack:
+			node = stack.pop()
+			old_size += sys.getsizeof(node) + sys.getsizeof(node.__dict__) +\
+				sys.getsizeof(node.children)
+			stack.extend(node.children.values())
+		compact_size = sum(sys.getsizeof(part) for part in [compact.labels, compact.starts,
+			compact.parents, compact.words, compact.states])
+
+		words = ["CASANFRANCISCO", "CASANFRAN....", "NYNEWYORKCITY", "NYNEWYO....",
+			"TXIRVING", "TXFAKECITY", "NJUNION....", "CASANJ", "CA....", "NY"] * 500
+		start = time.time()
+		old_results = [old_trie.search(word) for word in words]
+		old_time = time.time() - start
+		start = time.time()
+		compact_results = [compact.search(word) for word in words]
+		compact_time = time.time() - start
+
+		logging.warning("Trie: {0:.1f} MB, {1:.1f} us/search; CompactTrie: {2:.1f} MB, "
+			"{3:.1f} us/search".format(old_size / 1e6, old_time / len(words) * 1e6,
+			compact_size / 1e6, compact_time / len(words) * 1e6))
+		self.assertEqual(old_results, compact_results)
+		self.assertLess(compact_size, old_size)
+
+	def test_geo_index_round_trip(self):
+		"""A saved GeoIndex memory-maps back with identical searches and cities"""
+		geo_index = trie.get_geo_index()
+		tmp_dir = tempfile.mkdtemp()
+		filename = os.path.join(tmp_dir, "geo_index.bin")
+		geo_index.save(filename)
+		try:
+			loaded = trie.GeoIndex.load(filename)
+			for place in ["CASANFRANCISCO", "NYNEWYORKCITY", "TXIRVING", "CASANFRAN....", "CAX"]:
+				self.assertEqual(geo_index.trie.search(place), loaded.trie.search(place))
+				self.assertEqual(geo_index.get(place), loaded.get(place))
+			for text in ["PIZZASANFRANCISCOCA", "LAMICHOACANA26IRVINGTX", "FAKECITYCA"]:
+				self.assertEqual(geo_index.reverse.longest_reverse_match(text[-2:],
+					trie.encode_label(text), len(text) - 2, 3),
+					loaded.reverse.longest_reverse_match(text[-2:], trie.encode_label(text),
+					len(text) - 2, 3))
+			self.assertEqual(loaded["NYNEWYORKCITY"], ("New York", "NY"))
+			self.assertFalse("CAX" in loaded)
+		finally:
+			shutil.rmtree(tmp_dir)
+
+	def test_get_geo_index_builds_once(self):
+		"""Threads asking for a missing GeoIndex at once share a single build"""
+		tmp_dir = tempfile.mkdtemp()
+		filename = os.path.join(tmp_dir, "geo_index.bin")
+		builds, build_geo_index = [], trie.build_geo_index
+		def counting_build(**kwargs):
+			builds.append(threading.get_ident())
+			return build_geo_index(**kwargs)
+		trie.build_geo_index = counting_build
+		try:
+			threads = [threading.Thread(target=trie.get_geo_index, args=(filename,))
+				for _ in range(4)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			self.assertEqual(len(builds), 1)
+			self.assertEqual(trie.get_geo_index(filename)["NYNEWYORKCITY"], ("New York", "NY"))
+		finally:
+			trie.build_geo_index = build_geo_index
+			trie.GEO_INDEXES.pop(filename, None)
+			shutil.rmtree(tmp_dir)
+
+	def test_get_biggest_match_benchmark(self):
+		"""Compare the single-pass get_biggest_match against probing the trie
+		once per start position, and check both give identical matches"""
+		def probe_biggest_match(my_string, use_wildcards=False):
+			"""The original matcher, one trie search per start position"""
+			if len(my_string) < 5:
+				return None
+			state, biggest = my_string[-2:], None
+			suffix, min_length = ("....", 10) if use_wildcards else ("", 5)
+			for i in range(len(my_string) - min_length, -1, -1):
+				place = compact.search(state + my_string[i:-2] + suffix)
+				if place:
+					biggest = place
+			return biggest
+
+		compact = trie.get_geo_index().trie
+		texts = ["CANDLESTICKPARKSANFRANCISCOCA", "CHICAGOPIZZASANJOSECA",
+			"DEBITCARDPURCHASELAMICHOACANA26IRVINGTX", "ANEWYORKERWASBORNINYORKNY",
+			"ANDYBOUGHTACARINNEWYORKCITYNY", "CANDLESTICKPARKFAKECITYCA", "PAYMENTCA",
+			"CHECKCARD0412SANFRANCISCA", "NY"] * 200
+		for use_wildcards in [False, True]:
+			start = time.time()
+			old_results = [probe_biggest_match(text, use_wildcards) for text in texts]
+			old_time = time.time() - start
+			start = time.time()
+			new_results = [trie.get_biggest_match(text, use_wildcards) for text in texts]
+			new_time = time.time() - start
+
+			logging.warning("get_biggest_match wildcards={0}: {1:.0f} matches/s probing, "
+				"{2:.0f} matches/s single-pass".format(use_wildcards, len(texts) / old_time,
+				len(texts) / new_time))
+			self.assertEqual(old_results, new_results)
+
 if __name__ == "__main__":
 	unittest.main()
 	sys.exit()
@@ -1,5 +1,5 @@
 """Fixture for test_load_model module"""
-from meerkat.various_tools import load_params
+from meerkat.various_tools import load_params, load_dict_list
 
 def get_trans():
 	"""Return trans that contain single transaction"""
@@ -14,3 +14,8 @@ def get_class_size():
 	"""Return number of labels for subtype bank debit"""
 	return len(load_params("meerkat/classification/label_maps/subtype.bank.debit.json"))
 
+
+def get_sws_descriptions(repeat=5):
+	"""Return a list of bank descriptions used to benchmark the SWS classifier"""
+	transactions = load_dict_list("data/input/100_Bank_Transactions.txt")
+	return [trans["DESCRIPTION_UNMASKED"] for trans in transactions] * repeat
@@ -1,5 +1,7 @@
 """Unit test for meerkat/classification/load_model"""
 
+import logging
+import time
 import unittest
 import meerkat.classification.load_model as load_model
 
@@ -26,3 +28,22 @@ class LoadModelTests(unittest.TestCase):
 		else:
 			with self.assertRaises(KeyError):
 				apply_cnn(trans)
+
+	def test_scikit_model_batch(self):
+		"""Micro-benchmark per-item against batched SWS classification, labels must agree"""
+		descriptions = fixture.get_sws_descriptions()
+		classifier = load_model.load_scikit_model("bank_sws")
+		batch_classifier = load_model.load_scikit_model("bank_sws", batch=True)
+
+		start = time.time()
+		single_labels = [classifier(description) for description in descriptions]
+		single_time = time.time() - start
+
+		start = time.time()
+		batch_labels = list(batch_classifier(descriptions))
+		batch_time = time.time() - start
+
+		logging.warning("SWS per-item: {0:.0f} trans/sec, batched: {1:.0f} trans/sec".format(
+			len(descriptions) / single_time, len(descriptions) / batch_time))
+		self.assertEqual(single_labels, batch_labels)
+		self.assertEqual(len(batch_classifier([])), 0)
@@ -202,6 +202,31 @@ class ToolsTests(unittest.TestCase):
 		result = tools.string_to_tensor(config, doc, length)
 		np.testing.assert_array_equal(result, expected_tensor)
 
+	@parameterized.expand([
+		([tools_fixture.get_config(), ["aab", "", "Ab?c ÉÉ", "kkk"], 4]),
+		([tools_fixture.get_config(), ["aab", "abccccccccc"], 2])
+	])
+	def test_strings_to_tensor(self, config, docs, length):
+		"""Test strings_to_tensor matches a transposed stack of string_to_tensor"""
+		expected = np.array([[tools.string_to_tensor(config, doc, length).T] for doc in docs])
+		result = tools.strings_to_tensor(config, docs, length)
+		self.assertEqual(result.dtype, np.float32)
+		self.assertEqual(result.shape, (len(docs), 1, length, len(config["alphabet"])))
+		np.testing.assert_array_equal(result, expected)
+
+	def test_encoded_batch_subset(self):
+		"""Test EncodedBatch subsets slice the shared tensor of their parent"""
+		config = tools_fixture.get_config()
+		config["doc_length"] = 4
+		trans = [{"description": "aab"}, {"description": "xyz"}, {"description": "b"}]
+		encoded = tools.EncodedBatch(trans)
+		subset = encoded.subset([2, 0])
+		self.assertEqual(list(subset), [trans[2], trans[0]])
+		self.assertEqual(len(subset), 2)
+		full = encoded.get_tensor(config)
+		self.assertIs(encoded.get_tensor(config), full)
+		np.testing.assert_array_equal(subset.get_tensor(config), full[[2, 0]])
+
 if __name__ == '__main__':
 	unittest.main()
 
@@ -14,6 +14,8 @@ def create_parser():
 	"""Creates an argparse parser."""
 	parser = argparse.ArgumentParser()
 	parser.add_argument("configuration_file")
+	parser.add_argument("--search_cache_dir", default=None)
+	parser.add_argument("--web_service_config", default=loader.WEB_SERVICE_CONFIG)
 	return parser
 
 class LoadIndexFromFileTests (unittest.TestCase):
@@ -39,6 +41,15 @@ class LoadIndexFromFileTests (unittest.TestCase):
 			expected = create_parser().parse_args(arguments)
 			self.assertEqual(results, expected)
 
+	@parameterized.expand([
+		(["config.json", "--search_cache_dir", "/shared/search/"], "/shared/search/"),
+		(["config.json", "--web_service_config", "missing.json"], loader.SEARCH_CACHE_DIR),
+		(["config.json"], "meerkat/web_service/cache/search/")
+	])
+	def test_get_search_cache_dir(self, arguments, expected):
+		"""The search cache directory comes from the arguments or the web service config"""
+		self.assertEqual(loader.get_search_cache_dir(loader.parse_arguments(arguments)), expected)
+
 	@parameterized.expand([
 		(None, "tests/elasticsearch/fixtures/small_doc.tab"),
 	])
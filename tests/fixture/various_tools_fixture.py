@@ -1,5 +1,7 @@
 """Fixtures for test_various_tools"""
 
+import re
+
 from queue import Queue
 from elasticsearch import Elasticsearch
 
@@ -115,3 +117,34 @@ def get_magic_query_params():
 			}
 		}
 	}
+
+def get_benchmark_descriptions(repeat=20):
+	"""Return bank descriptions used to benchmark the normalization pipeline"""
+	with open("data/input/100_Bank_Transactions.txt", encoding="utf-8") as input_file:
+		rows = [line.split("|") for line in input_file.readlines()[1:]]
+	return [row[-1].strip() for row in rows] * repeat
+
+def legacy_query_string(description):
+	"""The query string pipeline as it was before patterns were precompiled,
+	rebuilding every pattern on each call"""
+	def cleanse(original_string):
+		bad_characters = [r"\[", r"\]", r"\{", r"\}", r'"', r"/", r"\\", r"\:", r"\(",\
+		 r"\)", r"-", r"\+", r"<", r">", r"'", r"!", r"\*", r"\|\|", r"&&", r"~"]
+		cleanse_pattern = re.compile("|".join(bad_characters))
+		with_spaces = re.sub(cleanse_pattern, " ", original_string)
+		return ' '.join(with_spaces.split()).lower()
+	def synonyms(transaction):
+		rep = {"wal-mart" : " Walmart ", "wal mart" : " Walmart ", "samsclub" : " Sam's Club ",
+			"usps" : " US Post Office ", "lowes" : " Lowe's ", "wholefds" : " Whole Foods ",
+			"shell oil" : " Shell Gas ", "wm supercenter" : " Walmart ",
+			"exxonmobil" : " exxonmobil exxon mobil ", "mcdonalds" : " mcdonald's ",
+			"costco whse" : " costco ", "franciscoca" : " francisco ca ", "qt" : " Quicktrip ",
+			"macy's east" : " Macy's "}
+		transaction = transaction.lower()
+		rep = dict((re.escape(k), v) for k, v in rep.items())
+		pattern = re.compile("|".join(rep.keys()))
+		return pattern.sub(lambda m: rep[re.escape(m.group(0))], transaction).upper()
+	transaction = cleanse(description).rstrip()
+	if len(transaction) <= 2 and re.match('^[a-zA-Z0-9_]+$', transaction):
+		return None
+	return cleanse(synonyms(transaction))
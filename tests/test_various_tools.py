@@ -1,6 +1,8 @@
 """Unit test for meerkat.various_tools"""
 
+import logging
 import sys
+import time
 import unittest
 from nose_parameterized import parameterized
 import meerkat.various_tools as various_tools
@@ -86,6 +88,25 @@ class VariousToolsTests(unittest.TestCase):
 		"""Test synonyms with parameters"""
 		self.assertEqual(various_tools.synonyms(input_str), expected_str)
 
+	def test_normalizer_query_string_benchmark(self):
+		"""Benchmark the precompiled pipeline against rebuilding patterns per call,
+		results must be identical"""
+		descriptions = various_tools_fixture.get_benchmark_descriptions()
+		descriptions += ["wal-mart #123 wholefds", "Qt 44 shell oil", "ab", "macy's east"]
+		normalizer = various_tools.Normalizer()
+
+		start = time.time()
+		legacy = [various_tools_fixture.legacy_query_string(desc) for desc in descriptions]
+		legacy_time = (time.time() - start) / len(descriptions)
+
+		start = time.time()
+		compiled = [normalizer.query_string(desc) for desc in descriptions]
+		compiled_time = (time.time() - start) / len(descriptions)
+
+		logging.warning("Per-description cost before: {0:.2f} us, after: {1:.2f} us".format(
+			legacy_time * 1e6, compiled_time * 1e6))
+		self.assertEqual(legacy, compiled)
+
 	def test_load_dict_list(self):
 		"""Test load_dict_list"""
 		dict_list = various_tools_fixture.get_dict_list()
@@ -287,9 +287,10 @@ def get_mock_hit(score):
         "_score": score
     }
 
-def get_mock_sws(description):
-    """Return a mock SWS classifier which returns true or false depending on the test data"""
-    return description == "some physical location"
+def get_mock_sws(descriptions):
+    """Return a mock batch SWS classifier which returns true or false for each description
+    depending on the test data"""
+    return [description == "some physical location" for description in descriptions]
 
 def get_mock_cnn(transactions, label_key="CNN", label_only=False):
     """Return a mock CNN which appends a parsable merchant name"""
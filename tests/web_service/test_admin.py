@@ -0,0 +1,75 @@
+"""Unit tests for meerkat.web_service.admin"""
+
+import json
+import unittest
+
+import tornado.web
+from tornado.testing import AsyncHTTPTestCase
+
+from meerkat.web_service.admin import ModelsHandler, is_authorized
+
+class FakeConsumer():
+	"""Counts model reloads"""
+
+	def __init__(self):
+		self.reloads = 0
+
+	def model_info(self):
+		return {"version": self.reloads + 1}
+
+	def reload_models(self):
+		self.reloads += 1
+		return True
+
+class FakeModelsHandler(ModelsHandler):
+	"""Reloads a FakeConsumer"""
+	consumer = FakeConsumer()
+	token = "secret"
+
+class ModelsHandlerTests(AsyncHTTPTestCase):
+	"""Our UnitTest class."""
+
+	def get_app(self):
+		FakeModelsHandler.consumer = FakeConsumer()
+		return tornado.web.Application([("/admin/models/?", FakeModelsHandler)])
+
+	def test_reload_with_token(self):
+		"""A request with the token reloads the models"""
+		response = self.fetch("/admin/models", method="POST", body="",
+			headers={"Authorization": "Bearer secret"})
+		self.assertEqual(response.code, 202)
+		self.assertEqual(json.loads(response.body.decode())["started"], True)
+		self.assertEqual(FakeModelsHandler.consumer.reloads, 1)
+
+	def test_reload_without_token(self):
+		"""Requests without the right token are refused"""
+		for headers in [{}, {"Authorization": "Bearer wrong"}, {"Authorization": "secret"}]:
+			response = self.fetch("/admin/models", method="POST", body="", headers=headers)
+			self.assertEqual(response.code, 401)
+		self.assertEqual(self.fetch("/admin/models").code, 401)
+		self.assertEqual(FakeModelsHandler.consumer.reloads, 0)
+
+	def test_no_token_configured(self):
+		"""Without a configured token every request is refused"""
+		FakeModelsHandler.token = None
+		try:
+			response = self.fetch("/admin/models", method="POST", body="",
+				headers={"Authorization": "Bearer "})
+		finally:
+			FakeModelsHandler.token = "secret"
+		self.assertEqual(response.code, 403)
+		self.assertEqual(FakeModelsHandler.consumer.reloads, 0)
+
+class AuthorizationTests(unittest.TestCase):
+	"""Our UnitTest class."""
+
+	def test_is_authorized(self):
+		"""Only a bearer header with the configured token is authorized"""
+		self.assertTrue(is_authorized("Bearer secret", "secret"))
+		self.assertTrue(is_authorized("bearer secret", "secret"))
+		self.assertFalse(is_authorized("Bearer secret", None))
+		self.assertFalse(is_authorized("", ""))
+		self.assertFalse(is_authorized("Basic secret", "secret"))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,120 @@
+"""Unit tests for meerkat.web_service.admission"""
+
+import concurrent.futures
+import json
+import threading
+import unittest
+
+import tornado.web
+from tornado import gen
+from tornado.testing import AsyncHTTPTestCase
+from tornado_json.requesthandlers import APIHandler
+
+from meerkat.web_service.admission import AdmissionController, AdmissionMixin, Overloaded
+
+class AdmissionControllerTests(unittest.TestCase):
+	"""Our UnitTest class."""
+
+	def test_reject_over_limit(self):
+		"""Transactions past the limit are rejected while others are in flight"""
+		controller = AdmissionController(initial_limit=100)
+		self.assertTrue(controller.try_acquire(60))
+		self.assertFalse(controller.try_acquire(60))
+		self.assertTrue(controller.try_acquire(40))
+		self.assertEqual(controller.stats()["in_flight"], 100)
+		self.assertEqual(controller.stats()["rejected"], 1)
+
+	def test_admit_when_idle(self):
+		"""A request larger than the limit runs when nothing is in flight"""
+		controller = AdmissionController(initial_limit=100)
+		self.assertTrue(controller.try_acquire(500))
+
+	def test_decrease_on_delay(self):
+		"""Work waiting longer than the target shrinks the limit, down to min_limit"""
+		controller = AdmissionController(initial_limit=1000, min_limit=500,
+			target_delay=0.0, decrease_factor=0.5)
+		for _ in range(3):
+			controller.try_acquire(10)
+			controller.release(10, 1.0)
+		self.assertEqual(controller.limit, 500)
+
+	def test_increase_without_delay(self):
+		"""Work finishing without waiting grows the limit, up to max_limit"""
+		controller = AdmissionController(initial_limit=100, max_limit=101, increase=10)
+		controller.try_acquire(50)
+		controller.release(50, 0.0)
+		self.assertEqual(controller.limit, 101)
+		self.assertEqual(controller.in_flight, 0)
+
+	def test_submit(self):
+		"""Submitted work is released when it finishes, and rejected work raises
+		Overloaded"""
+		controller = AdmissionController(initial_limit=10, retry_after=3)
+		started, finish = threading.Event(), threading.Event()
+
+		def work(value):
+			started.set()
+			finish.wait(5)
+			return value
+
+		with concurrent.futures.ThreadPoolExecutor(2) as executor:
+			future = controller.submit(executor, 8, work, "done")
+			started.wait(5)
+			with self.assertRaises(Overloaded) as context:
+				controller.submit(executor, 8, work, "rejected")
+			self.assertEqual(context.exception.retry_after, 3)
+			finish.set()
+			self.assertEqual(future.result(5), "done")
+		self.assertEqual(controller.stats()["in_flight"], 0)
+		self.assertEqual(controller.stats()["admitted"], 1)
+
+class FakeAPI(AdmissionMixin, APIHandler):
+	"""Counts the transactions of a request, like Meerkat_API classifies them"""
+	executor = concurrent.futures.ThreadPoolExecutor(1)
+
+	@gen.coroutine
+	def post(self):
+		data = json.loads(self.request.body.decode())
+		result = yield self.admit(self.executor, len(data["transaction_list"]), len,
+			data["transaction_list"])
+		self.success({"transactions": result})
+
+class AdmissionMixinTests(AsyncHTTPTestCase):
+	"""Our UnitTest class."""
+
+	def get_app(self):
+		FakeAPI.admission = AdmissionController(initial_limit=10, retry_after=7)
+		return tornado.web.Application([("/meerkat/v2.4/?", FakeAPI)])
+
+	def post(self, transactions):
+		"""Post a request of transactions transactions"""
+		return self.fetch("/meerkat/v2.4", method="POST",
+			body=json.dumps({"transaction_list": [{}] * transactions}))
+
+	def test_admitted(self):
+		"""Requests under the limit are answered"""
+		response = self.post(3)
+		self.assertEqual(response.code, 200)
+		self.assertEqual(json.loads(response.body.decode())["data"], {"transactions": 3})
+		self.assertNotIn("Retry-After", response.headers)
+
+	def test_shed_with_retry_after(self):
+		"""Requests past a saturated limit get a 503 with Retry-After"""
+		# Other requests hold the whole limit
+		FakeAPI.admission.try_acquire(10)
+		response = self.post(3)
+		self.assertEqual(response.code, 503)
+		self.assertEqual(response.headers["Retry-After"], "7")
+		body = json.loads(response.body.decode())
+		self.assertEqual(body["status"], "error")
+		self.assertEqual(body["code"], 503)
+		self.assertEqual(FakeAPI.admission.stats()["rejected"], 1)
+
+	def test_other_errors_without_retry_after(self):
+		"""Errors other than shedding are left to APIHandler"""
+		response = self.fetch("/meerkat/v2.4", method="POST", body="not json")
+		self.assertEqual(response.code, 500)
+		self.assertNotIn("Retry-After", response.headers)
+
+if __name__ == '__main__':
+	unittest.main()
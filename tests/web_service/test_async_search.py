@@ -0,0 +1,131 @@
+"""Unit tests for meerkat.web_service.async_search"""
+
+import json
+import threading
+import time
+import unittest
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from meerkat.web_service.async_search import AsyncSearch, get_node_url
+from web_service_tester.fake_elasticsearch import FakeElasticsearch
+
+class FakeNode(ThreadingMixIn, HTTPServer):
+	"""An msearch endpoint which answers after delay seconds, and records the
+	most requests it was answering at once"""
+	daemon_threads = True
+
+	def __init__(self, delay=0.0):
+		HTTPServer.__init__(self, ("127.0.0.1", 0), FakeHandler)
+		self.delay = delay
+		self.paths = []
+		self.in_flight, self.peak_in_flight, self.answered = 0, 0, 0
+		self.lock = threading.Lock()
+		threading.Thread(target=self.serve_forever, daemon=True).start()
+
+class FakeHandler(BaseHTTPRequestHandler):
+	"""Returns one response per query in the msearch body"""
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+		with self.server.lock:
+			self.server.paths.append(self.path)
+			self.server.in_flight += 1
+			self.server.peak_in_flight = max(self.server.peak_in_flight, self.server.in_flight)
+		time.sleep(self.server.delay)
+		with self.server.lock:
+			self.server.in_flight -= 1
+			self.server.answered += 1
+		queries = [json.loads(line) for line in body.splitlines()][1::2]
+		responses = [{"hits": {"total": 1, "hits": [{"_score": query["size"]}]}}
+			for query in queries]
+		output = json.dumps({"responses": responses}).encode()
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(output)))
+		self.end_headers()
+		self.wfile.write(output)
+
+	def log_message(self, *args):
+		return
+
+def get_body(sizes):
+	"""Return an msearch body with one query per size"""
+	lines = []
+	for size in sizes:
+		lines.append(json.dumps({"index": "factual_index"}))
+		lines.append(json.dumps({"size": size}))
+	return "\n".join(lines)
+
+class AsyncSearchTests(unittest.TestCase):
+	"""Our UnitTest class."""
+
+	def test_get_node_url(self):
+		"""Cluster nodes may be hosts, host:port pairs or URLs"""
+		self.assertEqual(get_node_url("es.local"), "http://es.local:9200")
+		self.assertEqual(get_node_url("es.local:9300"), "http://es.local:9300")
+		self.assertEqual(get_node_url("https://es.local/"), "https://es.local:9200")
+
+	def test_concurrent_searches_round_robin(self):
+		"""Concurrent searches are answered in order and spread over the nodes"""
+		nodes = [FakeNode(delay=0.05), FakeNode(delay=0.05)]
+		search = AsyncSearch(["127.0.0.1:{0}".format(node.server_port) for node in nodes],
+			"factual_index", deadline=5.0)
+		try:
+			futures = [search.msearch(get_body([i, i + 1])) for i in range(8)]
+			results = [future.result() for future in futures]
+		finally:
+			search.close()
+			for node in nodes:
+				node.shutdown()
+		for i, result in enumerate(results):
+			scores = [response["hits"]["hits"][0]["_score"] for response in result["responses"]]
+			self.assertEqual(scores, [i, i + 1])
+		self.assertEqual([len(node.paths) for node in nodes], [4, 4])
+		self.assertEqual(nodes[0].paths[0], "/factual_index/_msearch")
+		# Searches were sent without waiting for earlier answers
+		self.assertGreater(max(node.peak_in_flight for node in nodes), 1)
+
+	def test_deadline_returns_none(self):
+		"""A node slower than the deadline yields None instead of blocking"""
+		node = FakeNode(delay=5.0)
+		search = AsyncSearch(["127.0.0.1:{0}".format(node.server_port)], "factual_index",
+			deadline=0.1)
+		try:
+			self.assertEqual(search.search(get_body([1])), None)
+			# The search gave up before the node answered
+			self.assertEqual(node.answered, 0)
+		finally:
+			search.close()
+			node.shutdown()
+
+	def test_connection_reuse(self):
+		"""Sequential searches share one kept alive connection with pycurl, and
+		open one connection each without it"""
+		node = FakeElasticsearch()
+		search = AsyncSearch([node.url], "factual_index", deadline=5.0)
+		try:
+			for _ in range(5):
+				result = search.search(get_body([1]))
+				self.assertEqual(len(result["responses"]), 1)
+		finally:
+			search.close()
+			node.close()
+		self.assertEqual(node.requests, 5)
+		self.assertEqual(node.connections, 1 if search.reuses_connections else 5)
+
+	def test_unreachable_node_returns_none(self):
+		"""Connection errors yield None"""
+		node = FakeNode()
+		port = node.server_port
+		node.shutdown()
+		node.server_close()
+		search = AsyncSearch(["127.0.0.1:{0}".format(port)], "factual_index", deadline=1.0)
+		try:
+			self.assertEqual(search.search(get_body([1])), None)
+		finally:
+			search.close()
+
+if __name__ == "__main__":
+	unittest.main()
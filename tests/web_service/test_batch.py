@@ -0,0 +1,130 @@
+"""Unit tests for meerkat.web_service.batch"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from meerkat.web_service.batch import (get_transaction_list, load_checkpoint, save_checkpoint,
+	read_chunks, get_output_columns, PipedWriter, run_pipeline)
+
+class BatchTests(unittest.TestCase):
+	"""Our UnitTest class."""
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def test_get_transaction_list(self):
+		"""Rows are mapped like format_web_consumer, keeping their columns"""
+		records = [{"DESCRIPTION_UNMASKED": "Starbucks", "AMOUNT": "3.50",
+			"TRANSACTION_DATE": "2016-01-01", "LEDGER_ENTRY": "DEBIT"},
+			{"DESCRIPTION_UNMASKED": "Refund", "AMOUNT": "10", "TRANSACTION_DATE": "2016-01-02"}]
+		transactions = get_transaction_list(records, 100)
+		self.assertEqual([trans["transaction_id"] for trans in transactions], [100, 101])
+		self.assertEqual(transactions[0]["description"], "Starbucks")
+		self.assertEqual([trans["ledger_entry"] for trans in transactions], ["debit", "credit"])
+		self.assertEqual(transactions[0]["DESCRIPTION_UNMASKED"], "Starbucks")
+
+	def test_run_pipeline_keeps_order(self):
+		"""Chunks are classified concurrently but written in order"""
+		running, most_running, lock = [0], [0], threading.Lock()
+		written = []
+
+		def classify(chunk):
+			with lock:
+				running[0] += 1
+				most_running[0] = max(most_running[0], running[0])
+			# Later chunks finish first
+			time.sleep(0.01 * (5 - chunk % 5))
+			with lock:
+				running[0] -= 1
+			return chunk * 10
+
+		run_pipeline(range(12), classify, lambda chunk, result: written.append((chunk, result)),
+			workers=3, queue_size=4)
+		self.assertEqual(written, [(chunk, chunk * 10) for chunk in range(12)])
+		self.assertGreater(most_running[0], 1)
+		self.assertLessEqual(most_running[0], 3)
+
+	def test_run_pipeline_stops_on_error(self):
+		"""An error classifying a chunk stops the pipeline and is raised"""
+		written = []
+
+		def classify(chunk):
+			if chunk == 3:
+				raise ValueError("bad chunk")
+			return chunk
+
+		with self.assertRaises(ValueError):
+			run_pipeline(range(1000), classify, lambda chunk, result: written.append(chunk),
+				workers=2, queue_size=2)
+		self.assertEqual(written, [0, 1, 2])
+
+	def test_checkpoint_round_trip(self):
+		"""A missing checkpoint starts from the beginning"""
+		filename = os.path.join(self.tmp_dir, "output.checkpoint")
+		self.assertEqual(load_checkpoint(filename)["chunks"], 0)
+		save_checkpoint(filename, {"chunks": 2, "rows": 20, "offset": 100, "bytes": 5,
+			"columns": ["a"]})
+		self.assertEqual(load_checkpoint(filename)["rows"], 20)
+
+	def test_piped_writer_resumes(self):
+		"""Resuming drops whatever was written after the checkpoint"""
+		filename = os.path.join(self.tmp_dir, "output.txt")
+		checkpoint = load_checkpoint(filename + ".checkpoint")
+		writer = PipedWriter(filename, checkpoint, ["a", "b"])
+		size = writer.write([{"a": 1, "b": ["x"]}, {"a": 2, "b": []}])
+		writer.write([{"a": 3, "b": []}])
+		writer.close()
+
+		checkpoint = {"chunks": 1, "rows": 2, "bytes": size, "columns": writer.columns}
+		writer = PipedWriter(filename, checkpoint, ["a", "b", "c"])
+		writer.write([{"a": 4, "b": []}])
+		writer.close()
+		with open(filename) as output:
+			lines = output.read().splitlines()
+		self.assertEqual(lines, ["a|b", "1|\"[\"\"x\"\"]\"", "2|[]", "4|[]"])
+
+	def test_piped_writer_columns(self):
+		"""Fields missing from the first chunk still get a column, and fields
+		outside the columns are not dropped silently"""
+		filename = os.path.join(self.tmp_dir, "output.txt")
+		writer = PipedWriter(filename, load_checkpoint(filename + ".checkpoint"),
+			["a", "street"])
+		writer.write([{"a": 1}])
+		writer.write([{"a": 2, "street": "Main St"}])
+		with self.assertRaises(ValueError):
+			writer.write([{"a": 3, "unknown": ""}])
+		writer.close()
+		with open(filename) as output:
+			self.assertEqual(output.read().splitlines(), ["a|street", "1|", "2|Main St"])
+
+	def test_get_output_columns(self):
+		"""Input columns come first, then every field of the output schema"""
+		columns = get_output_columns(["DESCRIPTION_UNMASKED", "city"])
+		self.assertEqual(columns[:2], ["DESCRIPTION_UNMASKED", "city"])
+		for field in ["street", "latitude", "longitude", "category_labels", "txn_type"]:
+			self.assertIn(field, columns)
+		self.assertEqual(len(columns), len(set(columns)))
+
+	def test_read_chunks_resumes_from_offset(self):
+		"""Chunks end at byte offsets which resume reading without reparsing,
+		malformed lines are skipped"""
+		filename = os.path.join(self.tmp_dir, "input.txt")
+		with open(filename, "w") as input_file:
+			input_file.write("A|B\n1|x\n2|y\n3|y|extra\n4\n5|z\n")
+		chunks = list(read_chunks(filename, 2))
+		self.assertEqual([(index, row, [record["A"] for record in records])
+			for index, row, records, _ in chunks], [(0, 0, ["1", "2"]), (1, 2, ["4"]),
+			(2, 3, ["5"])])
+		self.assertEqual(chunks[1][2], [{"A": "4", "B": ""}])
+		resumed = list(read_chunks(filename, 2, 1, 2, chunks[0][3]))
+		self.assertEqual(resumed, chunks[1:])
+
+if __name__ == "__main__":
+	unittest.main()
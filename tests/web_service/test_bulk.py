@@ -0,0 +1,159 @@
+"""Unit tests for meerkat.web_service.bulk"""
+
+import concurrent.futures
+import json
+import threading
+import time
+import unittest
+
+import tornado.web
+from tornado import gen
+from tornado.simple_httpclient import HTTPStreamClosedError
+from tornado.testing import AsyncHTTPTestCase
+
+from meerkat.web_service.admission import AdmissionController
+from meerkat.web_service.bulk import BulkHandler, get_request_metadata
+
+class FakeConsumer():
+	"""Labels each transaction with its batch, and records the most batches
+	classified at once"""
+
+	def __init__(self):
+		self.batches = []
+		self.running, self.most_running = 0, 0
+		self.lock = threading.Lock()
+
+	def classify(self, data):
+		with self.lock:
+			self.running += 1
+			self.most_running = max(self.most_running, self.running)
+			batch = len(self.batches)
+			self.batches.append(data)
+		for transaction in data["transaction_list"]:
+			transaction["batch"] = batch
+			transaction["container"] = data["container"]
+		with self.lock:
+			self.running -= 1
+		return data
+
+class FakeBulkHandler(BulkHandler):
+	"""Classifies with a FakeConsumer"""
+	consumer = FakeConsumer()
+	executor = concurrent.futures.ThreadPoolExecutor(4)
+	batch_size = 3
+	max_pending = 2
+	max_line_bytes = 100
+
+def get_lines(count):
+	"""Return count transactions, one per line"""
+	return "".join(json.dumps({"transaction_id": index, "description": "txn " + str(index)}) +
+		"\n" for index in range(count))
+
+class BulkHandlerTests(AsyncHTTPTestCase):
+	"""Our UnitTest class."""
+
+	def get_app(self):
+		FakeBulkHandler.consumer = FakeConsumer()
+		return tornado.web.Application([("/meerkat/bulk/?", FakeBulkHandler)])
+
+	def get_httpserver_options(self):
+		# A small server limit stands in for the default 100 MB one
+		return {"max_body_size": 1024}
+
+	def post_chunked(self, chunks, query="?container=card"):
+		"""Upload chunks with chunked transfer, returns the response"""
+		@gen.coroutine
+		def body_producer(write):
+			for chunk in chunks:
+				yield write(chunk.encode())
+		return self.fetch("/meerkat/bulk" + query, method="POST", body_producer=body_producer,
+			headers={"Transfer-Encoding": "chunked"})
+
+	def test_results_in_order(self):
+		"""Every line gets one result, in order, from fixed-size batches"""
+		body = get_lines(10)
+		# Split lines across chunks
+		response = self.post_chunked([body[i:i + 7] for i in range(0, len(body), 7)])
+		self.assertEqual(response.code, 200)
+		self.assertEqual(response.headers["Content-Type"], "application/x-ndjson")
+		results = [json.loads(line) for line in response.body.decode().splitlines()]
+		self.assertEqual([result["transaction_id"] for result in results], list(range(10)))
+		self.assertEqual([result["batch"] for result in results],
+			[0, 0, 0, 1, 1, 1, 2, 2, 2, 3])
+		self.assertEqual(results[0]["container"], "card")
+		self.assertLessEqual(FakeBulkHandler.consumer.most_running, FakeBulkHandler.max_pending)
+		self.assertEqual(FakeBulkHandler.in_flight, 0)
+
+	def test_body_over_server_limit(self):
+		"""Uploads larger than the max_body_size of the server are classified"""
+		body = get_lines(100)
+		self.assertGreater(len(body), 1024)
+		response = self.post_chunked([body[i:i + 500] for i in range(0, len(body), 500)])
+		self.assertEqual(response.code, 200)
+		self.assertEqual(len(response.body.decode().splitlines()), 100)
+
+	def test_body_over_handler_limit(self):
+		"""Uploads larger than the max_body_size of the handler are cut off"""
+		FakeBulkHandler.max_body_size = 2048
+		body = get_lines(100)
+		try:
+			code = self.post_chunked([body[i:i + 500] for i in range(0, len(body), 500)]).code
+		except HTTPStreamClosedError:
+			code = None
+		finally:
+			FakeBulkHandler.max_body_size = None
+		self.assertNotEqual(code, 200)
+
+	def test_overloaded_batches_wait(self):
+		"""Batches are not submitted while the admission controller is full"""
+		admission = AdmissionController(initial_limit=10, retry_after=1)
+		# Other requests hold the whole limit for a while
+		admission.try_acquire(10)
+		released = []
+		def release():
+			released.append(time.time())
+			admission.release(10, 0.0)
+		self.io_loop.call_later(0.2, release)
+		FakeBulkHandler.admission, FakeBulkHandler.admission_backoff = admission, 0.01
+		try:
+			response = self.post_chunked([get_lines(6)])
+		finally:
+			FakeBulkHandler.admission = None
+		self.assertEqual(response.code, 200)
+		self.assertEqual(len(response.body.decode().splitlines()), 6)
+		self.assertEqual(len(released), 1)
+		self.assertGreater(admission.stats()["rejected"], 0)
+		# The two batches, after the acquire standing in for other requests
+		self.assertEqual(admission.stats()["admitted"], 3)
+		self.assertEqual(admission.stats()["in_flight"], 0)
+
+	def test_invalid_lines(self):
+		"""Invalid lines get an error in place, blank lines are skipped"""
+		body = get_lines(2) + "not json\n\n" + "x" * 200 + "\n" + get_lines(1).rstrip("\n")
+		response = self.post_chunked([body])
+		results = [json.loads(line) for line in response.body.decode().splitlines()]
+		self.assertEqual(len(results), 5)
+		self.assertEqual([result.get("transaction_id") for result in results],
+			[0, 1, None, None, 0])
+		self.assertEqual([result.get("line") for result in results[2:4]], [3, 4])
+		self.assertIn("100 bytes", results[3]["error"])
+
+	def test_missing_container(self):
+		"""A request without a valid container is rejected"""
+		response = self.post_chunked([get_lines(1)], query="?container=atm")
+		self.assertEqual(response.code, 400)
+		self.assertEqual(FakeBulkHandler.consumer.batches, [])
+
+class RequestMetadataTests(unittest.TestCase):
+	"""Our UnitTest class."""
+
+	def test_get_request_metadata(self):
+		"""Query arguments are converted to classify fields"""
+		arguments = {"container": "bank", "cobrand_region": "2",
+			"services_list": "cnn_merchant,bloom_filter"}
+		metadata = get_request_metadata(lambda name, default=None: arguments.get(name, default))
+		self.assertEqual(metadata, {"container": "bank", "cobrand_region": 2,
+			"services_list": ["cnn_merchant", "bloom_filter"], "debug": False})
+
+if __name__ == "__main__":
+	unittest.main()
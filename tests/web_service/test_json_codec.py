@@ -0,0 +1,37 @@
+"""Unit tests for meerkat.web_service.json_codec"""
+
+import json
+import unittest
+
+from meerkat.web_service import json_codec
+
+class JsonCodecTests(unittest.TestCase):
+	"""Our UnitTest class."""
+
+	def test_round_trip(self):
+		"""Documents decode from bytes or strings and encode to strings json can read"""
+		document = {"transaction_list": [{"description": "Café </script>", "amount": 1.5,
+			"ledger_entry": "debit", "is_physical_merchant": True, "locale_bloom": None}],
+			"container": "card", "cobrand_region": 3}
+		text = json.dumps(document)
+		self.assertEqual(json_codec.loads(text), document)
+		self.assertEqual(json_codec.loads(text.encode("utf-8")), document)
+		self.assertTrue(isinstance(json_codec.dumps(document), str))
+		self.assertEqual(json.loads(json_codec.dumps(document)), document)
+
+	def test_malformed_input_raises_value_error(self):
+		"""Malformed documents raise a ValueError, which schema.validate reports"""
+		self.assertRaises(ValueError, json_codec.loads, b"{\"transaction_list\": [")
+
+	def test_json_fallback(self):
+		"""Without orjson the json module is used"""
+		original = json_codec.orjson
+		json_codec.orjson = None
+		try:
+			self.assertEqual(json_codec.loads(b"{\"a\": [1]}"), {"a": [1]})
+			self.assertEqual(json_codec.dumps({"a": [1]}), "{\"a\": [1]}")
+		finally:
+			json_codec.orjson = original
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,87 @@
+"""Unit tests for web_service_tester.load_test and web_service_tester.fake_elasticsearch"""
+
+import http.client
+import json
+import unittest
+
+import tornado.web
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from meerkat.web_service.async_search import AsyncSearch
+from web_service_tester.fake_elasticsearch import FakeElasticsearch
+from web_service_tester.load_test import get_percentile, run_load, summarize
+
+class FlakyHandler(tornado.web.RequestHandler):
+	"""Fails requests whose body is "fail" """
+
+	def post(self):
+		if self.request.body == b"fail":
+			self.set_status(500)
+		self.write("{}")
+
+class LoadTestTests(AsyncHTTPTestCase):
+	"""Our UnitTest class."""
+
+	def get_app(self):
+		return tornado.web.Application([("/meerkat/v2.4", FlakyHandler)])
+
+	@gen_test(timeout=10)
+	def test_run_load(self):
+		"""Requests are sent at the arrival rate and failures are counted"""
+		payloads = [("ok.json", b"{}"), ("fail.json", b"fail")]
+		results, elapsed = yield run_load(self.get_url("/meerkat/v2.4"), payloads, rate=200,
+			duration=0.5)
+		summary = summarize(results, elapsed)
+		self.assertGreater(summary["requests"], 40)
+		self.assertEqual(summary["errors"], sum(1 for name, _, _ in results
+			if name == "fail.json"))
+		self.assertGreater(summary["error_rate"], 0.0)
+		self.assertLess(summary["error_rate"], 1.0)
+		self.assertLessEqual(summary["latency_ms"]["p50"], summary["latency_ms"]["p99"])
+
+	def test_get_percentile(self):
+		"""Nearest-rank percentiles"""
+		values = list(range(1, 101))
+		self.assertEqual(get_percentile(values, 50), 50)
+		self.assertEqual(get_percentile(values, 99), 99)
+		self.assertEqual(get_percentile([7], 95), 7)
+		self.assertEqual(get_percentile([], 50), None)
+
+class FakeElasticsearchTests(unittest.TestCase):
+	"""Our UnitTest class."""
+
+	def test_msearch(self):
+		"""The fake answers each msearch query with the same merchants every time,
+		AsyncSearch ends the body with the newline it requires"""
+		fake_es = FakeElasticsearch(latency=0.05)
+		search = AsyncSearch([fake_es.url], "factual_index", deadline=2.0)
+		try:
+			body = "\n".join(json.dumps(line) for line in [{"index": "factual_index"},
+				{"size": 3, "query": "a"}, {"index": "factual_index"}, {"size": 3, "query": "b"}])
+			first, second = search.search(body), search.search(body)
+		finally:
+			search.close()
+			fake_es.close()
+		self.assertEqual(len(first["responses"]), 2)
+		self.assertEqual(len(first["responses"][0]["hits"]["hits"]), 3)
+		self.assertEqual(first, second)
+		self.assertNotEqual(first["responses"][0], first["responses"][1])
+		self.assertEqual((fake_es.requests, fake_es.queries), (2, 4))
+
+	def test_msearch_requires_final_newline(self):
+		"""The fake rejects an msearch body without a final newline, as
+		Elasticsearch does"""
+		fake_es = FakeElasticsearch()
+		body = "\n".join(json.dumps(line) for line in [{"index": "factual_index"},
+			{"size": 1, "query": "a"}]).encode()
+		try:
+			for ending, expected in [(b"", 400), (b"\n", 200)]:
+				connection = http.client.HTTPConnection("127.0.0.1", fake_es.server_address[1])
+				connection.request("POST", "/factual_index/_msearch", body + ending)
+				self.assertEqual(connection.getresponse().status, expected)
+				connection.close()
+		finally:
+			fake_es.close()
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,59 @@
+"""Unit tests for meerkat.web_service.memo_cache"""
+
+import concurrent.futures
+import unittest
+
+from meerkat.web_service.memo_cache import MemoCache
+
+class MemoCacheTests(unittest.TestCase):
+	"""Our UnitTest class."""
+
+	def test_least_recently_used_is_evicted(self):
+		"""Once full, the entry used least recently is evicted first"""
+		cache = MemoCache(max_size=2)
+		cache.put("sws", "a", (("is_physical_merchant", True),))
+		cache.put("sws", "b", (("is_physical_merchant", False),))
+		self.assertEqual(cache.get("sws", "a"), (("is_physical_merchant", True),))
+		cache.put("sws", "c", ())
+		self.assertEqual(len(cache), 2)
+		self.assertEqual(cache.get("sws", "b"), None)
+		self.assertEqual(cache.get("sws", "c"), ())
+
+	def test_stages_are_separate(self):
+		"""The same key caches a separate value for each stage"""
+		cache = MemoCache()
+		cache.put("sws", "key", "physical")
+		cache.put("locale_bloom", "key", "bloom")
+		self.assertEqual(cache.get("sws", "key"), "physical")
+		self.assertEqual(cache.get("locale_bloom", "key"), "bloom")
+		self.assertEqual(cache.get("merchant_cnn", "key"), None)
+
+	def test_stats_and_clear(self):
+		"""Hits and misses are counted per stage and survive clear"""
+		cache = MemoCache(max_size=10)
+		cache.get("sws", "a")
+		cache.put("sws", "a", "value")
+		cache.get("sws", "a")
+		cache.get("sws", "a")
+		cache.clear()
+		cache.get("sws", "a")
+		stats = cache.stats()
+		self.assertEqual(stats["size"], 0)
+		self.assertEqual(stats["max_size"], 10)
+		self.assertEqual(stats["stages"]["sws"], {"hits": 2, "misses": 2, "hit_rate": 0.5})
+
+	def test_concurrent_access(self):
+		"""Concurrent gets and puts keep the cache bounded and the counters exact"""
+		cache = MemoCache(max_size=50)
+		def work(worker):
+			for i in range(1000):
+				if cache.get("sws", (worker + i) % 80) is None:
+					cache.put("sws", (worker + i) % 80, i)
+		with concurrent.futures.ThreadPoolExecutor(8) as executor:
+			list(executor.map(work, range(8)))
+		stats = cache.stats()["stages"]["sws"]
+		self.assertLessEqual(len(cache), 50)
+		self.assertEqual(stats["hits"] + stats["misses"], 8000)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,63 @@
+"""Unit tests for meerkat.web_service.metrics"""
+
+import logging
+import threading
+import time
+import unittest
+
+from meerkat.web_service.metrics import (Histogram, StageMetrics, format_metric,
+	format_labels)
+
+class MetricsTests(unittest.TestCase):
+	"""Our UnitTest class."""
+
+	def test_histogram_across_threads(self):
+		"""Values counted from several threads are all in the snapshot"""
+		histogram = Histogram([1, 10])
+
+		def observe():
+			for value in [0.5, 1, 5, 20] * 1000:
+				histogram.observe(value)
+
+		threads = [threading.Thread(target=observe) for _ in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		cumulative, total = histogram.snapshot()
+		self.assertEqual(cumulative, [8000, 12000, 16000])
+		self.assertEqual(total, 26.5 * 4000)
+
+	def test_format(self):
+		"""Histograms are formatted in the Prometheus text format"""
+		metrics = StageMetrics(latency_buckets=(0.1, 1.0), batch_size_buckets=(10,))
+		metrics.observe("sws", 0.05, 3)
+		with metrics.timer("msearch"):
+			pass
+		lines = metrics.format().splitlines()
+		self.assertIn("# TYPE meerkat_stage_latency_seconds histogram", lines)
+		self.assertIn('meerkat_stage_latency_seconds_bucket{stage="sws",le="0.1"} 1', lines)
+		self.assertIn('meerkat_stage_latency_seconds_bucket{stage="msearch",le="+Inf"} 1', lines)
+		self.assertIn('meerkat_stage_latency_seconds_count{stage="sws"} 1', lines)
+		self.assertIn('meerkat_stage_batch_size_sum{stage="sws"} 3.0', lines)
+		self.assertNotIn('meerkat_stage_batch_size_count{stage="msearch"} 1', lines)
+
+	def test_format_metric(self):
+		"""Label values are escaped"""
+		self.assertEqual(format_labels([("path", 'a"b\\c')]), '{path="a\\"b\\\\c"}')
+		self.assertEqual(format_metric("up", "Is it up", [([], 1)], "counter").splitlines(),
+			["# HELP up Is it up", "# TYPE up counter", "up 1"])
+
+	def test_observe_overhead(self):
+		"""Time many stages and log what timing one costs"""
+		metrics = StageMetrics()
+		start = time.perf_counter()
+		for _ in range(10000):
+			with metrics.timer("sws", 100):
+				pass
+		logging.warning("StageTimer: {0:.2f} us per stage".format(
+			(time.perf_counter() - start) / 10000 * 1e6))
+		self.assertEqual(metrics.latency["sws"].snapshot()[0][-1], 10000)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,66 @@
+"""Unit tests for meerkat.web_service.micro_batcher"""
+
+import concurrent.futures
+import threading
+import unittest
+
+from meerkat.web_service.micro_batcher import MicroBatcher
+
+class MicroBatcherTests(unittest.TestCase):
+	"""Our UnitTest class."""
+
+	def setUp(self):
+		self.batch_sizes = []
+		self.lock = threading.Lock()
+
+	def mock_cnn(self, trans, doc_key="description", label_key="CNN", label_only=True,
+		soft_target=False):
+		"""A mock apply_cnn which records the size of every batch it is given"""
+		with self.lock:
+			self.batch_sizes.append(len(trans))
+		if soft_target:
+			return [[len(doc["description"])] for doc in trans]
+		for doc in trans:
+			doc[label_key] = doc["description"].upper()
+		return trans
+
+	def test_concurrent_calls_are_merged(self):
+		"""Concurrent calls share batches and each caller gets its own transactions"""
+		batcher = MicroBatcher(self.mock_cnn, max_batch_size=64, max_wait=0.05)
+		requests = [[{"description": "trans {0} {1}".format(i, j)} for j in range(2)]
+			for i in range(16)]
+		with concurrent.futures.ThreadPoolExecutor(16) as executor:
+			results = list(executor.map(lambda trans: batcher(trans, label_key="CNN"), requests))
+		batcher.close()
+		for trans, result in zip(requests, results):
+			self.assertIs(result, trans)
+			for doc in result:
+				self.assertEqual(doc["CNN"], doc["description"].upper())
+		self.assertEqual(sum(self.batch_sizes), 32)
+		self.assertLess(len(self.batch_sizes), 16)
+
+	def test_max_batch_size(self):
+		"""Batches are flushed once max_batch_size transactions are waiting"""
+		batcher = MicroBatcher(self.mock_cnn, max_batch_size=4, max_wait=1.0)
+		requests = [[{"description": "a"}, {"description": "b"}] for _ in range(4)]
+		with concurrent.futures.ThreadPoolExecutor(4) as executor:
+			list(executor.map(batcher, requests))
+		batcher.close()
+		self.assertTrue(all(size <= 4 for size in self.batch_sizes))
+
+	def test_soft_target_is_scattered(self):
+		"""Soft target outputs are sliced back to each caller"""
+		batcher = MicroBatcher(self.mock_cnn, max_wait=0.0)
+		result = batcher([{"description": "ab"}, {"description": "abc"}], soft_target=True)
+		batcher.close()
+		self.assertEqual(list(result), [[2], [3]])
+
+	def test_closed_batcher_calls_through(self):
+		"""Calls made after close go straight to the wrapped model"""
+		batcher = MicroBatcher(self.mock_cnn)
+		batcher.close()
+		trans = [{"description": "abc"}]
+		self.assertEqual(batcher(trans, label_key="subtype_CNN")[0]["subtype_CNN"], "ABC")
+
+if __name__ == "__main__":
+	unittest.main()
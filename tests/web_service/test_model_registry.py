@@ -0,0 +1,95 @@
+"""Unit tests for meerkat.web_service.model_registry"""
+
+import threading
+import unittest
+
+from meerkat.web_service.model_registry import ModelRegistry
+
+class FakeModel():
+	"""Records its warm-up calls and whether its session was closed"""
+
+	def __init__(self, version):
+		self.version = version
+		self.calls = 0
+		self.closed = False
+
+	def __call__(self, trans, **kwargs):
+		self.calls += 1
+		return trans
+
+	def close(self):
+		self.closed = True
+
+class ModelRegistryTests(unittest.TestCase):
+	"""Our UnitTest class."""
+
+	def setUp(self):
+		self.loads = []
+		self.keys = ["bank_merchant_cnn", "card_merchant_cnn"]
+		self.fail = False
+		self.swaps = []
+		self.registry = ModelRegistry(self.load_models, warm_up=lambda model: model([{}]),
+			on_swap=self.swaps.append)
+
+	def load_models(self):
+		"""Load a fake set of models"""
+		if self.fail:
+			raise IOError("checkpoint not found")
+		version = len(self.loads) + 1
+		models = {key: FakeModel(version) for key in self.keys}
+		self.loads.append(models)
+		return models, {key: key + ".ckpt" for key in self.keys}
+
+	def test_swap_after_drain(self):
+		"""Old models serve their requests in flight and are closed after them"""
+		first = self.registry.load()
+		in_flight = self.registry.acquire()
+		second = self.registry.load()
+
+		self.assertIs(self.registry.current, second)
+		self.assertEqual([model_set.version for model_set in self.swaps], [1, 2])
+		self.assertTrue(all(model.calls == 1 for model in second.models.values()))
+		self.assertIs(in_flight, first)
+		self.assertFalse(any(model.closed for model in first.models.values()))
+
+		in_flight.release()
+		self.assertTrue(all(model.closed for model in first.models.values()))
+		self.assertFalse(any(model.closed for model in second.models.values()))
+
+	def test_failed_load_keeps_current(self):
+		"""A set which fails to load or misses models is never served"""
+		first = self.registry.load()
+		self.fail = True
+		with self.assertRaises(IOError):
+			self.registry.load()
+		self.fail = False
+		self.keys = self.keys[:1]
+		with self.assertRaises(ValueError):
+			self.registry.load()
+		self.assertIs(self.registry.current, first)
+		self.assertTrue(all(model.closed for model in self.loads[-1].values()))
+		self.assertFalse(any(model.closed for model in first.models.values()))
+
+	def test_background_reload(self):
+		"""Only one reload runs at a time"""
+		self.registry.load()
+		release = threading.Event()
+		load_models = self.load_models
+
+		def slow_load():
+			release.wait()
+			return load_models()
+
+		self.registry.load_models = slow_load
+		self.assertTrue(self.registry.reload())
+		self.assertFalse(self.registry.reload())
+		self.assertEqual(self.registry.current.version, 1)
+		release.set()
+		for thread in threading.enumerate():
+			if thread.name == "model_reload":
+				thread.join()
+		self.assertEqual(self.registry.current.version, 2)
+		self.assertFalse(self.registry.reloading)
+
+if __name__ == "__main__":
+	unittest.main()
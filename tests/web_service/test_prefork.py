@@ -0,0 +1,79 @@
+"""Unit tests for meerkat.web_service.prefork"""
+
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+# Each worker records its pid in a file named after it and exits on SIGTERM
+SUPERVISOR = """
+import os, signal, sys, time
+from meerkat.web_service.prefork import PreforkSupervisor
+
+def serve(worker_id, ready):
+	stopping = []
+	signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+	path = os.path.join(sys.argv[1], str(os.getpid()))
+	open(path, "w").close()
+	ready()
+	while not stopping:
+		time.sleep(0.01)
+	os.remove(path)
+
+PreforkSupervisor(2, serve, poll_interval=0.01).run()
+"""
+
+class PreforkSupervisorTests(unittest.TestCase):
+	"""Our UnitTest class."""
+
+	def setUp(self):
+		self.pid_dir = tempfile.mkdtemp()
+		self.supervisor = subprocess.Popen([sys.executable, "-c", SUPERVISOR, self.pid_dir])
+
+	def tearDown(self):
+		if self.supervisor.poll() is None:
+			self.supervisor.kill()
+			self.supervisor.wait()
+		shutil.rmtree(self.pid_dir)
+
+	def wait_for(self, condition, timeout=10):
+		"""Wait until condition() returns a true value"""
+		deadline = time.time() + timeout
+		while time.time() < deadline:
+			result = condition()
+			if result:
+				return result
+			time.sleep(0.01)
+		self.fail("Timed out waiting for workers")
+
+	def test_reload_and_stop(self):
+		"""SIGHUP replaces every worker and SIGTERM stops them all"""
+		workers = self.wait_for(lambda: len(os.listdir(self.pid_dir)) == 2 and
+			set(os.listdir(self.pid_dir)))
+
+		self.supervisor.send_signal(signal.SIGHUP)
+		replaced = self.wait_for(lambda: len(os.listdir(self.pid_dir)) == 2 and
+			not set(os.listdir(self.pid_dir)) & workers and set(os.listdir(self.pid_dir)))
+		self.assertEqual(len(replaced), 2)
+
+		self.supervisor.send_signal(signal.SIGTERM)
+		self.assertEqual(self.supervisor.wait(timeout=10), 0)
+		self.assertEqual(os.listdir(self.pid_dir), [])
+
+	def test_dead_workers_restart(self):
+		"""A worker which dies is replaced"""
+		workers = self.wait_for(lambda: len(os.listdir(self.pid_dir)) == 2 and
+			set(os.listdir(self.pid_dir)))
+		killed = sorted(workers)[0]
+		os.kill(int(killed), signal.SIGKILL)
+		os.remove(os.path.join(self.pid_dir, killed))
+		restarted = self.wait_for(lambda: len(os.listdir(self.pid_dir)) == 2 and
+			set(os.listdir(self.pid_dir)) != workers - {killed} and set(os.listdir(self.pid_dir)))
+		self.assertTrue(workers - {killed} < restarted)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,58 @@
+"""Unit tests for meerkat.web_service.scheduler"""
+
+import concurrent.futures
+import threading
+import time
+import unittest
+
+from meerkat.web_service.scheduler import StageScheduler
+
+class StageSchedulerTests(unittest.TestCase):
+	"""Our UnitTest class."""
+
+	@classmethod
+	def setUpClass(cls):
+		cls.executor = concurrent.futures.ThreadPoolExecutor(4)
+
+	def test_independent_stages_run_concurrently(self):
+		"""Independent stages overlap, each waits for the others to start"""
+		barrier = threading.Barrier(3)
+		scheduler = StageScheduler(self.executor)
+		for name in ["a", "b", "c"]:
+			# Raises BrokenBarrierError unless all three stages run at once
+			scheduler.add(name, barrier.wait, 5)
+		scheduler.run()
+		self.assertEqual(sorted(scheduler.timings), ["a", "b", "c"])
+		self.assertEqual(sorted(scheduler.results.values()), [0, 1, 2])
+
+	def test_dependencies_finish_first(self):
+		"""A stage starts only after the stages it depends on have finished"""
+		order, lock = [], threading.Lock()
+		def record(name, delay):
+			time.sleep(delay)
+			with lock:
+				order.append(name)
+			return name
+		scheduler = StageScheduler(self.executor)
+		scheduler.add("slow", record, "slow", 0.1)
+		scheduler.add("fast", record, "fast", 0.0)
+		scheduler.add("last", record, "last", 0.0, depends_on=["slow", "fast"])
+		results = scheduler.run()
+		self.assertEqual(order[-1], "last")
+		self.assertEqual(results, {"slow": "slow", "fast": "fast", "last": "last"})
+
+	def test_stage_exception_is_raised(self):
+		"""Exceptions raised by a stage are raised by run"""
+		def fail():
+			raise KeyError("description")
+		scheduler = StageScheduler(self.executor)
+		scheduler.add("fail", fail)
+		self.assertRaises(KeyError, scheduler.run)
+
+	def test_unknown_dependency(self):
+		"""Stages may only depend on stages that were already added"""
+		scheduler = StageScheduler(self.executor)
+		self.assertRaises(ValueError, scheduler.add, "a", time.sleep, 0, depends_on=["b"])
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,82 @@
+"""Unit tests for meerkat.web_service.schema"""
+
+import json
+import unittest
+
+import jsonschema
+
+from tornado.ioloop import IOLoop
+
+from meerkat.web_service import schema
+
+INPUT_SCHEMA = {"type": "object", "required": ["transaction_list"],
+	"properties": {"transaction_list": {"type": "array"}}}
+OUTPUT_SCHEMA = {"type": "object", "required": ["transaction_list"]}
+
+class MockRequest():
+	"""A request with a body"""
+	def __init__(self, body):
+		self.body = body
+
+class MockHandler():
+	"""Records what schema.validate writes back"""
+	def __init__(self, body):
+		self.request = MockRequest(body)
+		self.headers, self.written, self.finished = {}, [], False
+
+	def set_header(self, name, value):
+		self.headers[name] = value
+
+	def write(self, chunk):
+		self.written.append(chunk)
+
+	def finish(self):
+		self.finished = True
+
+	@schema.validate(input_schema=INPUT_SCHEMA, output_schema=OUTPUT_SCHEMA,
+		debug_output_schema=OUTPUT_SCHEMA)
+	def post(self):
+		self.body["seen"] = True
+		return self.body
+
+	@schema.validate(input_schema=INPUT_SCHEMA, output_schema=OUTPUT_SCHEMA,
+		output_sample_rate=0.0)
+	def put(self):
+		return {"unvalidated": True}
+
+class SchemaTests(unittest.TestCase):
+	"""Our UnitTest class."""
+
+	def test_get_validator(self):
+		"""Validators are built once and invalid schemas are rejected"""
+		validator = schema.get_validator(INPUT_SCHEMA)
+		validator.validate({"transaction_list": []})
+		self.assertRaises(jsonschema.ValidationError, validator.validate, {})
+		self.assertRaises(jsonschema.SchemaError, schema.get_validator, {"type": 12})
+		self.assertEqual(schema.get_validator(None), None)
+
+	def test_body_is_parsed_once(self):
+		"""The method gets the decoded body and its output is written as a JSend success"""
+		handler = MockHandler(b"{\"transaction_list\": [{\"description\": \"</b>\"}]}")
+		IOLoop.current().run_sync(handler.post)
+		self.assertTrue(handler.body["seen"])
+		self.assertTrue(handler.finished)
+		self.assertTrue("<\\/b>" in handler.written[0])
+		self.assertEqual(json.loads(handler.written[0]), {"status": "success",
+			"data": {"transaction_list": [{"description": "</b>"}], "seen": True}})
+
+	def test_invalid_input(self):
+		"""Malformed or invalid input raises a ValidationError"""
+		for body in [b"{", b"{\"transaction_list\": 1}"]:
+			handler = MockHandler(body)
+			self.assertRaises(jsonschema.ValidationError, IOLoop.current().run_sync,
+				handler.post)
+
+	def test_output_sampling(self):
+		"""Outputs are not validated when sampled out"""
+		handler = MockHandler(b"{\"transaction_list\": []}")
+		IOLoop.current().run_sync(handler.put)
+		self.assertEqual(json.loads(handler.written[0])["data"], {"unvalidated": True})
+
+if __name__ == "__main__":
+	unittest.main()
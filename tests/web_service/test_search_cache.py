@@ -0,0 +1,76 @@
+"""Unit tests for meerkat.web_service.search_cache"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from meerkat.web_service.search_cache import SearchCache, get_query_key, invalidate_index
+
+HEADER = {"index": "factual_index", "routing": "CA"}
+QUERY = {"size": 10, "query": {"bool": {"should": [{"query_string": {"query": "starbucks"}}]}}}
+RESPONSE = {"hits": {"total": 1, "hits": [{"_score": 3.5, "fields": {"name": ["Starbucks"]}}]}}
+
+class SearchCacheTests(unittest.TestCase):
+	"""Our UnitTest class."""
+
+	def setUp(self):
+		self.cache_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.cache_dir)
+
+	def test_query_key(self):
+		"""Keys ignore the order of JSON keys but not the index or routing"""
+		reordered = {"query": QUERY["query"], "size": 10}
+		self.assertEqual(get_query_key(HEADER, QUERY), get_query_key(HEADER, reordered))
+		self.assertNotEqual(get_query_key(HEADER, QUERY),
+			get_query_key({"index": "factual_index", "routing": "NY"}, QUERY))
+		self.assertNotEqual(get_query_key(HEADER, QUERY),
+			get_query_key({"index": "other_index", "routing": "CA"}, QUERY))
+
+	def test_put_get_and_eviction(self):
+		"""The least recently used response is evicted first"""
+		cache = SearchCache(max_size=2, cache_dir=self.cache_dir)
+		self.assertEqual(cache.get(HEADER, QUERY), None)
+		cache.put(HEADER, QUERY, RESPONSE)
+		cache.put(HEADER, {"size": 1}, {"hits": {}})
+		self.assertEqual(cache.get(HEADER, QUERY), RESPONSE)
+		cache.put(HEADER, {"size": 2}, {"hits": {}})
+		self.assertEqual(cache.get(HEADER, {"size": 1}), None)
+		self.assertEqual(cache.get(HEADER, QUERY), RESPONSE)
+		self.assertEqual(cache.stats()["hits"], 2)
+		self.assertEqual(cache.stats()["misses"], 2)
+
+	def test_ttl(self):
+		"""Responses older than the TTL are misses"""
+		cache = SearchCache(ttl=0.05, cache_dir=self.cache_dir)
+		cache.put(HEADER, QUERY, RESPONSE)
+		self.assertEqual(cache.get(HEADER, QUERY), RESPONSE)
+		time.sleep(0.1)
+		self.assertEqual(cache.get(HEADER, QUERY), None)
+		self.assertEqual(len(cache), 0)
+
+	def test_invalidate_index(self):
+		"""Reloading an index makes its responses stale in every cache sharing cache_dir"""
+		cache = SearchCache(cache_dir=self.cache_dir, disk_tier=True, stamp_interval=0)
+		other = {"index": "other_index"}
+		cache.put(HEADER, QUERY, RESPONSE)
+		cache.put(other, QUERY, RESPONSE)
+		time.sleep(0.01)
+		invalidate_index("factual_index", cache_dir=self.cache_dir)
+		self.assertEqual(cache.get(HEADER, QUERY), None)
+		self.assertEqual(cache.get(other, QUERY), RESPONSE)
+		self.assertTrue(os.path.isfile(os.path.join(self.cache_dir, "factual_index.stamp")))
+
+	def test_disk_tier(self):
+		"""A new cache sharing cache_dir reads responses from the disk tier"""
+		SearchCache(cache_dir=self.cache_dir, disk_tier=True).put(HEADER, QUERY, RESPONSE)
+		cache = SearchCache(cache_dir=self.cache_dir, disk_tier=True)
+		self.assertEqual(cache.get(HEADER, QUERY), RESPONSE)
+		self.assertEqual(len(cache), 1)
+		self.assertEqual(SearchCache(cache_dir=self.cache_dir).get(HEADER, QUERY), None)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -1,5 +1,9 @@
+import shutil
+import tempfile
 import unittest
 from meerkat.web_service import web_consumer
+from meerkat.web_service.memo_cache import MemoCache
+from meerkat.web_service.search_cache import SearchCache
 from tests.web_service.fixture import web_consumer_fixture
 from nose_parameterized import parameterized
 
@@ -184,6 +188,18 @@ class WebConsumerTest(unittest.TestCase):
 		for trans in test_request["transaction_list"]:
 			self.assertTrue("is_physical_merchant" in trans)
 
+	def test_sws_metrics(self):
+		"""Assert the latency and batch size of the SWS stage are recorded"""
+		test_request = web_consumer_fixture.get_test_request_bank()
+		before = self.consumer.metrics.batch_size.get("sws")
+		before = before.snapshot() if before is not None else ([0], 0)
+		self.consumer._WebConsumer__sws(test_request)
+		cumulative, total = self.consumer.metrics.batch_size["sws"].snapshot()
+		self.assertEqual(cumulative[-1], before[0][-1] + 1)
+		self.assertEqual(total, before[1] + len(test_request["transaction_list"]))
+		self.assertIn('meerkat_stage_latency_seconds_count{stage="sws"}',
+			self.consumer.metrics.format())
+
 	def test_apply_enrich_physical(self):
 		"""Assert transactions returned from enrich_physical have all the expected fields for a successful search"""
 		self.consumer._WebConsumer__search_index = web_consumer_fixture.get_mock_msearch
@@ -211,5 +227,163 @@ class WebConsumerTest(unittest.TestCase):
 			self.assertTrue("category_labels" in trans)
 			self.assertTrue("description" in trans)
 
+	@parameterized.expand([
+		([{}, 1, [0, 0]]),
+		([{"intra_op": 16, "inter_op": 4}, 1, [16, 4]]),
+		([{"intra_op": 16, "inter_op": 4}, 8, [2, 1]]),
+		([{"intra_op": 2, "inter_op": 2}, 8, [1, 1]])
+	])
+	def test_get_session_threads(self, tf_threads, workers, expected):
+		"""Test get_session_threads divides TensorFlow threads between workers"""
+		self.assertEqual(web_consumer.get_session_threads(tf_threads, workers), expected)
+
+	@parameterized.expand([
+		([5, 0, 1, [5]]),
+		([5, 10, 4, [5]]),
+		([10, 4, 8, [4, 4, 2]]),
+		([10, 2, 3, [4, 4, 2]])
+	])
+	def test_get_shards(self, count, shard_size, max_shards, expected):
+		"""Test get_shards splits transactions into at most max_shards in order"""
+		transactions = list(range(count))
+		shards = web_consumer.get_shards(transactions, shard_size, max_shards)
+		self.assertEqual([len(shard) for shard in shards], expected)
+		self.assertEqual([trans for shard in shards for trans in shard], transactions)
+
+	def test_classify_shards_keep_order(self):
+		"""Assert a request split into shards is returned in its original order"""
+		data = web_consumer_fixture.get_test_request_bank()
+		data["transaction_list"] = [dict(trans, description="{0} {1}".format(
+			trans["description"], i)) for i in range(3)
+			for trans in data["transaction_list"]]
+		transactions = list(data["transaction_list"])
+		data["services_list"] = ["search"]
+		self.consumer.shard_size, self.consumer.max_shards = 1, 4
+		timings = dict()
+		try:
+			result = self.consumer.classify(data, optimizing=True, timings=timings)
+		finally:
+			self.consumer.shard_size, self.consumer.max_shards = 0, 1
+		self.assertEqual(len(result["transaction_list"]), len(transactions))
+		for trans, expected in zip(result["transaction_list"], transactions):
+			self.assertIs(trans, expected)
+		self.assertIn("cpu", timings)
+
+	def test_load_category_rules(self):
+		"""Test load_category_rules keys sets of categories by ledger entry and container"""
+		rules = web_consumer.load_category_rules()
+		self.assertEqual(rules[("credit", "card")][1], True)
+		self.assertEqual(rules[("debit", "bank")][1], False)
+		self.assertIn("Insurance", rules[("debit", "card")][0])
+		self.assertEqual(self.consumer.category_rules, rules)
+
+	@parameterized.expand([
+		(["credit", "bank", "Other Income", "Restaurants"]),
+		(["credit", "bank", "Transfers", "Transfers"]),
+		(["debit", "bank", "Insurance", "Insurance"]),
+		(["debit", "card", "Savings", "Restaurants"]),
+		(["debit", "unknown", "Savings", "Savings"])
+	])
+	def test_apply_category_rules(self, ledger_entry, container, category, expected):
+		"""Test __apply_category lets the merchant CNN decide where the rules say so"""
+		transactions = [{"ledger_entry": ledger_entry, "container": container,
+			"category_labels": [category], "CNN": {"label": "Starbucks",
+			"category": "Restaurants"}}]
+		self.consumer._WebConsumer__apply_category(transactions)
+		self.assertEqual(transactions[0]["category_labels"], [expected])
+		self.assertEqual(transactions[0]["CNN"], "Starbucks")
+
+	def test_search_deadline_falls_back_to_no_result(self):
+		"""Assert transactions whose search failed or passed its deadline get no result"""
+		self.consumer._WebConsumer__search_index = lambda queries: None
+		transactions = web_consumer_fixture.get_test_transaction_list()
+		try:
+			enriched = self.consumer._WebConsumer__enrich_physical(transactions)
+		finally:
+			self.consumer._WebConsumer__search_index = web_consumer_fixture.get_mock_msearch
+		self.assertEqual(len(enriched), len(transactions))
+		for trans in enriched:
+			self.assertEqual(trans["match_found"], False)
+			self.assertEqual(trans["country"], "US")
+			self.assertEqual(trans["merchant_name"], "")
+
+	def test_cached_search_sends_only_misses(self):
+		"""Assert only distinct queries missing from the search cache are sent to msearch"""
+		bodies = []
+		def counting_msearch(queries):
+			bodies.append(queries)
+			return web_consumer_fixture.get_mock_msearch(queries)
+		cache_dir = tempfile.mkdtemp()
+		self.consumer._WebConsumer__search_index = counting_msearch
+		self.consumer.search_cache = SearchCache(cache_dir=cache_dir)
+		try:
+			first = self.consumer._WebConsumer__enrich_physical(
+				web_consumer_fixture.get_test_transaction_list())
+			second = self.consumer._WebConsumer__enrich_physical(
+				web_consumer_fixture.get_test_transaction_list())
+		finally:
+			self.consumer._WebConsumer__search_index = web_consumer_fixture.get_mock_msearch
+			self.consumer.search_cache = None
+			shutil.rmtree(cache_dir)
+		# The two distinct queries are sent once
+		self.assertEqual(len(bodies), 1)
+		self.assertEqual(len(bodies[0].split("\n")), 4)
+		self.assertEqual(first[0]["source_merchant_id"], first[1]["source_merchant_id"])
+		self.assertEqual(first, second)
+
+	def test_search_not_memoized_across_locales(self):
+		"""Assert transactions whose queries differ only by locale_bloom are both
+		searched, even with the memo cache enabled"""
+		bodies = []
+		def counting_msearch(queries):
+			bodies.append(queries)
+			return web_consumer_fixture.get_mock_msearch(queries)
+		self.consumer._WebConsumer__search_index = counting_msearch
+		self.consumer.memo_cache = MemoCache(max_size=100)
+		web_consumer.BANK_SWS = lambda descriptions: ["1"] * len(descriptions)
+		try:
+			# Only the second request finds a locale with the bloom filter
+			for services_list in [["search"], []]:
+				data = web_consumer_fixture.get_test_request_bank()
+				data["transaction_list"] = [{"ledger_entry": "debit",
+					"description": "some physical location san francisco ca"}]
+				data["services_list"] = services_list
+				self.consumer.classify(data, optimizing=True)
+		finally:
+			self.consumer._WebConsumer__search_index = web_consumer_fixture.get_mock_msearch
+			self.consumer.memo_cache = None
+			web_consumer.BANK_SWS = web_consumer_fixture.get_mock_sws
+		self.assertEqual(len(bodies), 2)
+		self.assertNotEqual(bodies[0], bodies[1])
+
+	def test_memoized_sws_and_merchant_cnn(self):
+		"""Assert descriptions seen before are served from the memo cache until
+		the models are reloaded"""
+		calls = []
+		def counting_sws(descriptions):
+			calls.append(len(descriptions))
+			return web_consumer_fixture.get_mock_sws(descriptions)
+		web_consumer.BANK_SWS = counting_sws
+		self.consumer.memo_cache = MemoCache(max_size=100)
+		try:
+			first = web_consumer_fixture.get_test_request_bank()
+			self.consumer._WebConsumer__sws(first)
+			self.consumer._WebConsumer__apply_merchant_cnn(first)
+			second = web_consumer_fixture.get_test_request_bank()
+			self.consumer._WebConsumer__sws(second)
+			self.consumer._WebConsumer__apply_merchant_cnn(second)
+
+			self.assertEqual(calls, [len(first["transaction_list"]), 0])
+			for before, after in zip(first["transaction_list"], second["transaction_list"]):
+				self.assertEqual(before["is_physical_merchant"], after["is_physical_merchant"])
+				self.assertEqual(before["CNN"], after["CNN"])
+			stats = self.consumer.memo_cache.stats()
+			self.assertEqual(stats["stages"]["sws"]["hit_rate"], 0.5)
+			self.assertEqual(stats["stages"]["merchant_cnn"]["hits"],
+				len(second["transaction_list"]))
+		finally:
+			web_consumer.BANK_SWS = web_consumer_fixture.get_mock_sws
+			self.consumer.memo_cache = None
+
 if __name__ == "__main__":
 	unittest.main()
@@ -0,0 +1,166 @@
+"""This module is a stand-in for the Elasticsearch cluster of the web
+service. It answers msearch requests with made up merchants after a
+configurable latency, so the search path can be benchmarked offline.
+
+USAGE:
+# python3 -m web_service_tester.fake_elasticsearch --port 9200 --latency_ms 20
+
+Then set skip_es to false and cluster_nodes to ["localhost:9200"] in
+meerkat/web_service/config/web_service.json
+
+@author: J. Andrew Key
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+def get_hit(query_text, rank, score, index="factual_index", doc_type="factual_type"):
+	"""Return a made up merchant for a query, the same query always gets the
+	same merchants"""
+	digest = hashlib.sha1("{0}:{1}".format(query_text, rank).encode("utf-8")).hexdigest()
+	return {
+		"_index": index,
+		"_type": doc_type,
+		"_id": digest,
+		"_score": score,
+		"fields": {
+			"name": ["Merchant " + digest[:8]],
+			"locality": ["Mockville"],
+			"region": ["CA"],
+			"postcode": ["12345"],
+			"address": ["{0} Mock St".format(int(digest[:4], 16))],
+			"country": ["us"],
+			"factual_id": [digest],
+			"category_labels": ["[\"Retail\",\"Gift and Novelty\"]"]
+		},
+		"_source": {"pin": {"location": {"coordinates": ["-73.807267", "40.989156"],
+			"type": "point"}}}
+	}
+
+def get_response(query, index="factual_index", doc_type="factual_type"):
+	"""Return the response to one query of an msearch, the top hit stands
+	out enough to be accepted"""
+	query_text = json.dumps(query, sort_keys=True)
+	size = int(query.get("size", 10)) if isinstance(query, dict) else 10
+	hits = [get_hit(query_text, rank, 10.0 if rank == 0 else 1.0, index, doc_type)
+		for rank in range(max(size, 2))]
+	return {"took": 1, "timed_out": False,
+		"hits": {"total": len(hits), "max_score": 10.0, "hits": hits}}
+
+class FakeElasticsearch(ThreadingMixIn, HTTPServer):
+	"""An in-process msearch responder. Each msearch waits latency seconds,
+	plus up to jitter seconds, before answering."""
+	daemon_threads = True
+
+	def __init__(self, port=0, latency=0.0, jitter=0.0, index="factual_index",
+		doc_type="factual_type"):
+		"""Initializes the FakeElasticsearch and starts serving"""
+		HTTPServer.__init__(self, ("127.0.0.1", port), FakeElasticsearchHandler)
+		self.latency = latency
+		self.jitter = jitter
+		self.index = index
+		self.doc_type = doc_type
+		self.requests = 0
+		self.queries = 0
+		self.connections = 0
+		self.__lock = threading.Lock()
+		self.__thread = threading.Thread(target=self.serve_forever, name="fake_elasticsearch")
+		self.__thread.daemon = True
+		self.__thread.start()
+
+	@property
+	def url(self):
+		"""Return the URL of the responder"""
+		return "http://127.0.0.1:{0}".format(self.server_address[1])
+
+	def connect(self):
+		"""Count a client connection"""
+		with self.__lock:
+			self.connections += 1
+
+	def count(self, queries):
+		"""Count an msearch request of queries queries"""
+		with self.__lock:
+			self.requests += 1
+			self.queries += queries
+
+	def close(self):
+		"""Stop serving"""
+		self.shutdown()
+		self.server_close()
+
+class FakeElasticsearchHandler(BaseHTTPRequestHandler):
+	"""Answers the requests the web service sends to Elasticsearch"""
+	protocol_version = "HTTP/1.1"
+
+	def setup(self):
+		BaseHTTPRequestHandler.setup(self)
+		self.server.connect()
+
+	def send_json(self, body):
+		"""Send a JSON response"""
+		output = json.dumps(body).encode("utf-8")
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json; charset=UTF-8")
+		self.send_header("Content-Length", str(len(output)))
+		self.end_headers()
+		self.wfile.write(output)
+
+	def do_HEAD(self):
+		self.send_response(200)
+		self.send_header("Content-Length", "0")
+		self.end_headers()
+
+	def do_GET(self):
+		if self.path.split("?")[0].endswith("/_mapping"):
+			# Without _routing, so queries are not routed
+			self.send_json({self.server.index: {"mappings": {self.server.doc_type: {}}}})
+		else:
+			self.send_json({"name": "fake_elasticsearch", "version": {"number": "1.7.0"}})
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+		if not self.path.split("?")[0].endswith("/_msearch"):
+			self.send_error(404)
+			return
+		# Like Elasticsearch, which requires every line to end with a newline
+		if not body.endswith("\n"):
+			self.send_error(400, "The msearch request must be terminated by a newline")
+			return
+		lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+		queries = lines[1::2]
+		self.server.count(len(queries))
+		time.sleep(self.server.latency + random.uniform(0, self.server.jitter))
+		self.send_json({"responses": [get_response(query, self.server.index,
+			self.server.doc_type) for query in queries]})
+
+	def log_message(self, *args):
+		return
+
+def main():
+	"""Serve until interrupted"""
+	parser = argparse.ArgumentParser(description="Fake Elasticsearch msearch responder")
+	parser.add_argument("--port", type=int, default=9200)
+	parser.add_argument("--latency_ms", type=float, default=20.0,
+		help="Milliseconds every msearch waits before answering")
+	parser.add_argument("--jitter_ms", type=float, default=0.0,
+		help="Up to this many more milliseconds, chosen at random")
+	args = parser.parse_args()
+	server = FakeElasticsearch(port=args.port, latency=args.latency_ms / 1000.0,
+		jitter=args.jitter_ms / 1000.0)
+	print("Serving msearch on {0}".format(server.url))
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		server.close()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,165 @@
+"""This module load tests the web service. Requests are sent at an open-loop
+arrival rate, whether or not earlier ones have been answered, with payloads
+sampled from the example requests. Latency percentiles, throughput and error
+rate are written as JSON so runs can be compared across commits.
+
+USAGE:
+# python3 -m web_service_tester.load_test --rate 50 --duration 60 \
+--output load_test.json
+# Search against a local stand-in for Elasticsearch, started in this process
+# python3 -m web_service_tester.load_test --fake_es_port 9200 --fake_es_latency_ms 20
+
+@author: J. Andrew Key
+"""
+
+import argparse
+import json
+import logging
+import math
+import random
+import subprocess
+import time
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+
+from web_service_tester.fake_elasticsearch import FakeElasticsearch
+
+DEFAULT_PAYLOADS = ["web_service_tester/big.json", "web_service_tester/one_ledger.json"]
+
+def parse_arguments(args=None):
+	""" Create the parser """
+	parser = argparse.ArgumentParser(description="Load test the web service")
+	parser.add_argument("--url", default="https://localhost:443/meerkat/v2.4",
+		help="Endpoint to POST requests to")
+	parser.add_argument("--payloads", nargs="+", default=DEFAULT_PAYLOADS,
+		help="Request bodies to sample from")
+	parser.add_argument("--rate", type=float, default=10.0, help="Requests per second")
+	parser.add_argument("--duration", type=float, default=30.0,
+		help="Seconds to send requests for")
+	parser.add_argument("--timeout", type=float, default=30.0, help="Seconds per request")
+	parser.add_argument("--max_clients", type=int, default=1000,
+		help="Most requests open at once")
+	parser.add_argument("--seed", type=int, default=0, help="Random seed of arrivals")
+	parser.add_argument("--output", default="load_test.json", help="Path to the results")
+	parser.add_argument("--fake_es_port", type=int, default=None,
+		help="Serve a fake Elasticsearch on this port during the test")
+	parser.add_argument("--fake_es_latency_ms", type=float, default=20.0,
+		help="Milliseconds every fake msearch takes")
+	return parser.parse_args(args)
+
+def load_payloads(filenames):
+	"""Return the name and bytes of each payload file"""
+	payloads = []
+	for filename in filenames:
+		with open(filename, "rb") as payload_file:
+			payloads.append((filename, payload_file.read()))
+	return payloads
+
+def get_percentile(values, percent):
+	"""Return the nearest-rank percentile of sorted values"""
+	if not values:
+		return None
+	rank = max(int(math.ceil(percent / 100.0 * len(values))), 1)
+	return values[min(rank, len(values)) - 1]
+
+def summarize(results, elapsed):
+	"""Return latency percentiles in milliseconds, throughput and error rate
+	of a list of (payload, latency in seconds, success)"""
+	latencies = sorted(latency * 1000 for _, latency, success in results if success)
+	errors = sum(1 for _, _, success in results if not success)
+	summary = {
+		"requests": len(results),
+		"errors": errors,
+		"error_rate": errors / len(results) if results else 0.0,
+		"throughput": len(latencies) / elapsed if elapsed else 0.0,
+		"latency_ms": {
+			"p50": get_percentile(latencies, 50),
+			"p95": get_percentile(latencies, 95),
+			"p99": get_percentile(latencies, 99),
+			"max": latencies[-1] if latencies else None,
+			"mean": sum(latencies) / len(latencies) if latencies else None
+		}
+	}
+	return summary
+
+@gen.coroutine
+def run_load(url, payloads, rate, duration, timeout=30.0, max_clients=1000, seed=0):
+	"""Send requests with exponentially distributed gaps averaging 1/rate
+	seconds for duration seconds. Latency is measured from when a request
+	was due, so a slow server is not hidden by sending fewer requests.
+	Returns a list of (payload, latency, success) and the elapsed seconds."""
+	client = AsyncHTTPClient(force_instance=True, max_clients=max_clients)
+	arrivals = random.Random(seed)
+	results, pending = [], []
+
+	@gen.coroutine
+	def send(name, body, due):
+		"""Send one request"""
+		request = HTTPRequest(url, method="POST", body=body, validate_cert=False,
+			headers={"Content-Type": "application/json"}, request_timeout=timeout)
+		try:
+			response = yield client.fetch(request, raise_error=False)
+			success = response.code == 200
+		except Exception as exception:
+			logging.warning("Request failed: {0}".format(exception))
+			success = False
+		results.append((name, time.time() - due, success))
+
+	start = time.time()
+	due = start
+	while due < start + duration:
+		name, body = arrivals.choice(payloads)
+		pending.append(send(name, body, due))
+		due += arrivals.expovariate(rate)
+		delay = due - time.time()
+		if delay > 0:
+			yield gen.sleep(delay)
+	yield pending
+	elapsed = time.time() - start
+	client.close()
+	return results, elapsed
+
+def get_commit():
+	"""Return the commit being tested, if any"""
+	try:
+		return subprocess.check_output(["git", "rev-parse", "HEAD"],
+			stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def main(args=None):
+	"""Run a load test and write its results"""
+	args = parse_arguments(args)
+	payloads = load_payloads(args.payloads)
+	fake_es = None
+	if args.fake_es_port is not None:
+		fake_es = FakeElasticsearch(port=args.fake_es_port,
+			latency=args.fake_es_latency_ms / 1000.0)
+		logging.warning("Fake Elasticsearch serving on {0}".format(fake_es.url))
+
+	try:
+		results, elapsed = IOLoop.current().run_sync(lambda: run_load(args.url, payloads,
+			args.rate, args.duration, args.timeout, args.max_clients, args.seed))
+	finally:
+		if fake_es is not None:
+			fake_es.close()
+
+	report = {"commit": get_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"url": args.url, "rate": args.rate, "duration": args.duration,
+		"overall": summarize(results, elapsed), "payloads": dict()}
+	for name, _ in payloads:
+		report["payloads"][name] = summarize([result for result in results
+			if result[0] == name], elapsed)
+	if fake_es is not None:
+		report["fake_es"] = {"latency_ms": args.fake_es_latency_ms,
+			"msearch_requests": fake_es.requests, "queries": fake_es.queries}
+
+	with open(args.output, "w") as output_file:
+		json.dump(report, output_file, indent=4, sort_keys=True)
+	print(json.dumps(report["overall"], indent=4, sort_keys=True))
+	return report
+
+if __name__ == "__main__":
+	main()